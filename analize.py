@@ -15,16 +15,23 @@ if __name__ == '__main__':
                       " of the cluster to build", default=0)
   parser.add_argument('--smooth', '-s', action='store_true')
   parser.add_argument('--hydrogenate', '-y', action='store_true')
+  parser.add_argument('--cell_list', action='store_true', help='the neighbors'
+                      ' are found with a cell list, recommended for large cells')
+  parser.add_argument('--workers', '-j', type=int, default=None, help='number of'
+                      ' threads to find the neighbors')
 
+  parser.add_argument('--cache', action='store_true', help='use a binary cache'
+                      ' of the parsed input file')
   parser.add_argument('-v', '--verbose', action='store_true')
   
   
   args = parser.parse_args()
   
-  p = poscar.Poscar(args.inputfile, verbose=False)
+  p = poscar.Poscar(args.inputfile, verbose=False, cache=args.cache)
   p.parse()
   
-  Defects = defects.FindDefect(poscar=p,verbose=args.verbose)
+  Defects = defects.FindDefect(poscar=p,verbose=args.verbose, cell_list=args.cell_list,
+                               workers=args.workers)
   print(Defects.defects)
 
   # going to write a new file to mark the defects
@@ -0,0 +1,161 @@
+"""Opt-in on-disk cache of parsed files.
+
+The parsed arrays of a file (i.e. a POSCAR or a CHGCAR) are stored as
+.npy files in a sidecar directory, next to the original file:
+
+  path/to/POSCAR -> path/to/.pyposcar_cache/POSCAR/<name>/
+
+together with a `meta.json` file with the size, modification time and
+sha1 of the original file (and any other small info). The cache is
+valid if the size and mtime match; if only the mtime changed (i.e. the
+file was copied or touched) the sha1 is compared. The .npy files can be
+opened as memory maps.
+
+-load(filename, name, mmap_mode='c'):
+ the cached (arrays, info) of `filename`, or None
+
+-save(filename, name, arrays, info=None):
+ stores a dict of arrays (and a json-able dict `info`)
+
+-clear(filename, name=None):
+ removes the cache of `filename`
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+# changing this number invalidates all the caches
+CACHE_VERSION = 1
+CACHE_DIR = '.pyposcar_cache'
+
+
+def cache_path(filename, name):
+  """The directory with the cache `name` of `filename`"""
+  dirname, basename = os.path.split(os.path.abspath(filename))
+  return os.path.join(dirname, CACHE_DIR, basename, name)
+
+def file_sha1(filename, chunk=1 << 24):
+  """sha1 of the content of `filename`, read by chunks"""
+  sha1 = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    while True:
+      data = f.read(chunk)
+      if not data:
+        break
+      sha1.update(data)
+  return sha1.hexdigest()
+
+def _read_meta(path):
+  try:
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def _write_meta(path, meta):
+  temp = os.path.join(path, 'meta.json.tmp')
+  with open(temp, 'w') as f:
+    json.dump(meta, f)
+  os.replace(temp, os.path.join(path, 'meta.json'))
+
+def _write_array(path, key, array):
+  temp = os.path.join(path, key + '.npy.tmp')
+  with open(temp, 'wb') as f:
+    np.save(f, np.asarray(array))
+  os.replace(temp, os.path.join(path, key + '.npy'))
+
+def is_valid(filename, name, verbose=False):
+  """Is there an up to date cache `name` of `filename`?"""
+  path = cache_path(filename, name)
+  meta = _read_meta(path)
+  if meta is None or meta.get('version') != CACHE_VERSION:
+    return False
+  stat = os.stat(filename)
+  if stat.st_size != meta['size']:
+    return False
+  if stat.st_mtime_ns == meta['mtime_ns']:
+    return True
+  # the file was touched, perhaps not modified
+  if file_sha1(filename) != meta['sha1']:
+    if verbose:
+      print('cacheUtils: the cache of', filename, 'is outdated')
+    return False
+  meta['mtime_ns'] = stat.st_mtime_ns
+  try:
+    _write_meta(path, meta)
+  except OSError:
+    pass
+  return True
+
+def load(filename, name, mmap_mode='c', verbose=False):
+  """Loads the cache `name` of `filename`.
+
+  `mmap_mode`: passed to np.load. The default, 'c' (copy-on-write),
+  gives arrays that can be modified in memory without changing the
+  cache. None loads the arrays into memory.
+
+  return: (arrays, info), a dict of arrays and the dict stored with
+  them. None if there is no valid cache.
+
+  """
+  if not is_valid(filename, name, verbose=verbose):
+    return None
+  path = cache_path(filename, name)
+  meta = _read_meta(path)
+  arrays = {}
+  try:
+    for key in meta['arrays']:
+      arrays[key] = np.load(os.path.join(path, key + '.npy'), mmap_mode=mmap_mode)
+  except (OSError, ValueError):
+    return None
+  if verbose:
+    print('cacheUtils: loaded', name, 'cache of', filename)
+  return arrays, meta['info']
+
+def save(filename, name, arrays, info=None, verbose=False):
+  """Stores the dict of `arrays` (one .npy file each) and the dict
+  `info` (it has to be json-serializable) as the cache `name` of
+  `filename`. If the cache can't be written (i.e. a read-only
+  directory) nothing happens.
+
+  return: True if the cache was written
+
+  """
+  path = cache_path(filename, name)
+  stat = os.stat(filename)
+  meta = {'version' : CACHE_VERSION,
+          'size' : stat.st_size,
+          'mtime_ns' : stat.st_mtime_ns,
+          'sha1' : file_sha1(filename),
+          'arrays' : list(arrays.keys()),
+          'info' : info if info is not None else {}}
+  try:
+    os.makedirs(path, exist_ok=True)
+    # the old meta is removed first, an interrupted save is never valid
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+      os.remove(os.path.join(path, 'meta.json'))
+    # each file is written aside and then renamed, the arrays already
+    # loaded (memory maps) keep the old data
+    for key, array in arrays.items():
+      _write_array(path, key, array)
+    _write_meta(path, meta)
+  except OSError as error:
+    if verbose:
+      print('cacheUtils: the cache of', filename, 'was not written:', error)
+    return False
+  if verbose:
+    print('cacheUtils: written', name, 'cache of', filename)
+  return True
+
+def clear(filename, name=None):
+  """Removes the cache `name` of `filename`, or all its caches if
+  `name` is None"""
+  if name is not None:
+    shutil.rmtree(cache_path(filename, name), ignore_errors=True)
+    return
+  # the caches of each file are in their own directory
+  shutil.rmtree(os.path.dirname(cache_path(filename, 'x')), ignore_errors=True)
@@ -11,13 +11,16 @@ import argparse
 import os
 import numpy as np
 import poscar
-import re
-import math
-from scipy.interpolate import griddata
+import cacheUtils
+from scipy.ndimage import map_coordinates
 import matplotlib.pyplot as plt
 import warnings
 import plot3d
 
+def _parse_lines(lines):
+  """the floats of a list of lines (bytes), parsed at once (internal)"""
+  return np.fromstring(b''.join(lines), sep=' ')
+
 class Chg_base:
   def __init__(self):
     self.comment = None
@@ -26,25 +29,51 @@ class Chg_base:
     self.poscar = None
     self.File = []
     self.Data_blocks = []
-    self.Data0 = np.array([])
-    self.Data1 = np.array([])
-    self.Data2 = np.array([])
-    self.Data3 = np.array([])
+    self.filename = None
+    # byte offset of each data block, Data0,...,Data3 are parsed only
+    # when they are used
+    self.offsets = []
+    self._data = [np.array([])]*4
+    # byte offset of each frame, see index()
+    self.frame_offsets = None
+    self.Nframes = None
+    self._index_file = None
     self.is_chg = True
     self.is_locpot = None
+    self.verbose = False
+    self.cache = False
+    # number of lines parsed at once, the memory used while parsing is
+    # roughly chunk*(line length)
+    self.chunk = 1 << 16
     
-  def Load(self, filename='CHGCAR', frame=0, is_chg=None, verbose=None):
+  def Load(self, filename='CHGCAR', frame=0, is_chg=None, verbose=None, cache=None):
     """Load a CHG-like file 
 
     `verbose` = False: No verbosity
               = True: verbose output
               = 'debug': usually unwanted verbosity level
 
+    `frame`: the frame to load (0-based, negative values count from
+    the end). The frames are located with index().
+
+    `cache`: if True, the grids (and the POSCAR) of the frame are
+    stored in a binary cache next to the file (see cacheUtils), later
+    loads open them as read-only memory maps. The index of frames is
+    cached too.
+
+    The file is scanned sequentially, only the header and the grid
+    lines are parsed, the augmentation occupancies are skipped. The
+    byte offset of each data block is stored and the block is parsed
+    (by chunks of lines, into a preallocated array) the first time it
+    is used, i.e. `self.Data1`. The file shouldn't change meanwhile.
+
     """
     if verbose != None:
       self.verbose = verbose
     if is_chg != None:
       self.is_chg = is_chg
+    if cache != None:
+      self.cache = cache
     if self.verbose:
       print("\nINFO: Loading a CHG-like with the following parameters:")
       print("INFO: Filename: ", filename)
@@ -53,47 +82,286 @@ class Chg_base:
     if not os.path.isfile(filename):
       print("ERROR: can't open the file, please check:", filename)
       raise RuntimeError('File does not exist')
-    self.File = open(filename, 'r').read()
-        
-    # getting how many ionic steps were loaded
-    self.comment = re.findall(r'^[^\n]*\n', self.File)[0]
-    if self.verbose == 'debug':
-      print('DEBUG: Comment line:')
-      print(self.comment)
-
-    Nframes = len(re.findall(self.comment, self.File))
-    if self.verbose == 'debug':
-      print('DEBUG: Number of frames found:', Nframes)
-
+    self.filename = filename
+    if frame != 0:
+      offsets = self.index(filename)
+      if frame < 0:
+        frame = frame + len(offsets)
+      if frame < 0 or frame >= len(offsets):
+        raise RuntimeError('Frame ' + str(frame) + ' not found, there are ' +
+                           str(len(offsets)) + ' frames')
+    if self.cache and self._load_cache(filename, frame):
+      return
+
+    with open(filename, 'rb') as f:
+      # the comment line starts every frame
+      self.comment = f.readline().decode()
+      if self.verbose == 'debug':
+        print('DEBUG: Comment line:')
+        print(self.comment)
+      if self.verbose:
+        print('INFO: Selecting the frame:', frame)
+      f.seek(self.frame_offsets[frame] if frame != 0 else 0)
+      if not self._read_frame(f, parse=True):
+        raise RuntimeError('Frame ' + str(frame) + ' not found')
+    if self.cache:
+      self._save_cache(filename, frame)
+
+  def index(self, filename):
+    """The byte offset where each frame of `filename` starts
+    (np.array). The file is scanned once, without parsing the data
+    blocks. If `self.cache`, the index is stored next to the file (see
+    cacheUtils)"""
+    if self._index_file == filename:
+      return self.frame_offsets
+    cached = None
+    if self.cache:
+      cached = cacheUtils.load(filename, 'chgindex', mmap_mode=None,
+                               verbose=self.verbose)
+    if cached is not None:
+      self.frame_offsets = cached[0]['offsets']
+    else:
+      NGF = self.NGF
+      offsets = []
+      with open(filename, 'rb') as f:
+        self.comment = f.readline().decode()
+        f.seek(0)
+        while True:
+          start = f.tell()
+          if not self._read_frame(f, parse=False):
+            break
+          offsets.append(start)
+      self.NGF = NGF
+      self.frame_offsets = np.array(offsets, dtype=np.int64)
+      if self.cache:
+        cacheUtils.save(filename, 'chgindex', {'offsets' : self.frame_offsets},
+                        verbose=self.verbose)
+    self.Nframes = len(self.frame_offsets)
+    self._index_file = filename
     if self.verbose:
-      print('INFO: Selecting the frame:', frame)
-    frames = re.split(self.comment, self.File)
-    # if the first frame is empty (a `re` thing), should be discarded
-    if len(frames[0]) == 0:
-      frames.pop(0)
-    self.File = frames[frame]
-
-    # next string to find is the line with
+      print('INFO: Number of frames found:', self.Nframes)
+    return self.frame_offsets
+
+  def frames(self, filename='CHG', start=0, stop=None, step=1):
+    """Generator with the frames from `start` to `stop` (not included)
+    each `step`. The frame is loaded into this object, which is
+    yielded (the arrays of each frame are new, the data blocks are
+    parsed when used). The other options are the ones of the last
+    Load(), or the defaults."""
+    offsets = self.index(filename)
+    for frame in range(*slice(start, stop, step).indices(len(offsets))):
+      self.Load(filename, frame=frame)
+      yield self
+
+  def _cache_name(self, frame):
+    """the name of the cache of `frame`, the scaled (`is_chg`) and
+    unscaled grids are cached apart (internal)"""
+    return 'chg%d_%d' % (frame, bool(self.is_chg))
+
+  def _save_cache(self, filename, frame):
+    """stores the grids and the POSCAR of `frame` in the cache of the
+    file (internal)"""
+    arrays, info = self.poscar._cache_arrays()
+    arrays = {'poscar_' + key : arrays[key] for key in arrays}
+    arrays['NGF'] = self.NGF
+    for i in range(self.Ispin):
+      arrays['Data' + str(i)] = getattr(self, 'Data' + str(i))
+    info = {'poscar' : info,
+            'comment' : self.comment,
+            'Ispin' : self.Ispin,
+            'is_chg' : bool(self.is_chg),
+            'is_locpot' : self.is_locpot}
+    cacheUtils.save(filename, self._cache_name(frame), arrays, info,
+                    verbose=self.verbose)
+
+  def _load_cache(self, filename, frame):
+    """loads `frame` from the cache of the file, if it is up to date
+    (and it has the same scaling, `is_chg`). The grids are read-only
+    memory maps. Returns True on success (internal)"""
+    cached = cacheUtils.load(filename, self._cache_name(frame), mmap_mode='r',
+                             verbose=self.verbose)
+    if cached is None:
+      return False
+    arrays, info = cached
+    if info['is_chg'] != bool(self.is_chg):
+      return False
+    # the POSCAR is small, a copy in memory is kept
+    arrays_poscar = {key[7:] : np.array(arrays[key]) for key in arrays
+                     if key.startswith('poscar_')}
+    self.poscar = poscar.Poscar(filename=None)
+    self.poscar._from_cache(arrays_poscar, info['poscar'])
+    self.comment = info['comment']
+    self.NGF = np.array(arrays['NGF'])
+    self.Ispin = info['Ispin']
+    self.is_locpot = info['is_locpot']
+    self._data = [np.array([])]*4
+    for i in range(self.Ispin):
+      setattr(self, 'Data' + str(i), arrays['Data' + str(i)])
+    if self.verbose:
+      print('INFO: NGFx NGFy NGFz', self.NGF)
+      print('INFO: Ispin', self.Ispin)
+    return True
+
+  def _read_header(self, f):
+    """Reads the POSCAR-like header of a frame and the grid line
+    (NGFx NGFy NGFz). Returns the lines of the header (str), or None
+    at the end of the file (internal)"""
+    lines = []
+    while True:
+      line = f.readline()
+      if not line:
+        if len(lines) == 0:
+          return None
+        raise RuntimeError('The line with NGFx NGFy NGFz was not found')
+      # the header ends with a blank line
+      if len(lines) > 0 and len(line.strip()) == 0:
+        break
+      if len(lines) > 0 or len(line.strip()) > 0:
+        lines.append(line.decode())
+    # next line to find is the line with
     # NGFx NGFy NGFz
-    NGFline = re.findall(r'\n\s*\n(\s+\d+\s+\d+\s+\d+)\n', self.File)
-    if verbose:
-      print('INFO: NGFx NGFy NGFz', NGFline)
-    if len(NGFline) != 1:
-      raise RuntimeError('NGFline should have one and only one occurrence')
-    NGFline = NGFline[0]
-    self.NGF = np.array(NGFline.split(), dtype=int)
-    if verbose == 'debug':
-      print('DEBUG: grid size,', self.NGF)
-
-    data = re.split(NGFline, self.File)
-    ndata = len(data)
+    line = f.readline()
+    while line and len(line.strip()) == 0:
+      line = f.readline()
+    try:
+      self.NGF = np.array(line.split(), dtype=int)
+    except ValueError:
+      raise RuntimeError('The line with NGFx NGFy NGFz was not found')
+    if len(self.NGF) != 3:
+      raise RuntimeError('The line with NGFx NGFy NGFz was not found')
+    if self.verbose:
+      print('INFO: NGFx NGFy NGFz', self.NGF)
+    return lines
+
+  def _read_block(self, f, Ndata, parse=True):
+    """Reads `Ndata` values from the current position of `f` into a
+    new array (or just skips them if not `parse`), by chunks of
+    `self.chunk` lines (internal)"""
+    data = np.empty(Ndata) if parse else None
+    filled = 0
+    first = f.readline()
+    ncols = max(1, len(first.split()))
+    lines = [first]
+    while True:
+      try:
+        values = _parse_lines(lines)
+      except ValueError:
+        # text found before the end of the block
+        raise RuntimeError('Grid points do not agree')
+      if filled + len(values) > Ndata:
+        raise RuntimeError('Grid points do not agree')
+      if parse:
+        data[filled:filled+len(values)] = values
+      filled += len(values)
+      if filled == Ndata:
+        break
+      nlines = min(self.chunk, -(-(Ndata - filled)//ncols))
+      lines = [f.readline() for i in range(nlines)]
+      if not lines[-1]:
+        raise RuntimeError('Grid points do not agree')
+    return data
+
+  def _skip_to_next_block(self, f):
+    """After a data block, reads the lines until the next grid line (a
+    new block), the beginning of the next frame or the end of the
+    file. The values before the augmentation occupancies (if any) are
+    counted.
+
+    Returns (next, extras), `next` is 'block', 'frame' or None (end of
+    file) (internal)"""
+    comment = self.comment.strip().encode()
+    NGF = [str(x).encode() for x in self.NGF]
+    extras = 0
+    augmentation = False
+    while True:
+      position = f.tell()
+      line = f.readline()
+      if not line:
+        return None, extras
+      tokens = line.split()
+      if tokens == NGF:
+        return 'block', extras
+      if line.strip() == comment:
+        f.seek(position)
+        return 'frame', extras
+      if b'augmentation' in line:
+        augmentation = True
+      if not augmentation:
+        extras += len(tokens)
+
+  def _skip_block(self, f, Ndata):
+    """Moves `f` after a data block of `Ndata` values, without parsing
+    it. The lines of a block usually have a fixed width, then the block
+    is skipped with a seek, checking its last line. Otherwise the
+    lines are read (internal)"""
+    start = f.tell()
+    first = f.readline()
+    ncols = len(first.split())
+    if ncols > 0:
+      nlines = -(-Ndata//ncols)
+      # values expected in the last line of the block
+      last_count = Ndata - (nlines - 1)*ncols
+      end = start + (nlines - 1)*len(first)
+      f.seek(end - 1)
+      if f.read(1) == b'\n':
+        last = f.readline()
+        if len(last.split()) == last_count and (last_count < ncols or
+                                                 len(last.rstrip()) == len(first.rstrip())):
+          return
+    if self.verbose == 'debug':
+      print('DEBUG: the lines of the block have different widths')
+    f.seek(start)
+    self._read_block(f, Ndata, parse=False)
+
+  def _read_frame(self, f, parse=True):
+    """Scans (or skips, if not `parse`) the frame starting at the
+    current position of `f`. The data blocks are not parsed, their byte
+    offsets are stored in `self.offsets`. Returns False if there are
+    no more frames (internal)"""
+    header = self._read_header(f)
+    if header is None:
+      return False
+    ngfx, ngfy, ngfz = self.NGF[0], self.NGF[1], self.NGF[2]
+    Ndata = ngfx*ngfy*ngfz
+    if parse:
+      # The poscar-like string would be passed to a POSCAR class
+      self.poscar = poscar.Poscar(filename=None)
+      self.poscar.parse(fromString=header)
+      if self.verbose == 'debug':
+        print('DEBUG: POSCAR-like info:')
+        print(''.join(self.poscar.poscar))
+        print('DEBUG: Data points expected:', Ndata)
+
+    # The first block is the spin-up
+    # The second block (if present) is the spin-down
+    # The 3th and 4th blocks are Sy, Sz (1s:rho, 2nd:Sx)
+    # The augmentation occupancies (if any) are discarded
+    offsets = []
+    if parse:
+      self.is_locpot = None
+    while True:
+      offsets.append(f.tell())
+      self._skip_block(f, Ndata)
+      following, extras = self._skip_to_next_block(f)
+      if extras != 0:
+        # If the grid points don't agree it could be a LOCPOT with residual data 
+        if len(offsets) == 1 and parse and extras == self.poscar.Ntotal:
+          self.is_locpot = True
+          if self.verbose == 'debug':
+            print('INFO: a LOCTOP file was detected')
+          if self.is_chg and self.is_locpot:
+            raise RuntimeError('The file is flagged as a CHGCAR-like file'
+                               ' and as a LOCPOT at the same time. This is inconsistent')
+        elif parse:
+          raise RuntimeError('Grid points do not agree')
+      if following != 'block':
+        break
+    if not parse:
+      return True
+
+    ndata = len(offsets) + 1
     if self.verbose:
       print('INFO: number of data blocks', ndata)
-    
-    # The first block is a POSCAR-like string
-    # The second block is the spin-up
-    # The third block (if present) is the spin-down
-    # The 4th and 5th blocks are Sy, Sz (1s:rho, 2nd:Sx)
     if ndata == 2:
       self.Ispin = 1
       print('\nA non-magnetic calculation detected\n')
@@ -106,94 +374,84 @@ class Chg_base:
     else:
       raise RuntimeError('Number of block data is unexpected,' + str(ndata))
 
-    # The poscar-like string would be passed to a POSCAR class
-    poscarString = self.comment + data.pop(0)
-    # print(poscarString)
-    self.poscar = poscar.Poscar(filename=None)
-    self.poscar.parse(fromString=poscarString)
-    if self.verbose == 'debug':
-      print('DEBUG: POSCAR-like info:')
-      print('\n'.join(self.poscar.poscar))
-    
-    # Now we will search for augmentation charges
-    # 'augmentation occupancies'
-    # That info will be discarded
-    temp = []
-    for block in data:
-      temp.append(re.split(r'augmentation occupancies', block)[0])
-    data = temp
-    
-    # The grid data will be processed
-    Ndata = self.NGF[0]*self.NGF[1]*self.NGF[2]
-    if self.verbose == 'debug':
-      print('DEBUG: Data points expected:', Ndata)
-      
-    self.Data0 = data[0].split()
-    ngfx, ngfy, ngfz = self.NGF[0], self.NGF[1], self.NGF[2]
-
-    # If the grid points don't agree it could be a LOCPOT with residual data 
-    if len(self.Data0) != Ndata:
-      N = self.poscar.Ntotal
-      if len(self.Data0) == Ndata + N:
-        self.is_locpot = True
-        self.Data0 = np.array(self.Data0[:-N], dtype=float).reshape(ngfz,ngfy,ngfx)
-        if self.verbose == 'debug':
-          print('INFO: a LOCTOP file was detected')
-        if self.is_chg and self.is_locpot:
-          if self.verbose == 'debug':
-            print('DEBUG: The number of grid points is not what I was expecting. '
-                  'The data I got is:')
-            print(self.Data0[:30])
-            print(self.Data0[-30:])
-          raise RuntimeError('The file is flagged as a CHGCAR-like file'
-                             ' and as a LOCPOT at the same time. This is inconsistent')
-      else:
-        raise RuntimeError('Grid points do not agree')
-    else:
-      self.Data0 = np.array(self.Data0, dtype=float).reshape(ngfz,ngfy,ngfx)
-
-    if self.is_chg:
-      self.Data0 = self.Data0 / Ndata
+    self.offsets = offsets
+    self._data = [None]*len(offsets) + [np.array([])]*(4 - len(offsets))
+    if self.is_chg and self.verbose:
+      print('Total charge', np.sum(self.Data0))
+    if self.is_chg and self.verbose and self.Ispin == 2:
+      print('INFO: total magnetization,', np.sum(self.Data1))
+    return True
+
+  def _block(self, index):
+    """The data block `index`, it is parsed on its first use (internal)"""
+    if self._data[index] is None:
       if self.verbose:
-        print('Total charge', np.sum(self.Data0))
-      
-    if self.Ispin > 1:
-      self.Data1 = data[1].split()
-      if len(self.Data1) != Ndata:
-        raise RuntimeError('Grid points do not agree')
-      self.Data1 = np.array(self.Data1, dtype=float).reshape(ngfz,ngfy,ngfx)
-      if self.is_chg:
-        self.Data1 = self.Data1 / Ndata
-        if self.verbose and self.Ispin == 2:
-          print('INFO: total magnetization,', np.sum(self.Data1))
-
-    if self.Ispin == 4:
-      self.Data2 = data[2].split()
-      self.Data3 = data[3].split()
-      if len(self.Data2) != Ndata or len(self.Data3) != Ndata:
-        raise RuntimeError('Grid points do not agree')
-      self.Data2 = np.array(self.Data2, dtype=float).reshape(ngfz,ngfy,ngfx)
-      self.Data3 = np.array(self.Data3, dtype=float).reshape(ngfz,ngfy,ngfx)
+        print('INFO: reading the data block', index)
+      ngfx, ngfy, ngfz = self.NGF[0], self.NGF[1], self.NGF[2]
+      Ndata = ngfx*ngfy*ngfz
+      with open(self.filename, 'rb') as f:
+        f.seek(self.offsets[index])
+        data = self._read_block(f, Ndata).reshape(ngfz,ngfy,ngfx)
       if self.is_chg:
-        self.Data2 = self.Data2 / Ndata
-        self.Data3 = self.Data3 / Ndata
+        data /= Ndata
+      self._data[index] = data
+    return self._data[index]
+
+  @property
+  def Data0(self):
+    return self._block(0)
+
+  @Data0.setter
+  def Data0(self, value):
+    self._data[0] = value
+
+  @property
+  def Data1(self):
+    return self._block(1)
+
+  @Data1.setter
+  def Data1(self, value):
+    self._data[1] = value
+
+  @property
+  def Data2(self):
+    return self._block(2)
+
+  @Data2.setter
+  def Data2(self, value):
+    self._data[2] = value
+
+  @property
+  def Data3(self):
+    return self._block(3)
+
+  @Data3.setter
+  def Data3(self, value):
+    self._data[3] = value
   
 
 class Chg:
-  def __init__(self, filename='CHG', is_chg=True, verbose=False):
+  def __init__(self, filename='CHG', is_chg=True, verbose=False, cache=False,
+               frame=0):
+    """`cache`: if True, the parsed grids are stored in (and later
+    loaded from) a binary cache next to the file, see cacheUtils
+
+    `frame`: the frame of a CHG file (0-based, -1 is the last one)"""
     self.chg = Chg_base()
     self.filename = filename
     self.is_chg = is_chg
     self.verbose = verbose
+    self.cache = cache
+    self.frame = frame
     self.chg.Load(filename=self.filename,
-                  frame=0,
+                  frame=self.frame,
                   is_chg=self.is_chg,
-                  verbose=self.verbose)
+                  verbose=self.verbose,
+                  cache=self.cache)
 
   def Zplot(self, level=None, spin=0, cart_level=None, direct_level=None):
     """it plots the CHG-like file at an specific z-value, given by
-    level. Only works properly when the Z-axis (c-vector) is perpendicular to the
-    other axes.
+    level. It is `CutPlot(axis='c')`.
 
     args:
 
@@ -209,89 +467,95 @@ class Chg:
     direct_level: as `level`, but the value is in direct coordinates.
 
     """
-    if (level and cart_level) or (level and direct_level) or (direct_level and cart_level):
+    return self.CutPlot(level=level, spin=spin, cart_level=cart_level,
+                        direct_level=direct_level, axis='c')
+
+  def _data(self, spin):
+    """The grid of the `spin` channel (internal)"""
+    if spin not in [0, 1, 2, 3]:
+      raise RuntimeError('No such spin channel, ' + str(spin))
+    return getattr(self.chg, 'Data' + str(spin))
+
+  def _direct_level(self, ax3, level=None, cart_level=None, direct_level=None):
+    """The position of a plane perpendicular to the axis `ax3`, in
+    direct coordinates. It is given by one among `level` (in grid
+    points), `cart_level` (the distance to the origin) or
+    `direct_level`. The default is the midpoint of the axis (internal)
+    
+    """
+    given = [x is not None for x in (level, cart_level, direct_level)]
+    if sum(given) > 1:
       raise RuntimeError('only one among `level`, `direct_level`, and'
                          ' `cart_level` has to be provided')
-    # setting the different kind of levels in order, `cart_level` sets
-    # `direct_level` and so on
-    if cart_level:
-      c = np.linalg.norm(self.chg.poscar.lat[2])
-      direct_level = cart_level/c
+    lat = self.chg.poscar.lat
+    if cart_level is not None:
+      # distance between the planes (ax1, ax2) at 0 and 1
+      normal = np.cross(lat[(ax3+1)%3], lat[(ax3+2)%3])
+      L = np.abs(np.linalg.det(lat))/np.linalg.norm(normal)
+      direct_level = cart_level/L
       if self.verbose:
         print('INFO: cart_level,', cart_level)
-    if direct_level:
-      # going to a grid level, crude interpolation of the level
-      level_float = direct_level*self.chg.NGF[2]
-      level_floor = math.floor(level_float)
-      level_ceil = math.ceil(level_float)
-      delta_floor = 1-np.abs(level_float - level_floor)
-      delta_ceil = 1-np.abs(level_ceil - level_float)
-      if level_floor == level_ceil:
-        delta_floor, delta_ceil = 1,0
-      if self.verbose == 'debug':
-        print('INFO: direct_level', direct_level)
-        #print('level_float', level_float)
-        #print('level_floor, level_floor', level_floor, level_floor)
-        #print('delta_floor,delta_ceil', delta_floor,delta_ceil)
-    if level:
-      # in this case the crude interpolation shouldn't do anything
-      level_floor = level
-      level_ceil = level
-      delta_floor, delta_ceil = 0,1
+    elif level is not None:
+      direct_level = level/self.chg.NGF[ax3]
       if self.verbose == 'debug':
         print('INFO: level', level)
-    if level is None and cart_level is None and direct_level is None:
-      level_floor = self.chg.NGF[2]/2
-      level_ceil = level_floor
-      delta_floor, delta_ceil = 0,1
+    elif direct_level is None:
+      direct_level = 0.5
       if self.verbose == 'debug':
-        print('INFO: default is the midpoint of the axis', level_floor)
-      
-    if spin == 0:
-      data = self.chg.Data0
-    elif spin == 1:
-      data = self.chg.Data1
-    elif spin == 2:
-      data = self.chg.Data2
-    elif spin == 3:
-      data = self.chg.Data3
-    else:
-      raise RuntimeError('No such spin channel, ' + str(spin))
-    
-    zcolor = data[level_floor]*delta_floor + data[level_ceil]*delta_ceil
-      
-    Agrid, Bgrid = np.mgrid[0:1:self.chg.NGF[0]*1j, 0:1:self.chg.NGF[1]*1j]
-    #cartesian value of each point of the grid
-    xgrid = Agrid*self.chg.poscar.lat[0,0] + Bgrid*self.chg.poscar.lat[1,0]
-    ygrid = Agrid*self.chg.poscar.lat[0,1] + Bgrid*self.chg.poscar.lat[1,1]
+        print('INFO: default is the midpoint of the axis')
+    if self.verbose:
+      print('INFO: direct_level', direct_level)
+    return direct_level
+
+  def _cut(self, data, ax3, direct_level, resolution=4):
+    """Interpolates the grid `data` on the plane at `direct_level` of
+    the axis `ax3`. The regular grid of the plot is taken to
+    fractional coordinates and the data is interpolated (linear) as a
+    periodic grid. `resolution` is the number of points of the plot
+    per grid point.
+
+    returns: xi, yi, zi. `xi`, `yi` are the cartesian coordinates
+    within the plane (the first axis of the plane is x), `zi` is NaN
+    outside the cell (internal)
+
+    """
+    lat = self.chg.poscar.lat
+    NGF = self.chg.NGF
+    ax1 = (ax3 + 1)%3
+    ax2 = (ax3 + 2)%3
+    # an orthonormal basis of the plane
+    e1 = lat[ax1]/np.linalg.norm(lat[ax1])
+    e2 = lat[ax2] - np.dot(lat[ax2], e1)*e1
+    e2 = e2/np.linalg.norm(e2)
+    # the two lattice vectors in the plane, in 2D
+    basis = np.array([[np.dot(lat[ax1], e1), 0.0],
+                      [np.dot(lat[ax2], e1), np.dot(lat[ax2], e2)]])
+    corners = np.array([[0, 0], [1, 0], [0, 1], [1, 1]]) @ basis
+    xmin, ymin = corners.min(axis=0)
+    xmax, ymax = corners.max(axis=0)
+    xi, yi = np.mgrid[xmin:xmax:NGF[ax1]*resolution*1j,
+                      ymin:ymax:NGF[ax2]*resolution*1j]
+    frac = np.stack((xi, yi), axis=-1) @ np.linalg.inv(basis)
+    # the grid point `i` is at i/NGF, and the axes of `data` are c, b, a
+    coords = np.empty((3,) + xi.shape)
+    coords[2-ax1] = frac[..., 0]*NGF[ax1]
+    coords[2-ax2] = frac[..., 1]*NGF[ax2]
+    coords[2-ax3] = direct_level*NGF[ax3]
+    zi = map_coordinates(data, coords, order=1, mode='grid-wrap')
+    outside = np.any((frac < -1e-8) | (frac > 1 + 1e-8), axis=-1)
+    zi[outside] = np.nan
     if self.verbose == 'debug':
-      print('DEBUG: Agrid.shape', Agrid.shape)
-      print('DEBUG: lattice\n', self.chg.poscar.lat)
-      print('DEBUG: xgrid.shape', xgrid.shape)
-
-    xmin, xmax = xgrid.min(), xgrid.max()
-    ymin, ymax = ygrid.min(), ygrid.max()
-    xi, yi = np.mgrid[xmin:xmax:self.chg.NGF[0]*4j, ymin:ymax:self.chg.NGF[1]*4j]
-    points = np.vstack((xgrid.flatten(), ygrid.flatten())).T
-    values = zcolor.flatten()
-    if self.verbose == 'debug':    
-      print('DEBUG: points.shape', points.shape)
-      print('DEBUG: values.shape', values.shape)
+      print('DEBUG: data.shape', data.shape)
+      print('DEBUG: lattice\n', lat)
       print('DEBUG: xi.shape', xi.shape)
       print('DEBUG: yi.shape', yi.shape)
-    zi = griddata(points, values, (xi, yi), method='linear')
-    
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-    p1= ax.pcolormesh(xi, yi, zi, cmap='seismic')
-    fig.colorbar(p1)
-    ax.set_aspect('equal')
-    return fig
+    return xi, yi, zi
 
   def CutPlot(self, level=None, spin=0, cart_level=None, direct_level=None, axis='c'):
     """it plots the CHG-like file at an specific value of `axis`, given by
-    `level`. Only works properly when the selected `axis` (basis vector) is perpendicular
-    to the other axes.
+    `level`. The plane is spanned by the other two basis vectors, its
+    cartesian coordinates start along the next basis vector (i.e. `a`
+    for axis='c').
 
     args:
 
@@ -302,7 +566,8 @@ class Chg:
     NGF in OUTCAR). Only one among `level`, `cart_level`, and
     `direct_level` should be provided.
 
-    cart_level: as `level`, but the value of z is in cartesian.
+    cart_level: as `level`, but the value is the cartesian distance
+    to the origin.
 
     direct_level: as `level`, but the value is in direct coordinates.
 
@@ -313,108 +578,13 @@ class Chg:
     ax_dict = {'a':0, 'b':1, 'c':2}
     # axis 3 is the axis to make the cut
     ax3 = ax_dict[axis]
-    ax1 = np.remainder(ax_dict[axis]+1, 3)
-    ax2 = np.remainder(ax_dict[axis]+2, 3)
     if self.verbose:
       print('INFO: Selected axis to cut:', ax3)
-    if self.verbose=='debug':
-      print('DEBUG: The other axes are:', ax1, ax2)
 
-    
-    if (level and cart_level) or (level and direct_level) or (direct_level and cart_level):
-      raise RuntimeError('only one among `level`, `direct_level`, and'
-                         ' `cart_level` has to be provided')
-    # setting the different kind of levels in order, `cart_level` sets
-    # `direct_level` and so on
-    if cart_level:
-      # length of the perpendicular vector
-      L = np.linalg.norm(self.chg.poscar.lat[ax3])
-      direct_level = cart_level/L
-      if self.verbose:
-        print('INFO: cart_level,', cart_level)
-    if direct_level:
-      # going to a grid level, crude interpolation of the level
-      level_float = direct_level*self.chg.NGF[ax3]
-      level_floor = math.floor(level_float)
-      level_ceil = math.ceil(level_float)
-      delta_floor = 1-np.abs(level_float - level_floor)
-      delta_ceil = 1-np.abs(level_ceil - level_float)
-      if level_floor == level_ceil:
-        delta_floor, delta_ceil = 1,0
-      if self.verbose:
-        print('INFO: direct_level', direct_level)
-        # print('level_float', level_float)
-        # print('level_floor, level_floor', level_floor, level_floor)
-        # print('delta_floor,delta_ceil', delta_floor,delta_ceil)
-    if level:
-      # in this case the crude interpolation shouldn't do anything
-      level_floor = level
-      level_ceil = level
-      delta_floor, delta_ceil = 0,1
-      if self.verbose == 'debug':
-        print('INFO: level', level)
-
-    if level is None and cart_level is None and direct_level is None:
-      level_floor = self.chg.NGF[ax3]/2
-      level_ceil = level_floor
-      delta_floor, delta_ceil = 0,1
-      if self.verbose == 'debug':
-        print('INFO: default is the midpoint of the axis', level_floor)
-
-    if spin == 0:
-      data = self.chg.Data0
-    elif spin == 1:
-      data = self.chg.Data1
-    elif spin == 2:
-      data = self.chg.Data2
-    elif spin == 3:
-      data = self.chg.Data3
-    else:
-      raise RuntimeError('No such spin channel, ' + str(spin))
-
-    # building a grid with existent points
-    if axis == 'c':
-      zcolor = data[level_floor]*delta_floor + data[level_ceil]*delta_ceil
-      # a regular orthogonal grid
-      Agrid, Bgrid = np.mgrid[0:1:self.chg.NGF[0]*1j, 0:1:self.chg.NGF[1]*1j]
-      # cartesian grid
-      xgrid = Agrid*self.chg.poscar.lat[0,0] + Bgrid*self.chg.poscar.lat[1,0]
-      ygrid = Agrid*self.chg.poscar.lat[0,1] + Bgrid*self.chg.poscar.lat[1,1]
-  
-    elif axis == 'b':
-      zcolor = data[:,level_floor,:]*delta_floor + data[:,level_ceil,:]*delta_ceil
-      Agrid, Bgrid = np.mgrid[0:1:self.chg.NGF[2]*1j, 0:1:self.chg.NGF[0]*1j]
-      xgrid = Agrid*self.chg.poscar.lat[2,2] + Bgrid*self.chg.poscar.lat[0,2]
-      ygrid = Agrid*self.chg.poscar.lat[2,0] + Bgrid*self.chg.poscar.lat[0,0]
-
-    elif axis == 'a':
-      zcolor = data[:,:,level_floor]*delta_floor + data[:,:,level_ceil]*delta_ceil
-      Agrid, Bgrid = np.mgrid[0:1:self.chg.NGF[1]*1j, 0:1:self.chg.NGF[2]*1j]
-      # xgrid = Agrid*self.chg.poscar.lat[1,1] + Bgrid*self.chg.poscar.lat[1,2]
-      # ygrid = Agrid*self.chg.poscar.lat[2,1] + Bgrid*self.chg.poscar.lat[2,2]
-      xgrid = Agrid*self.chg.poscar.lat[1,1] 
-      ygrid = Bgrid*self.chg.poscar.lat[2,2] + Agrid*self.chg.poscar.lat[1,0]
-
-    if self.verbose == 'debug':
-      print('DEBUG: zcolor.shape', zcolor.shape)
-      print('DEBUG: Agrid.shape', Agrid.shape)
-      print('DEBUG: Bgrid.shape', Bgrid.shape)
-      print('DEBUG: lattice\n', self.chg.poscar.lat)
-      print('DEBUG: xgrid.shape', xgrid.shape)
-      print('DEBUG: ygrid.shape', xgrid.shape)
-    
-    xmin, xmax = xgrid.min(), xgrid.max()
-    ymin, ymax = ygrid.min(), ygrid.max()
-    # creating a regular grid to interpolate (the `4` is the resolution)
-    xi, yi = np.mgrid[xmin:xmax:self.chg.NGF[ax1]*4j, ymin:ymax:self.chg.NGF[ax2]*4j]
-    points = np.vstack((xgrid.flatten(), ygrid.flatten())).T
-    values = zcolor.flatten()
-    if self.verbose == 'debug':
-      print('points.shape', points.shape)
-      print('values.shape', values.shape)
-      print('xi.shape', xi.shape)
-      print('yi.shape', yi.shape)
-    zi = griddata(points, values, (xi, yi), method='linear')
+    direct_level = self._direct_level(ax3, level=level, cart_level=cart_level,
+                                      direct_level=direct_level)
+    data = self._data(spin)
+    xi, yi, zi = self._cut(data, ax3, direct_level)
     
     fig = plt.figure()
     ax = fig.add_subplot(111)
@@ -471,6 +641,10 @@ if __name__ == "__main__":
   parser.add_argument('-a', '--axis', choices=['a','b','c'], default='c',
                       help='Axis to cut')
   parser.add_argument('-z', action='store_true', help='Fallback utility function to plot')
+  parser.add_argument('--cache', action='store_true', help='use a binary cache'
+                      ' of the grids, see cacheUtils')
+  parser.add_argument('-f', '--frame', type=int, default=0,
+                      help='frame of a CHG file (0-based, -1 is the last one)')
 
   parser.add_argument('--new', action='store_true', help='usage of new, not fully'
                       ' tested methods')
@@ -501,7 +675,8 @@ if __name__ == "__main__":
   is_chg = not args.no_scale
       
   
-  chg = Chg(filename=args.inputfile, is_chg=is_chg, verbose=args.verbose)
+  chg = Chg(filename=args.inputfile, is_chg=is_chg, verbose=args.verbose,
+            cache=args.cache, frame=args.frame)
 
   
   
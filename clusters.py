@@ -51,37 +51,9 @@ class Clusters:
     "marked" atoms
 
     """
-    # I will start assuming every atom has its own cluster, the
-    # interaction will join the sets
-    clusters = [set([i]) for i in self.marked]
-    nn_list = self.neighbors.nn_list
-
-    # In the main iteration I will modify the contents of `clusters`,
-    # then I need to loop over another, immutable object.
-    
-    # which atoms are connected to atom 0
-    for atom in self.marked:
-      # I need to search for all the pairs of interacctions
-      neighbors = nn_list[atom]
-      for neighbor in neighbors:
-        # print(atom, neighbor)
-        # finding the clusters with 'atom' and 'neighbor', removing
-        # them and then appending its union.
-        # The las term in the if is to avoid checking: 1<->2, 2<->1
-        if neighbor in self.marked and neighbor < atom:
-          for c in clusters:
-            if atom in c:
-              c1 = c
-            if neighbor in c:
-              c2 = c
-          # I am going to append `c1` (perhaps united to `c2`) to
-          # `clusters` later
-          clusters.remove(c1)
-          if c1 != c2:
-            clusters.remove(c2)
-          clusters.append(c1.union(c2))
-          # print(atom, neighbor, clusters)
-    self.clusters = [list(x) for x in clusters]
+    # the clusters are the connected components of the graph of
+    # nearest neighbors, restricted to the marked atoms
+    self.clusters = self.neighbors.neighbor_list.clusters(self.marked)
     if self.verbose:
       print('clusters.Clusters.find_clusters(), clusters:', self.clusters)
     # self._set_nn_clusters()
@@ -97,9 +69,11 @@ class Clusters:
     for i in range(n):
       if self.verbose:
         print('clusters.Clusters.extend_clusters()... Iteration', i)
+      # the atoms are added atom by atom, to keep the order of the
+      # set (and of the H atoms added later) reproducible
+      nl = self.neighbors.neighbor_list
       for atom in list(self.marked):
-        for neighbor in self.neighbors.nn_list[atom]:
-          self.marked.add(neighbor)
+        self.marked.update(nl.indices[nl.indptr[atom]:nl.indptr[atom+1]].tolist())
       self.find_clusters()
       if self.verbose:
         print('clusters.Clusters.extend_clusters()... clusters:', self.clusters)
@@ -135,30 +109,26 @@ class Clusters:
     to clustering
 
     """
-    nn_list = self.neighbors.nn_list
-    # not removing while iteration
-    to_unmark = []
     if self.verbose:
       print('clusters.Cluster.smooth_edges(): ... looking for undercoordinate edges')
-    for i in self.marked:
-      # I need to count how many neighbors are marked
-      nn = set(nn_list[i])
-      cluster_coord = len(nn & self.marked)
-      if ignoreH is True and self.p.elm[i] == 'H':
-        cutoff = 1
-      else:
-        cutoff = coordination
-        
-      if cluster_coord <= cutoff:
-        to_unmark.append(i)
-        if self.verbose:
-          print('atom', i,nn, '. cluster coordination',cluster_coord)
+    marked = np.array(list(self.marked), dtype=int)
+    # I need to count how many neighbors are marked
+    cluster_coord = self.neighbors.neighbor_list.coordination(self.marked)[marked]
+    cutoff = np.full(len(marked), coordination)
+    if ignoreH is True:
+      cutoff[np.array(self.p.elm)[marked] == 'H'] = 1
+    to_unmark = marked[cluster_coord <= cutoff].tolist()
+    if self.verbose:
+      for i, coord in zip(marked, cluster_coord):
+        if i in to_unmark:
+          print('atom', i, '. cluster coordination', coord)
     # The atoms marked as "defects" should not be unmarked, it would
     # change the physics
     if self.verbose:
       print('undercoordinate atoms:', to_unmark)
+    to_unmark = set(to_unmark)
     if preserve_original:
-      to_unmark = set(to_unmark) - self.initial_marked
+      to_unmark = to_unmark - self.initial_marked
     if self.verbose:
       print('excluding the initial set of marked atoms,')
       print('undercoordinate atoms:', to_unmark)
@@ -189,7 +159,8 @@ class Clusters:
     marked = list(self.marked)
     # the nearest neighbors need to be converted to sets. Only for
     # marked atoms.
-    nn_set = [set(self.neighbors.nn_list[atom]) for atom in marked]
+    nl = self.neighbors.neighbor_list
+    nn_set = [set(nl.indices[nl.indptr[atom]:nl.indptr[atom+1]].tolist()) for atom in marked]
     if self.verbose:
       print('marked atoms and their neigbors')
       print(list(zip(marked, nn_set)))
@@ -212,51 +183,15 @@ class Clusters:
         missing_used.append(ma)
         # It might happen that the neigbor atom belongs to a different
         # lattice (i.e. [0,0,0.1] and [0,0,0.9]) the H atom should be
-        # at [0,0,0.1-delta], not in [0,0,0.1+delta]. Notice, it is
-        # not necessary to compare all the 3*3*3 possibilities to get
-        # the smallest distance. If the value of any coordinate,
-        # |pos1_i-pos2_i|< 1/2, it is in the rigth cell. This is
-        # because we are working in a large supercell and the error
-        # for wrong PBCs is large too.
-        #
-        # We will start working in direct cordinates, to get the
-        # correct lattice vectors shift. Afterwards, we will add the H
-        # atom in cartesian
-        p0 = self.p.dpos[atom]
-        p1 = self.p.dpos[ma]
-        # print('atom', atom, 'missing', ma, 'p0', p0, 'p1', p1)
-        # delta is the vector to put the H atom
-        delta = p1-p0
-        shift = np.array([0,0,0])
-        # shifted = False
-        for i in [0,1,2]:
-          if delta[i] > 0.5:
-            shifted = True
-            shift[i] = -1
-          elif delta[i] < -0.5:
-            shifted = True
-            shift[i] =  1
-        # if shifted:
-        #   print('delta (rec)', delta)
-        #   print('shift direct',shift)
-        # Now that we have the rigth lattice shift, we will aply it to
-        # the cartesian positions.
-        # following the previous example:
-        # p1 = [0,0,.9]
-        # p0 = [0,0,.1]
-        # p1-p0 = [0,0,.8] -> delta
-        # shift = [0,0,-1]
-        # p1-p0-shift = [0,0,-.2]
-        # now doing the same in cartesian
+        # at [0,0,0.1-delta], not in [0,0,0.1+delta]. The lattice
+        # shift of the neighbor `ma` is stored in the list of
+        # neighbors (its closest image)
+        row = slice(nl.indptr[atom], nl.indptr[atom+1])
+        shift = nl.shifts[row][nl.indices[row] == ma][0]
         p0 = self.p.cpos[atom]
-        p1 = self.p.cpos[ma]
-        shift = np.dot(shift, self.p.lat)
-        delta = p1 - p0 + shift
-        # if shifted:
-        #   print('shift cart', shift)
-        #   print('p1', p1)
-        #   print('p0', p0)
-        #   print('p1-p0+shift', delta)
+        p1 = self.p.cpos[ma] + np.dot(shift, self.p.lat)
+        # delta is the vector to put the H atom
+        delta = p1 - p0
         # normalizing the direction delta:
         delta = delta/np.linalg.norm(delta)
         # bond_length
@@ -284,7 +219,7 @@ class Clusters:
     to_remove = list(to_remove - self.marked)
     pu.remove(to_remove)
     #adding the new H atoms
-    [pu.add('H', x) for x in new_H_atoms]
+    pu.add_many('H', new_H_atoms)
     if filename:
       pu.write(filename)
     return pu.p
@@ -26,7 +26,13 @@ import matplotlib.pyplot as plt
 class FindDefect:
   """Tries to identify a defect
   """
-  def __init__(self, poscar, verbose=False):
+  def __init__(self, poscar, verbose=False, cell_list=False, workers=None):
+    """`cell_list`: the neighbors are found with a cell list, see
+    latticeUtils.Neighbors. Recommended for large cells
+
+    `workers`: number of threads to find the neighbors
+
+    """
     # avoiding to modify the original poscar
     self.p = copy.deepcopy(poscar)
     self.verbose = verbose
@@ -34,7 +40,8 @@ class FindDefect:
                       # should be here. It is a dictionary of lists
     self.all_defects = [] # a simple list with all the defects found
     self.nn_elem = [] #a descriptive list of all nearest neighbors clusters
-    self.neighbors = latticeUtils.Neighbors(self.p, verbose=False)
+    self.neighbors = latticeUtils.Neighbors(self.p, verbose=False, cell_list=cell_list,
+                                            workers=workers)
     self.find_forgein_atoms()
     self.nearest_neighbors_environment()
 
@@ -233,10 +240,7 @@ class FindDefect:
     for (natoms, element) in zip(self.p.numberSp, self.p.typeSp):
       if natoms <= lower_min:
         defect_elements.append(element)
-    defects = []
-    for i in range(len(self.p.elm)):
-      if self.p.elm[i] in defect_elements:
-        defects.append(i)
+    defects = np.nonzero(np.isin(np.array(self.p.elm), defect_elements))[0].tolist()
 
     if self.verbose:
       print('list of defects: ')
@@ -257,25 +261,38 @@ class FindDefect:
 
     """
     # self.verbose = True
-    nn_elem = self.neighbors.nn_elem
-    # Building a single string with the environment, it needs to be
-    # sorted, for taking statistics
-    nn_elem = [''.join(sorted(x)) for x in nn_elem]
+    nl = self.neighbors.neighbor_list
+    # The environment of each atom is the number of neighbors of each
+    # species, a (Natoms x Nspecies) matrix
+    typeSp = list(self.p.typeSp)
+    nsp = len(typeSp)
+    species = self.p.indexSp
+    environment = np.bincount(nl.rows()*nsp + species[nl.indices],
+                              minlength=self.p.Ntotal*nsp)
+    environment = environment.reshape(self.p.Ntotal, nsp)
     
     # Assume in hBN a B->N defect, its environment is NNN, which seems
     # fine, but for a B atom, not when surrounding a N. This means
     # that the atom at which its environment is being proccesed also
     # matters. And it can be distinguihed from its environment (no
     # sorting)
-    
+    environment = np.column_stack((species, environment))
+    keys, inverse, counts = np.unique(environment, axis=0, return_inverse=True,
+                                      return_counts=True)
+    # Building a single string with each (unique) environment, the
+    # neighbors need to be sorted, for taking statistics
+    alphabetic = np.argsort(typeSp, kind='stable')
+    keys = [typeSp[x[0]] + ''.join([typeSp[k]*x[1+k] for k in alphabetic]) for x in keys]
     
     #I need to save this as a class var
     #For cluster comparison
-    nn_elem = [x[0]+x[1] for x in zip(self.p.elm, nn_elem)]
+    nn_elem = [keys[x] for x in inverse.flatten()]
     self.nn_elem = nn_elem
     # counting the frequency of unique elements
     from collections import Counter
-    uniques = Counter(nn_elem)
+    uniques = Counter()
+    for key, count in zip(keys, counts.tolist()):
+      uniques[key] += count
     if self.verbose:
       print('\nFindDefect.nearest_neighbors_environment()')
       print('Atomic environments and their frequency:')
@@ -2,6 +2,7 @@
 
 import numpy as np
 from poscar import Poscar
+import latticeUtils
 
 np.set_printoptions(precision=4, linewidth=160, suppress=True)
 
@@ -10,7 +11,8 @@ class Neighbors:
     """ poscar can be the filename or a Poscar file, already parsed"""
     self.verbose = verbose
     self.p = None # a poscar-object
-    self.nn_list = None
+    self.neighbor_list = None # a latticeUtils.NeighborList
+    self._nn_list = None # the same, as a list of lists (see `nn_list`)
     self.distances = None
     self.clusters = None # a list of clusters, each cluster has a list with its atoms
     self.nn_dict_clusters = None # a list of dict with the nearest
@@ -36,77 +38,63 @@ respective set of `parameters`. Currently supported:
    parameters = {'max_dis':1.5,     # maximum distance in Angstroms. No default
                  'allow_self:True'} # can an atom be its own neighbor? Default: False
 
+2) method='cell_list' the same as 'distance', with the same
+   `parameters`, but the distance matrix is not calculated (see
+   latticeUtils.neighbor_pairs). `self.distances` is None.
+
     """
     # checking whether  the method exists and has the rigth parameters
-    if method == 'distance':
-      try:
-        dCutoff = parameters['max_dis']
-      except KeyError:
-        raise RuntimeError('the parameter argument doesnt have the key `max_dis`')
-      
-      d = distances(self.p.cpos, lattice=self.p.lat)
+    if method not in ['distance', 'cell_list']:
+      raise RuntimeError('set_neighbors() does not support the method ' + str(method))
+    try:
+      dCutoff = parameters['max_dis']
+    except KeyError:
+      raise RuntimeError('the parameter argument doesnt have the key `max_dis`')
+    allow_self = parameters.get('allow_self', False) is True
+    N = self.p.Ntotal
+    self._nn_list = None
+
+    if method == 'cell_list':
+      i, j, d, shift = latticeUtils.neighbor_pairs(self.p.cpos, lattice=self.p.lat,
+                                                   cutoff=dCutoff, allow_self=allow_self)
+      # only one entry by neighbor, regardless of its image
+      self.neighbor_list = latticeUtils.NeighborList(N, i, j, d, shift).unique()
+      self.distances = None
+    elif method == 'distance':
+      d = latticeUtils.distances(self.p.cpos, lattice=self.p.lat)
       self.distances = d
       if self.verbose:
         print('distances:')
         print(d)
-      N = len(d)
-      # setting an empty list to contain the list of neighbors
-      self.nn_list = []
-      for i in range(N):
-        temp = []
-        # is j a neighbor of i?
-        for j in range(N):
-          if d[i,j] <  dCutoff:
-            # print(i,j)
-            # if they are different atoms, always accept
-            if i!=j:
-              temp.append(j)
-            # if allow_self is True, also accept (False by default)
-            elif parameters.get('allow_self', False) is True:
-              temp.append(j)
-            # otherwise, not a neighbor
-        #print('loop over j done, neighbors found:', temp)
-        self.nn_list.append(temp)
+      # is j a neighbor of i?
+      i, j = np.nonzero(d < dCutoff)
+      # an atom can be its own neighbor only if allow_self is True
+      # (False by default)
+      if not allow_self:
+        i, j = i[i != j], j[i != j]
+      dist, shift = latticeUtils.pair_distances(self.p.cpos, self.p.lat, i, j)
+      self.neighbor_list = latticeUtils.NeighborList(N, i, j, d[i,j], shift)
         
-      if self.verbose:
-        print('list of first neighbors:')
-        print(self.nn_list)
-    else:
-      raise RuntimeError('set_neighbors() does not support the method ' + str(method))
+    if self.verbose:
+      print('list of first neighbors:')
+      print(self.nn_list)
     return
 
+  @property
+  def nn_list(self):
+    """list of N lists with the neighbors of each atom, built from
+    `self.neighbor_list` the first time is needed"""
+    if self._nn_list is None and self.neighbor_list is not None:
+      self._nn_list = self.neighbor_list.to_list()
+    return self._nn_list
+
   def find_clusters(self):
-    N = len(self.nn_list)
     if self.verbose:
-      print(N, 'atoms')
-    # I will start assuming every atom has its own cluster, the
-    # interaction will join the sets
-    clusters = [set([i]) for i in range(N)]
-    nn_list = self.nn_list
-    
-    # which atoms are connected to atom 0
-    for atom in range(N):
-      # I need to search for all the pairs of interacctions
-      neighbors = nn_list[atom]
-      for neighbor in neighbors:
-        # print(atom, neighbor)
-        # finding the clusters with 'atom' and 'neighbor', removing
-        # them and then appending its union
-        for c in clusters:
-          if atom in c:
-            c1 = c
-          if neighbor in c:
-            c2 = c
-        clusters.remove(c1)
-        # maybe c1 and c2 are the same (both atoms are already in the
-        # same cluster)
-        if c2 in clusters:
-          clusters.remove(c2)
-        clusters.append( c1.union(c2) )
-        # print(clusters)
-    self.clusters = [list(x) for x in clusters]
+      print(self.neighbor_list.N, 'atoms')
+    # the clusters are the connected groups of atoms
+    self.clusters = self.neighbor_list.clusters()
     if self.verbose:
-      print('clusters:', clusters)
+      print('clusters:', self.clusters)
     self._set_nn_clusters()
     return
 
@@ -136,6 +124,7 @@ class Graphene:
     self.p.parse()
     self.nn_list = None  # a lsit with the nearest neighbors, just by
                          # distance, ignoring any bonding scheme.
+    self.neighbor_list = None # the same, a latticeUtils.NeighborList
     self.neighbors = None # a `Neighbors class`
     self.clusters = None # a list disjoint group of atoms
     self.sublattices = None # [dict('A':[...], 'B':[...])] one dict
@@ -156,6 +145,7 @@ class Graphene:
     # getting the nearest neighbors
     n = Neighbors(self.p, verbose=False)
     n.set_neighbors(method='distance', parameters={'max_dis':1.6})
+    self.neighbor_list = n.neighbor_list
     self.nn_list = n.nn_list
     # if there are N layers of graphene, we need to treat them separately
     n.find_clusters()
@@ -201,22 +191,20 @@ class Graphene:
 
   def find_edges(self, ignoreH=True):
     self.edges = []
+    nl = self.neighbor_list
+    isH = np.array(self.p.elm) == 'H'
+    # an edge is a C atom with less than 3 nearest neighbors, or an H
+    # atom next to a C atom with coor
+    if ignoreH:
+      # ignoring the H atoms, and the H neighbors
+      rows = nl.rows()
+      counter = np.bincount(rows[~isH[nl.indices]], minlength=self.p.Ntotal)
+      is_edge = (counter < 3) & ~isH
+    else:
+      is_edge = nl.coordination() < 3
     for icluster in range(len(self.clusters)):
       cluster = self.clusters[icluster]
-      # an edge is a C atom with less than 3 nearest neighbors, or an H
-      # atom next to a C atom with coor
-      edge = [] 
-      for i in range(self.p.Ntotal):
-        if ignoreH and self.p.elm[i] == 'H':
-          pass # ignoring an H atom
-        else:
-          neighbors = self.nn_list[i]
-          counter = 0
-          for neighbor in neighbors:
-            if self.p.elm[neighbor] != 'H' or ignoreH == False:
-              counter += 1
-        if counter < 3:
-          edge.append(i)
+      edge = [i for i in cluster if is_edge[i]]
       if self.verbose:
         print('edge:', edge)
       self.edges.append(edge)
@@ -235,27 +223,14 @@ class Graphene:
           if len(neighbors) == 2:
             # I need the positions of the shortest distance within the
             # PBC
-            n1, n2 = neighbors[0], neighbors[1]
+            nl = self.neighbor_list
+            row = slice(nl.indptr[iatom], nl.indptr[iatom+1])
             # these are the distances within the PBC
-            d1 = self.neighbors.distances[iatom, n1]
-            d2 = self.neighbors.distances[iatom, n2]
+            d1, d2 = nl.distances[row]
             print('d1', d1, 'd2', d2)
             p0 = self.p.cpos[iatom]
-            lat = self.p.lat
-            # getting all the periodic disatances, if one of them
-            # fits, I will store it
-            for i in [-1, 0, 1]:
-              for j in [-1, 0, 1]:
-                for k in [-1, 0, 1]:
-                  temp_p1 = self.p.cpos[n1] + i*lat[0] + j*lat[1] + k*lat[2]
-                  temp_p2 = self.p.cpos[n2] + i*lat[0] + j*lat[1] + k*lat[2]
-                  # if it match with the minimum distance, store it
-                  if np.abs(np.linalg.norm(p0 - temp_p1) - d1) < 0.01:
-                    p1 = temp_p1
-                    #print('1:[',i,j,k,']', end=' ')
-                  if np.abs(np.linalg.norm(p0 - temp_p2) - d2) < 0.01:
-                    p2 = temp_p2
-                    #print('2:[',i,j,k,']',end=' ')
+            # the closest image of each neighbor
+            p1, p2 = self.p.cpos[nl.indices[row]] + np.dot(nl.shifts[row], self.p.lat)
             # Now I have the Cartesian position of each neighbor, within the PBC
             r1, r2  = p0 - p1, p0 - p2
             # I only need the angle, normalizing
@@ -267,8 +242,7 @@ class Graphene:
 
     # I need to add all the newHatoms to poscar
     print(newHatoms)
-    for newH in newHatoms:
-      self.p.add(newH, element='H', direct=False)
+    self.p.add_many(newHatoms, elements='H', direct=False)
     # writing the data to file
     self.p.write(outFile, direct=False)
   def sublattice_polarization(self):
@@ -285,18 +259,11 @@ class Graphene:
     spd = (spd.T/spd[:,-1]).T # all bands, just sum of all atoms
     print(spd.shape)
     
-    nn_list = self.nn_list
-    print('nearest neighbors',nn_list)
-    # an empty array
-    overlap = 0*spd[:,0]
-    counter = 0
-    for atom in range(len(nn_list)):
-      for neighbor in nn_list[atom]:
-        # print('\natom', spd[:,atom])
-        # print('neighbor', spd[:,neighbor])
-        overlap += spd[:,atom]*spd[:,neighbor]
-        # print(overlap)
-        counter += 1
+    nl = self.neighbor_list
+    print('nearest neighbors',self.nn_list)
+    # summing over all the pairs of neighbors
+    overlap = np.sum(spd[:,nl.rows()]*spd[:,nl.indices], axis=1)
+    counter = len(nl.indices)
           
     import matplotlib.pyplot as plt
     x = np.arange(len(overlap)) + 1
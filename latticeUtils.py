@@ -1,19 +1,44 @@
 """General lattice related utilities.
 
--distances(positions, lattice=None, verbose=False):
- calculates the PBC-aware distances among all positions.
+-distances(positions, lattice=None, allow_self=True, verbose=False, max_bytes=None, out=None, workers=None):
+ calculates the PBC-aware distances among all positions. With
+ `max_bytes` it works by blocks of rows, `out` can be a float32 array
+ or a np.memmap. The blocks can be calculated by `workers` threads.
+
+-distance_blocks(positions, lattice=None, allow_self=True, max_bytes=None, verbose=False, workers=None):
+ the same distances, by blocks of rows (a generator).
+
+-neighbor_pairs(positions, lattice=None, cutoff=3.0, allow_self=True, verbose=False, workers=None):
+ finds the pairs of atoms closer than `cutoff` with a cell list, without
+ building the NxN distance matrix.
+
+-pair_distances(positions, lattice, i, j):
+ PBC-aware distances only between the pairs of atoms i[k], j[k]
+
+-reduce_lattice(lattice, delta=0.75):
+ LLL-reduced lattice, the minimum-image distances are calculated on it
+
+-image_candidates(lattice):
+ the few lattice shifts needed besides wrapping direct coordinates
+
+-shortest_vector(lattice):
+ the distance of an atom to its nearest self-image
 
 
 add RDF here
 
 """
+import collections
+import concurrent.futures
+import itertools
 import numpy as np
 import db
 import rdf
 np.set_printoptions(precision=4, linewidth=160, suppress=True)
 
 
-def distances(positions, lattice=None, allow_self=True, verbose=False):
+def distances(positions, lattice=None, allow_self=True, verbose=False,
+              max_bytes=None, out=None, workers=None):
   """Calculates all the pasirwise distances. The `positions` have to be
   in cartesian coordinates, size Nx3. The lattice should be a 3x3
   array-like.
@@ -21,90 +46,484 @@ def distances(positions, lattice=None, allow_self=True, verbose=False):
   `allow_self`: it allows to an atom to be its own neighbor, in
   another lattice
 
-  return: a NxN array with distances.
+  `max_bytes`: if given, the matrix is calculated by blocks of rows,
+  the temporary arrays of each block use roughly `max_bytes`
+
+  `out`: a preallocated NxN array to store the result (i.e. a float32
+  array or a np.memmap), useful together with `max_bytes` for large
+  cells.
+
+  `workers`: number of threads, each one calculating a block of rows
+
+  return: a NxN array with distances (`out` if given).
 
   """ 
-  
-  # I will calculate the whole distance matrix, first I need to expand
-  # the arrays by replicating the data
-  
-  pbc_list = []
+  N = len(positions)
+  if out is None:
+    out = np.empty((N, N))
+  elif out.shape != (N, N):
+    raise RuntimeError('latticeUtils.distances: `out` has shape ' +
+                       str(out.shape) + ', expected ' + str((N, N)))
+  for start, end, block in distance_blocks(positions, lattice=lattice,
+                                           allow_self=allow_self,
+                                           max_bytes=max_bytes,
+                                           verbose=verbose,
+                                           workers=workers):
+    out[start:end] = block
+    
+  if verbose:
+    print('distances')
+    print(out, out.max())
+  return out
+
+def distance_blocks(positions, lattice=None, allow_self=True, max_bytes=None,
+                    verbose=False, workers=None):
+  """Generator with the rows of the distance matrix (see `distances`),
+  by blocks of rows. Only a block is kept in memory.
+
+  `max_bytes`: approximated memory used by the temporary arrays of a
+  block. If None, the whole matrix is a single block.
+
+  `workers`: number of threads calculating blocks concurrently (up to
+  `workers` blocks are kept in memory). The positions are shared by
+  the threads, not copied.
+
+  yields: (start, end, block), with block = distances[start:end]
+
+  """
+  positions = np.asarray(positions, dtype=float)
+  N = len(positions)
   if lattice is not None:
-    for i in [-1, 0, 1]:
-      for j in [-1, 0, 1]:
-        for k in [-1, 0, 1]:
-          pbc_list.append(i*lattice[0] + j*lattice[1] + k*lattice[2])
+    # direct coordinates respect to the reduced lattice, any
+    # difference is wrapped to [-1/2, 1/2] in a single pass, only a
+    # few extra images are needed for skewed cells
+    reduced, T = reduce_lattice(lattice)
+    direct = np.dot(positions, np.linalg.inv(reduced))
+    images = np.dot(image_candidates(reduced), reduced)
+    shortest, image = shortest_vector(reduced)
+    if verbose:
+      print('reduced lattice:')
+      print(reduced)
+      print('extra images:', len(images))
+    
+  # each row of a block needs a few Nx3 arrays (the differences, its
+  # cartesian values and squares) and a pair of N arrays, all float64
+  if max_bytes is None:
+    size = N
+    if workers is not None and workers > 1:
+      # a few blocks per worker
+      size = int(np.ceil(N/(4*workers)))
   else:
-    pbc_list = [np.array([0,0,0])]
-  pbc_list = np.array(pbc_list)
+    size = int(max_bytes // (8*12*N))
+  size = min(max(size, 1), N)
   if verbose:
-    print('PBC lists:')
-    print(pbc_list)
-    
+    print('rows per block:', size)
+
+  def block(start):
+    end = min(start + size, N)
+    if lattice is None:
+      vectors = positions[None, :, :] - positions[start:end, None, :]
+      return start, end, np.linalg.norm(vectors, axis=2)
+    # rows have the position in the central cell, columns have
+    # position on the nearest image
+    vectors = direct[None, :, :] - direct[start:end, None, :]
+    vectors -= np.rint(vectors)
+    vectors = np.dot(vectors, reduced)
+    dist = np.sum(vectors**2, axis=2)
+    for image in images:
+      # np.minimum is element-wise
+      np.minimum(dist, np.sum((vectors + image)**2, axis=2), out=dist)
+    dist = np.sqrt(dist)
+    # now we are looking for the self-distances in another cell
+    if allow_self:
+      diagonal = np.arange(end - start), np.arange(start, end)
+      dist[diagonal] = shortest
+    return start, end, dist
+
+  starts = range(0, N, size)
+  if workers is None or workers < 2:
+    for start in starts:
+      yield block(start)
+    return
+  # the blocks are calculated by a pool of threads (sharing the
+  # positions), never more than `workers` blocks are in memory
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+    pending = collections.deque()
+    for start in starts:
+      pending.append(pool.submit(block, start))
+      if len(pending) == workers:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+def reduce_lattice(lattice, delta=0.75):
+  """LLL-reduction of the `lattice` (3x3, one vector per row). The
+  reduced vectors are short and nearly orthogonal, and they generate
+  the same lattice.
+
+  return: (reduced, T), with reduced = T.lattice and T an integer
+  (unimodular) 3x3 array.
+
+  """
+  lattice = np.array(lattice, dtype=float)
+  T = np.eye(3, dtype=int)
+  
+  def gram_schmidt(B):
+    Bs = np.zeros((3,3))
+    mu = np.zeros((3,3))
+    for i in range(3):
+      Bs[i] = B[i]
+      for j in range(i):
+        mu[i,j] = np.dot(B[i], Bs[j])/np.dot(Bs[j], Bs[j])
+        Bs[i] = Bs[i] - mu[i,j]*Bs[j]
+    return Bs, mu
+
+  B = lattice.copy()
+  k = 1
+  while k < 3:
+    # size reduction of the vector `k`
+    for j in range(k-1, -1, -1):
+      Bs, mu = gram_schmidt(B)
+      q = int(np.rint(mu[k,j]))
+      if q != 0:
+        B[k] = B[k] - q*B[j]
+        T[k] = T[k] - q*T[j]
+    # Lovasz condition, otherwise the vectors are swapped
+    Bs, mu = gram_schmidt(B)
+    if np.dot(Bs[k], Bs[k]) >= (delta - mu[k,k-1]**2)*np.dot(Bs[k-1], Bs[k-1]):
+      k = k + 1
+    else:
+      B[[k-1,k]] = B[[k,k-1]]
+      T[[k-1,k]] = T[[k,k-1]]
+      k = max(k-1, 1)
+  # the reduced lattice from the exact integer transformation
+  return np.dot(T, lattice), T
+
+def image_candidates(lattice):
+  """The lattice shifts (integer, respect to `lattice`) that can give
+  a shorter distance than a difference of direct coordinates already
+  wrapped to [-1/2, 1/2]. For a difference `f`, the image `s` is
+  shorter only if s.G.s < -2 s.G.f <= sum_i |(G.s)_i|, with G the
+  metric tensor. No image is needed for orthogonal cells, and only a
+  few for a reduced (see `reduce_lattice`) skewed cell.
+
+  return: a Mx3 integer array
+
+  """
+  lattice = np.array(lattice, dtype=float)
+  G = np.dot(lattice, lattice.T)
+  tol = 1e-8*np.trace(G)
+  n = 1
+  while True:
+    images = np.array(list(itertools.product(range(-n, n+1), repeat=3)))
+    images = images[np.any(images != 0, axis=1)]
+    Gs = np.dot(images, G)
+    norm = np.sum(Gs*images, axis=1)
+    candidates = images[norm < np.sum(np.abs(Gs), axis=1) - tol]
+    # the search is complete if no candidate is in the outer shell
+    if len(candidates) == 0 or np.abs(candidates).max() < n:
+      return candidates
+    n = n + 1
+
+def shortest_vector(lattice):
+  """The shortest (non-zero) vector of a reduced `lattice`, i.e. the
+  nearest self-image of an atom
+
+  return: (length, image), `image` are its integer coordinates
+
+  """
+  lattice = np.array(lattice, dtype=float)
+  images = np.array(list(itertools.product([-2, -1, 0, 1, 2], repeat=3)))
+  images = images[np.any(images != 0, axis=1)]
+  lengths = np.linalg.norm(np.dot(images, lattice), axis=1)
+  k = np.argmin(lengths)
+  return lengths[k], images[k]
+
+def neighbor_pairs(positions, lattice=None, cutoff=3.0, allow_self=True, verbose=False,
+                   workers=None):
+  """Finds all the pairs of atoms closer than `cutoff` by using a cell
+  list (linked-cell) search. The atoms are binned in cells (in direct
+  coords) with a width of at least `cutoff`, and only the adjacent
+  cells (within PBC) are searched. Its cost scales linearly with the
+  number of atoms, and the NxN distance matrix is never built.
+
+  `positions`: cartesian coordinates, size Nx3.
+
+  `lattice`: 3x3 array-like. If None, no PBC are used.
+
+  `cutoff`: the maximum distance (in Angstroms) of a pair.
+
+  `allow_self`: it allows to an atom to be its own neighbor, in
+  another lattice
+
+  `workers`: number of threads searching the adjacent bins
+
+  return: (i, j, d, shift), four arrays with one entry per pair. The
+  atom `j` (shifted by the lattice vectors `shift`, an integer Px3
+  array) is at a distance `d` from the atom `i`:
+
+  d = |positions[j] + shift.lattice - positions[i]|
+
+  Both (i,j) and (j,i) are included. An atom `j` can appear more than
+  once as neighbor of `i` (in different images) for small cells.
+
+  """
+  positions = np.array(positions, dtype=float)
   N = len(positions)
+  empty = (np.array([], dtype=int), np.array([], dtype=int),
+           np.array([], dtype=float), np.zeros((0,3), dtype=int))
+  if N == 0 or cutoff <= 0:
+    return empty
+  if lattice is None:
+    # without PBC, a box large enough to never find a periodic image
+    # closer than `cutoff`
+    positions = positions - positions.min(axis=0)
+    lattice = np.diag(positions.max(axis=0) + cutoff + 1.0)
+  lattice = np.array(lattice, dtype=float)
+
+  # direct coordinates, the atoms are wrapped into the [0,1) cell, but
+  # the cell of each atom is needed to get the right shift
+  direct = np.dot(positions, np.linalg.inv(lattice))
+  cell = np.floor(direct)
+  direct = direct - cell
+  wrapped = np.dot(direct, lattice)
+
+  # the number of bins along each lattice vector is set by its
+  # perpendicular height, every bin must be at least `cutoff` wide
+  volume = np.abs(np.linalg.det(lattice))
+  heights = volume/np.linalg.norm(np.cross(lattice[[1,2,0]], lattice[[2,0,1]]), axis=1)
+  nbins = np.maximum(np.floor(heights/cutoff).astype(int), 1)
+  # if the cell is smaller than `cutoff`, more than one bin needs to
+  # be searched in each direction
+  reach = np.ceil(cutoff*nbins/heights).astype(int)
   if verbose:
-    print('positions')
-    print(positions, positions.shape)
-    
-  # d is a list of NxN distance-matrices (one per pbc_list)
-  d = []
-  for vector in pbc_list:
-    # rows have the position in the central cell
-    rows = positions.repeat(N,axis=0)
-    rows.shape = (N, N, 3)
-    # columns have position on the extended cells
-    npos = positions + vector
-    columns = npos.repeat(N,axis=0)
-    columns.shape = (N, N, 3)
-    columns = np.transpose(columns, axes=(1,0,2))
-    if verbose:
-      print('rows[0]')
-      print(rows[0], rows.shape)
-      print('columns[0]')
-      print(columns[0], columns.shape)
-      # calculating the distance
-    d.append( np.linalg.norm(rows-columns, axis=2) )
-    
-  # lets assume the first distance is the minimum distance
-  dist = d.pop(0)
-  for matrix in d:
-    # np.minimum is element-wise
-    dist = np.minimum(dist, matrix)
-
-  # now we are looking for the self-distances in another cell
-  if allow_self:
-    # I popped one entry of `d` before, but it can't be the nearest
-    # self-image (it is shited in [-1,-1,-1], and the nearest
-    # neighborh are shifted in only one lattice vector)
-    for matrix in d:
-      for i in range(N):
-        # any non-zero value is a good guess
-        if dist[i,i] == 0 and matrix[i,i] != 0:
-          dist[i,i] = matrix[i,i]
-        # but I want the smallest non-sero value
-        elif matrix[i,i] < dist[i,i]:
-          dist[i,i] = matrix[i,i]          
-    
+    print('latticeUtils.neighbor_pairs(): cutoff', cutoff)
+    print('bins per lattice vector', nbins, ', bins searched', reach)
+
+  bins = np.minimum((direct*nbins).astype(int), nbins-1)
+  bin_id = (bins[:,0]*nbins[1] + bins[:,1])*nbins[2] + bins[:,2]
+  # atoms sorted by bin, `starts` is where each bin begins
+  order = np.argsort(bin_id, kind='stable')
+  counts = np.bincount(bin_id, minlength=np.prod(nbins))
+  starts = np.cumsum(counts) - counts
+
+  atoms = np.arange(N)
+
+  def search(offset):
+    # bin to search and its periodic image
+    nbin = bins + np.array(offset)
+    image = np.floor_divide(nbin, nbins)
+    nbin = nbin - image*nbins
+    nbin_id = (nbin[:,0]*nbins[1] + nbin[:,1])*nbins[2] + nbin[:,2]
+    # every atom `i` is paired with all the atoms of its bin `nbin`
+    ncounts = counts[nbin_id]
+    total = np.sum(ncounts)
+    if total == 0:
+      return None
+    i = np.repeat(atoms, ncounts)
+    first = np.repeat(starts[nbin_id] - (np.cumsum(ncounts) - ncounts), ncounts)
+    j = order[first + np.arange(total)]
+    vectors = wrapped[j] + np.dot(image[i], lattice) - wrapped[i]
+    d = np.linalg.norm(vectors, axis=1)
+    keep = d < cutoff
+    # an atom is never its own neighbor in the same cell
+    if allow_self:
+      keep = keep & ((i != j) | np.any(image[i] != 0, axis=1))
+    else:
+      keep = keep & (i != j)
+    i, j = i[keep], j[keep]
+    # shift respect to the original (non-wrapped) positions
+    shift = image[i] + cell[i].astype(int) - cell[j].astype(int)
+    return i, j, d[keep], shift
+
+  offsets = itertools.product(*[range(-x, x+1) for x in reach])
+  if workers is None or workers < 2:
+    results = [search(offset) for offset in offsets]
+  else:
+    # the bins are shared by the threads, each one searches a few
+    # offsets
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      results = list(pool.map(search, offsets))
+  results = [x for x in results if x is not None]
+  I = [x[0] for x in results]
+  J = [x[1] for x in results]
+  D = [x[2] for x in results]
+  S = [x[3] for x in results]
+  if len(I) == 0:
+    return empty
+  I, J, D, S = np.concatenate(I), np.concatenate(J), np.concatenate(D), np.concatenate(S)
+  # sorting by `i` and then by `j`
+  order = np.lexsort((J, I))
   if verbose:
-    print('distances')
-    print(dist, dist.max())
-  return dist
+    print('pairs found:', len(order))
+  return I[order], J[order], D[order], S[order]
+
+def pair_distances(positions, lattice, i, j):
+  """PBC-aware distances, but only between the pairs of atoms i[k],
+  j[k]. The positions have to be in cartesian coordinates, size
+  Nx3. As in `distances`, an atom paired with itself gets the
+  distance to its nearest image.
+
+  return: (d, shift), the distances and the lattice shift (an integer
+  Px3 array) of atom j[k] giving that distance.
+
+  """
+  positions = np.array(positions, dtype=float)
+  i, j = np.array(i, dtype=int), np.array(j, dtype=int)
+  reduced, T = reduce_lattice(lattice)
+  direct = np.dot(positions, np.linalg.inv(reduced))
+  # the differences are wrapped to [-1/2, 1/2] (in the reduced
+  # lattice), `shift` is the number of reduced vectors added
+  vectors = direct[j] - direct[i]
+  shift = -np.rint(vectors)
+  vectors = np.dot(vectors + shift, reduced)
+  d = np.sum(vectors**2, axis=1)
+  best = np.zeros(shift.shape)
+  for image in image_candidates(reduced):
+    dimage = np.sum((vectors + np.dot(image, reduced))**2, axis=1)
+    closer = dimage < d
+    d[closer] = dimage[closer]
+    best[closer] = image
+  # the image [0,0,0] is not valid for an atom and itself, its nearest
+  # self-image is a shortest vector of the lattice
+  same = i == j
+  shortest, image = shortest_vector(reduced)
+  d[same] = shortest**2
+  best[same] = image
+  shift = shift + best
+  # the shift respect to the original lattice
+  shift = np.dot(shift.astype(int), T)
+  return np.sqrt(d), shift
+
+class NeighborList:
+  """Compact (CSR-like) list of neighbors of N atoms. The neighbors of
+  the atom `i` are:
+
+  indices[indptr[i]:indptr[i+1]]
+
+  and `distances`, `shifts` (the lattice shift of each neighbor, see
+  `neighbor_pairs`) follow the same layout. Within each atom the
+  neighbors are sorted by index (and distance).
+
+  Methods:
+  rows()                 # the atom `i` of each entry of `indices`
+  unique()               # a NeighborList with only the closest image of each neighbor
+  to_list()              # list of N lists with the neighbors
+  neighbors(atoms)       # all the neighbors of a group of atoms
+  coordination(atoms)    # number of neighbors of each atom (within `atoms`)
+  clusters(atoms)        # connected groups of `atoms`
+  """
+  def __init__(self, N, i, j, distances, shifts=None):
+    i = np.array(i, dtype=int)
+    j = np.array(j, dtype=int)
+    distances = np.array(distances, dtype=float)
+    if shifts is None:
+      shifts = np.zeros((len(i), 3), dtype=int)
+    shifts = np.array(shifts, dtype=int).reshape(-1,3)
+    order = np.lexsort((distances, j, i))
+    self.N = N
+    self.indptr = np.zeros(N+1, dtype=int)
+    self.indptr[1:] = np.cumsum(np.bincount(i, minlength=N))
+    self.indices = j[order]
+    self.distances = distances[order]
+    self.shifts = shifts[order]
+    return
+
+  def rows(self):
+    """The atom owning each entry of `self.indices` """
+    return np.repeat(np.arange(self.N), np.diff(self.indptr))
+
+  def unique(self):
+    """A new NeighborList, where each neighbor is listed once (its
+    closest image)"""
+    rows = self.rows()
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (self.indices[1:] != self.indices[:-1])
+    return NeighborList(self.N, rows[first], self.indices[first],
+                        self.distances[first], self.shifts[first])
+
+  def to_list(self):
+    """list of N lists with the neighbors (as python int) of each atom """
+    return [x.tolist() for x in np.split(self.indices, self.indptr[1:-1])]
+
+  def _mask(self, atoms):
+    mask = np.zeros(self.N, dtype=bool)
+    mask[np.array(list(atoms), dtype=int)] = True
+    return mask
+
+  def neighbors(self, atoms):
+    """The neighbors of any of `atoms` (a sorted array, without
+    repetitions) """
+    return np.unique(self.indices[self._mask(atoms)[self.rows()]])
+
+  def coordination(self, atoms=None):
+    """Number of neighbors of each atom. If `atoms` is given, only the
+    neighbors within `atoms` are counted """
+    rows = self.rows()
+    if atoms is not None:
+      rows = rows[self._mask(atoms)[self.indices]]
+    return np.bincount(rows, minlength=self.N)
+
+  def clusters(self, atoms=None):
+    """The connected groups (clusters) of `atoms`, only the bonds
+    between atoms of `atoms` are used. All the atoms by default.
+
+    return: a list of lists, one by cluster, sorted by their first atom
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+    if atoms is None:
+      atoms = range(self.N)
+    mask = self._mask(atoms)
+    rows = self.rows()
+    keep = mask[rows] & mask[self.indices]
+    graph = csr_matrix((np.ones(np.sum(keep)), (rows[keep], self.indices[keep])),
+                       shape=(self.N, self.N))
+    ncomponents, labels = connected_components(graph, directed=False)
+    atoms = np.nonzero(mask)[0]
+    labels = labels[atoms]
+    # grouping the atoms by label, the label of each cluster is set by
+    # its first atom
+    order = np.argsort(labels, kind='stable')
+    labels, start = np.unique(labels[order], return_index=True)
+    clusters = [x.tolist() for x in np.split(atoms[order], start[1:])]
+    clusters.sort()
+    return clusters
+
 
 class Neighbors:
-  def __init__(self, poscar, verbose=False):
+  def __init__(self, poscar, verbose=False, cell_list=False, workers=None):
+    """Nearest neighbors of each atom of `poscar`.
+
+    `cell_list`: if True, the neighbors are searched with a cell list
+    (see `neighbor_pairs`) and the NxN distance matrix is not
+    calculated (`self.distances` is None). Recommended for large
+    cells.
+
+    `workers`: number of threads used to calculate the distances (or
+    the cell list) and the RDF.
+
+    """
     self.poscar = poscar
     self.verbose = verbose
-    self.nn_list = None # a list of N lists with neighbor indexes
-    self.nn_elem = None # the atomic elements of the nn_list
+    self.cell_list = cell_list
+    self.workers = workers
+    self.neighbor_list = None # the neighbors, a `NeighborList`
+    self._nn_list = None # a list of N lists with neighbor indexes
+    self._nn_elem = None # the atomic elements of the nn_list
+    self.d_MaxSp = None # maximum bond distance by pair of species
+    self.rdf = None # the rdf.RDF with the cutoffs, built once
+    self.pairs = None # with a cell list, (i, j, d, shift) up to rdf.PAIRS_CUTOFF
 
     self.db = db.atomicDB # database with atomic info
-    self.distances = distances(positions=self.poscar.cpos,
-                               lattice=self.poscar.lat)
-    # Maximum distance of a nearest neighbor NxN matrix
+    self.distances = None
+    if not self.cell_list:
+      self.distances = distances(positions=self.poscar.cpos,
+                                 lattice=self.poscar.lat,
+                                 workers=self.workers)
+    # Maximum distance of a nearest neighbor, by species
     self.estimateMaxBondDist()
-    self.nn_list = self.set_neighbors()
-    self.d_Max = None # maximum distance for a nearest neighbor (a
-                      # dict, for all interactions)
+    self.set_neighbors()
     return
 
   def estimateMaxBondDist(self):
@@ -119,36 +538,31 @@ class Neighbors:
     
     which is half way between the first and second neighbors in a FCC lattice
 
-    It returns a Natoms x Natoms matrix with d_Max for each pair of atoms
+    It returns a Nspecies x Nspecies matrix with d_Max for each pair of
+    species (also stored as `self.d_MaxSp`)
 
     """
     if self.verbose:
       print('Find_neighbors.estimateMaxBondDist:')
-    elements = self.poscar.elm
-    # removing duplicates, and going to write a dictionary with
-    # distances
-    nelems = list(set(elements))
-    
+    # a (small) matrix with the species of the poscar, the cutoff of
+    # a pair of atoms is d_MaxSp[indexSp[i], indexSp[j]]
+    typeSp = self.poscar.typeSp
     if self.verbose:
-      print('elements to use:', nelems)
-    names = [x+y for x in nelems for y in nelems]
-    values = [self.db.estimateBond(x,y) for x in nelems for y in nelems]
-    max_dist = dict(zip(names, values))
+      print('elements to use:', typeSp)
+    d_MaxSp = [[self.db.estimateBond(x,y) for x in typeSp] for y in typeSp]
+    d_MaxSp = np.array(d_MaxSp)
     if self.verbose:
-      print('Estimated covalent radius (not maximum yet) ', max_dist)
-    
-    d_Max = [[max_dist[x+y] for x in elements] for y in elements]
+      print('Estimated covalent radius (not maximum yet) ', d_MaxSp)
     # rescaling to allow intermediate distances (FCC-like)
-    d_Max = np.array(d_Max)*(1+np.sqrt(2))/2
-    self.d_Max = d_Max
+    self.d_MaxSp = d_MaxSp*(1+np.sqrt(2))/2
     if self.verbose:
       print('Estimation of the Maximum bond length:')
-      print(self.d_Max)
-    return self.d_Max
+      print(self.d_MaxSp)
+    return self.d_MaxSp
 
   def set_neighbors(self,allow_self=True):
-    """setting the nearest neighbors by using self.d_Max as cutoff
-    distance
+    """setting the nearest neighbors by using the cutoff distance of each
+    pair of species (the smallest of `self.d_MaxSp` and the RDF one)
 
      Arguments: 
 
@@ -156,44 +570,109 @@ class Neighbors:
     to be useless in a large supercell.  Beware, if the
     self-distance is zero, this could be troublesome
 
+     return: `self.neighbor_list`, a NeighborList. `self.nn_list` is
+     the same as a list of lists
+
      """
-    self.nn_list = []
     N = self.poscar.Ntotal
+    # the lists are built from `self.neighbor_list` when needed
+    self._nn_list = None
+    self._nn_elem = None
     
-    my_RDF = rdf.RDF(self.poscar)
-    
-    self.d_Max = np.minimum(my_RDF.CutoffMatrix, self.d_Max)
-    
-    if self.verbose:
-      print(self.d_Max)
+    # the RDF (and its KDE curves) only depends on the positions, like
+    # `self.distances`. It uses the same distances (or pairs) than the
+    # neighbors
+    if self.rdf is None:
+      if self.cell_list:
+        self.pairs = neighbor_pairs(self.poscar.cpos, lattice=self.poscar.lat,
+                                    cutoff=rdf.PAIRS_CUTOFF, allow_self=True,
+                                    workers=self.workers)
+        i, j, d, shift = self.pairs
+        other = i != j
+        self.rdf = rdf.RDF(self.poscar, workers=self.workers,
+                           pairs=(i[other], j[other], d[other]))
+      else:
+        # the RDF doesn't use the self-distances
+        RDF_distances = self.distances.copy()
+        np.fill_diagonal(RDF_distances, 0.0)
+        self.rdf = rdf.RDF(self.poscar, workers=self.workers, distances=RDF_distances)
+    my_RDF = self.rdf
+
+    if self.cell_list:
+      self._set_neighbors_cell_list(my_RDF, allow_self)
+    else:
+      cutoffSp = np.minimum(my_RDF.CutoffSp, self.d_MaxSp)
+      if self.verbose:
+        print('cutoff by species:\n', cutoffSp)
       
-    ### Añadir MIS minimos
-    
-    
-    for i in range(N):
-      # to store all defects
-      temp = []
-      for j in range(N):
-        if self.distances[i,j] < self.d_Max[i,j]:
-          # The self-neighbors may/maynot be included
-          if i!=j:
-            temp.append(j)
-            # if allow_self is True, also accept
-          elif 'allow_self':
-            temp.append(j)
-      self.nn_list.append(temp)
-
-    self._set_nn_elem()
+      ### Añadir MIS minimos
+
+      # the rows of each species are compared with their cutoffs
+      # (one per column, by species)
+      species = self.poscar.indexSp
+      i, j = [], []
+      for X in range(len(cutoffSp)):
+        rows = np.nonzero(species == X)[0]
+        ii, jj = np.nonzero(self.distances[rows] < cutoffSp[X][species])
+        i.append(rows[ii])
+        j.append(jj)
+      i, j = np.concatenate(i), np.concatenate(j)
+      # The self-neighbors may/maynot be included
+      if not allow_self:
+        i, j = i[i != j], j[i != j]
+      # only the shifts are needed, the distances are the ones compared
+      _, shift = pair_distances(self.poscar.cpos, self.poscar.lat, i, j)
+      self.neighbor_list = NeighborList(N, i, j, self.distances[i,j], shift)
+
     if self.verbose:
       print('list of first neighbors:')
       print(list(zip(self.nn_list, self.nn_elem)))
-    return self.nn_list
+    return self.neighbor_list
     
+  def _set_neighbors_cell_list(self, my_RDF, allow_self=True):
+    """Same as `set_neighbors`, but the cutoffs are given by species
+    and only the pairs within the largest cutoff are used (see
+    `neighbor_pairs`). The pairs found for the RDF are reused.
+
+    """
+    N = self.poscar.Ntotal
+    cutoffSp = np.minimum(my_RDF.CutoffSp, self.d_MaxSp)
+    if self.verbose:
+      print('cutoff by species:\n', cutoffSp)
+    # the species of each atom, as an index of `typeSp`
+    species = self.poscar.indexSp
+    if self.pairs is not None and cutoffSp.max() <= rdf.PAIRS_CUTOFF:
+      i, j, d, shift = self.pairs
+    else:
+      i, j, d, shift = neighbor_pairs(self.poscar.cpos, lattice=self.poscar.lat,
+                                      cutoff=cutoffSp.max(), allow_self=True,
+                                      workers=self.workers)
+    keep = d < cutoffSp[species[i], species[j]]
+    if not allow_self:
+      keep = keep & (i != j)
+    # a neighbor is listed once, regardless of how many of its images
+    # are within the cutoff
+    self.neighbor_list = NeighborList(N, i[keep], j[keep], d[keep], shift[keep]).unique()
+    return self.neighbor_list
+
+  @property
+  def nn_list(self):
+    """list of N lists with the neighbors of each atom. It is built from
+    `self.neighbor_list` the first time is needed"""
+    if self._nn_list is None and self.neighbor_list is not None:
+      self._nn_list = self.neighbor_list.to_list()
+    return self._nn_list
+
+  @property
+  def nn_elem(self):
+    """the elements of `self.nn_list`, built the first time is needed"""
+    if self._nn_elem is None and self.neighbor_list is not None:
+      self._set_nn_elem()
+    return self._nn_elem
+
   def _set_nn_elem(self):
     """ sets the elements of the list of nearest neighbors  """
-    nn_elem = []
-    for nns in self.nn_list:
-      temp = [self.poscar.elm[x] for x in nns]
-      nn_elem.append(temp)
-    self.nn_elem = nn_elem
+    elm = np.array(self.poscar.elm)
+    nn_elem = np.split(elm[self.neighbor_list.indices], self.neighbor_list.indptr[1:-1])
+    self._nn_elem = [x.tolist() for x in nn_elem]
     
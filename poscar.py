@@ -1,42 +1,150 @@
 #!/usr/bin/env python
 import sys
-import re
 import numpy as np
 import argparse
+import io
+import cacheUtils
+
+
+def _write_rows(f, rows, fmt, chunk=20000):
+  """Writes a line per row of the 2D array `rows` into the file-like
+  `f`, the line format `fmt` has one field per column. A single
+  %-formatting is done for each chunk of lines."""
+  for start in range(0, len(rows), chunk):
+    block = rows[start:start+chunk]
+    f.write((fmt*len(block)) % tuple(block.ravel().tolist()))
 
 
 class Poscar:
   """Stores the settings of a POSCAR. The Cartesian and direct coords
-    must be updated together all the time.  The scaling factor, is
-    internally set to 1.0, always.
+    are synchronized lazily: setting one of them (or calling
+    `_set_cartesian`/`_set_direct`) marks the other one as outdated,
+    and it is computed only when it is read. If the positions are
+    modified in place, call `_set_cartesian`/`_set_direct`
+    afterwards. The scaling factor, is internally set to 1.0, always.
 
     Methods:
     parse(self)                    # loads the whole file
-    _set_cartesian(self)           # set direct -> cartesian (internal)
-    _set_direct(self)              # set cartesian -> direct (internal)
-    _unparse(self, direct)         # data to string, called by write()
+    _set_cartesian(self)           # set direct -> cartesian, lazily (internal)
+    _set_direct(self)              # set cartesian -> direct, lazily (internal)
+    _unparse(self, direct)         # data to string (self.poscar)
     write(self, filename, direct)  # saves the class to a POSCAR-like file
     xyz(self, filename)            # saves a xyz file from the data
     sort(self)                     # sorts the atoms, grouping them by element
     remove()                       # removes one or more atoms from poscar
-    add(position, element, direct) # add one atom at the time
+    add(position, element, direct) # add one atom
+    add_many(positions, elements, direct) # add several atoms at once
   """
 
-  def __init__(self, filename, verbose=False):
+  def __init__(self, filename, verbose=False, cache=False):
+    """`cache`: if True, the parsed data is stored in (and later loaded
+    from) a binary cache next to the file, see cacheUtils. Only used
+    when parsing a file.
+
+    """
     self.verbose = verbose
     self.filename = filename
+    self.cache = cache
     self.poscar = None
-    self.cpos = None # cartesian coordinates
-    self.dpos = None # direct coordinates
-    self.lat = None # lattice
+    self._cpos = None # cartesian coordinates, None if outdated
+    self._dpos = None # direct coordinates, None if outdated
+    self._lat = None # lattice
+    self._inv_lat = None # cache of the inverse of the lattice
+    self._inv_lat_of = None # ... and the lattice it was computed from
+    self._elm = None # cache of self.elm
     self.typeSp = None # Name of atomic species
     self.numberSp = None # Number of atoms per specie
     self.Ntotal = None # Total atoms in system
-    self.elm = None # Element of each atoms one-by-one. list(str)
+    self.indexSp = None # Index (in typeSp) of the specie of each atom. np.array(int)
     self.selective = None # Selective dynamics
-    self.selectFlags = None # all the T,F from selective dynamics. np.array(str)
+    self.selectFlags = None # all the T,F from selective dynamics. np.array(bool), Nx3
     self.volume = None
     return
+
+  @property
+  def elm(self):
+    """Element of each atom one-by-one, tuple(str). It is a read-only
+    view of `typeSp` and `indexSp` (built when needed), to change the
+    species of the atoms change `indexSp` or `typeSp`"""
+    if self._elm is None and self._indexSp is not None:
+      self._elm = tuple(np.array(self._typeSp, dtype=str)[self._indexSp].tolist())
+    return self._elm
+
+  @property
+  def cpos(self):
+    """Cartesian coordinates, Nx3. Computed from `dpos` if needed"""
+    if self._cpos is None and self._dpos is not None:
+      self._cpos = np.dot(self._dpos, self._lat)
+    return self._cpos
+
+  @cpos.setter
+  def cpos(self, value):
+    self._cpos = value
+    self._dpos = None
+
+  @property
+  def dpos(self):
+    """Direct coordinates, Nx3. Computed from `cpos` if needed"""
+    if self._dpos is None and self._cpos is not None:
+      self._dpos = np.dot(self._cpos, self._inverse_lattice())
+    return self._dpos
+
+  @dpos.setter
+  def dpos(self, value):
+    self._dpos = value
+    self._cpos = None
+
+  @property
+  def lat(self):
+    return self._lat
+
+  @lat.setter
+  def lat(self, value):
+    # an outdated set of coordinates has to be computed with the old
+    # lattice
+    if self._lat is not None:
+      self.cpos, self.dpos
+    self._lat = value
+
+  def _inverse_lattice(self):
+    """The inverse of the lattice, it is cached. The lattice could be
+    modified in place, hence it is compared with the cached one (just
+    9 numbers). (internal)"""
+    if self._inv_lat is None or not np.array_equal(self._inv_lat_of, self._lat):
+      self._inv_lat_of = np.array(self._lat, dtype=float)
+      self._inv_lat = np.linalg.inv(self._inv_lat_of)
+    return self._inv_lat
+
+  def _set_positions(self, dpos, cpos):
+    """sets both coordinates, they must be consistent (internal)"""
+    self._dpos = dpos
+    self._cpos = cpos
+
+  def _take(self, index):
+    """keeps the positions given by `index` (mask or array of
+    indexes), only the coordinates up to date are copied (internal)"""
+    if self._dpos is not None:
+      self._dpos = self._dpos[index]
+    if self._cpos is not None:
+      self._cpos = self._cpos[index]
+
+  @property
+  def indexSp(self):
+    return self._indexSp
+
+  @indexSp.setter
+  def indexSp(self, value):
+    self._indexSp = value
+    self._elm = None
+
+  @property
+  def typeSp(self):
+    return self._typeSp
+
+  @typeSp.setter
+  def typeSp(self, value):
+    self._typeSp = value
+    self._elm = None
     
   def parse(self, fromString=None):
     """Loads into memory all the content of the POSCAR file.
@@ -46,6 +154,9 @@ class Poscar:
     variable as a string with the contents of the POSCAR file. Default=None
 
     """
+    fromFile = not fromString
+    if fromFile and self.cache and self._load_cache():
+      return
     if fromString and isinstance(fromString, str):
       self.poscar = fromString.split('\n')
     elif fromString and isinstance(fromString, list):
@@ -55,32 +166,29 @@ class Poscar:
       self.poscar = self.poscar.readlines()
 
     # getting the scale factor
-    scale = re.findall(r'[.\d]+', self.poscar[1])
-    scale = float(scale[0])
+    scale = float(self.poscar[1].split()[0])
     if self.verbose:
       print('scaling factor: ', scale)
     
-    # parsing the lattice
-    self.lat = re.findall(r'[-.\d]+\s+[-.\d]+\s+[-.\d]+\s*\n*', ''.join(self.poscar[2:5]))
-    self.lat = np.array([x.split() for x in self.lat], dtype=float)*scale
+    # parsing the lattice, only the first three numbers of each line
+    self.lat = np.array([x.split()[:3] for x in self.poscar[2:5]], dtype=float)*scale
     if self.verbose:
       print( 'lattice:\n', self.lat)
 
     # type of atoms and number of atoms per type
-    self.typeSp = re.findall(r'(\w+)\s*', self.poscar[5])
+    self.typeSp = self.poscar[5].split()
     if len(self.typeSp) == 0:
       raise RuntimeError("No data about the atomic species found. Correct it.")
     if self.verbose:
       print( 'atoms per species:\n', self.typeSp)
-    self.numberSp = re.findall(r'(\d+)\s*', self.poscar[6])
-    self.numberSp = np.array(self.numberSp, dtype=int)
+    self.numberSp = np.array(self.poscar[6].split(), dtype=int)
     self.Ntotal = np.sum(self.numberSp)
     if self.verbose:
       print( 'atomic species:\n', self.numberSp)
       print( 'The total is ' + str(self.Ntotal) + ' atoms')
     
     # selective dynamics? setting a offset
-    if re.findall(r'^\s*[sS]', self.poscar[7]) :
+    if self.poscar[7].lstrip()[:1] in ['s', 'S']:
       self.selective = True
       offset = 1
       if self.verbose:
@@ -91,7 +199,7 @@ class Poscar:
       
     # Direct coordinates unless otherwise
     direct = True
-    if not re.findall(r'^\s*[Dd]', self.poscar[7+offset]) :
+    if self.poscar[7+offset].lstrip()[:1] not in ['d', 'D']:
       direct = False
       if self.verbose:
         print('Positions in Cartesian coordinates')
@@ -99,196 +207,224 @@ class Poscar:
       if self.verbose:
         print('Positions in Direct coordinates')
 
-    # parsing the positions
+    # parsing the positions (and flags) in a single pass, the block of
+    # positions is tokenized at once. Only if there are extra columns
+    # (i.e. labels or comments), each line is split on its own
     start, end = 8+offset, 8+offset+ self.Ntotal
-    string = r'([-.\d]+)\s+([-.\d]+)\s+([-.\d]+)\s*'
-    pos = re.findall(string, ''.join(self.poscar[start:end]))
+    ncols = 6 if self.selective else 3
+    tokens = ' '.join(self.poscar[start:end]).split()
+    if len(tokens) != self.Ntotal*ncols:
+      tokens = [x for line in self.poscar[start:end] for x in line.split()[:ncols]]
+    if len(tokens) != self.Ntotal*ncols:
+      raise RuntimeError('The positions of ' + str(self.Ntotal) + ' atoms were expected')
+    pos = np.array([tokens[i::ncols] for i in range(3)], dtype=float).T
     if direct:
-      self.dpos = np.array(pos, dtype=float)
+      self.dpos = pos
       self._set_cartesian()
     else:
-      self.cpos = np.array(pos, dtype=float)
+      self.cpos = pos
       self._set_direct()
     if self.verbose:
       print( "Atomic positions (direct)\n", self.dpos)
       print( "Atomic positions (cartesian)\n", self.cpos)
 
-    # parsing selective dynamics
+    # selective dynamics, True means 'T'
     if self.selective == True:
-      string = r'([TF]+)\s+([TF]+)\s+([TF]+)\s+'
-      selectFlags = re.findall(string, ''.join(self.poscar[start:end]))
-      self.selectFlags = np.array(selectFlags)
-      print('Flags of selective dynamics:\n', self.selectFlags)
+      self.selectFlags = np.array([tokens[i::ncols] for i in range(3, 6)]).T == 'T'
+      if self.verbose:
+        print('Flags of selective dynamics:\n', self.selectFlags)
       
-    # setting a list of elements:
-    elementList = zip(self.typeSp, self.numberSp)
-    self.elm = ' '.join([' '.join([x]*y) for x,y in elementList]).split()
+    # the index of the species of each atom, the list of elements is
+    # built from it
+    self.indexSp = np.repeat(np.arange(len(self.typeSp)), self.numberSp)
     if self.verbose:
       print('Elements: ', self.elm)
 
     # setting the volume, just as an utility
     self.volume = np.linalg.det(self.lat)
+    if fromFile and self.cache:
+      self._save_cache()
     return
 
+  def _cache_arrays(self):
+    """the parsed data as (arrays, info), see cacheUtils (internal)"""
+    arrays = {'lat' : self.lat, 'dpos' : self.dpos, 'cpos' : self.cpos,
+              'indexSp' : self.indexSp}
+    if self.selective:
+      arrays['selectFlags'] = self.selectFlags
+    info = {'typeSp' : list(self.typeSp),
+            'numberSp' : [int(x) for x in self.numberSp],
+            'selective' : bool(self.selective)}
+    return arrays, info
+
+  def _from_cache(self, arrays, info):
+    """sets the data given by _cache_arrays() (internal)"""
+    self.poscar = None
+    self.lat = arrays['lat']
+    self._set_positions(arrays['dpos'], arrays['cpos'])
+    self.indexSp = arrays['indexSp']
+    self.typeSp = info['typeSp']
+    self.numberSp = np.array(info['numberSp'], dtype=int)
+    self.Ntotal = np.sum(self.numberSp)
+    self.selective = info['selective']
+    self.selectFlags = arrays.get('selectFlags')
+    self.volume = np.linalg.det(self.lat)
+
+  def _save_cache(self):
+    """stores the parsed data in the cache of the file (internal)"""
+    arrays, info = self._cache_arrays()
+    cacheUtils.save(self.filename, 'poscar', arrays, info, verbose=self.verbose)
+
+  def _load_cache(self):
+    """loads the parsed data from the cache of the file, if it is up
+    to date. Returns True on success (internal)"""
+    cached = cacheUtils.load(self.filename, 'poscar', verbose=self.verbose)
+    if cached is None:
+      return False
+    self._from_cache(*cached)
+    return True
+
   def _set_cartesian(self):
-    cart = np.dot(self.lat.T, self.dpos.T)
-    cart = cart.T
-    self.cpos = cart
+    """The direct coordinates are the right ones, the Cartesian ones
+    will be computed when needed"""
+    self.dpos = self.dpos
     
   def _set_direct(self):
-    inverse = np.linalg.inv(self.lat)
-    direct = np.dot(inverse.T, self.cpos.T)
-    direct = direct.T
-    self.dpos = direct
+    """The Cartesian coordinates are the right ones, the direct ones
+    will be computed when needed"""
+    self.cpos = self.cpos
     
-  def _unparse(self, direct=True):
+  def _unparse(self, direct=True, precision=10):
     """writes a POSCAR file with the info stored in the arrays. The
     information is as it is. No PBC are applied, and no checks are
     performed at this stage.
     The scaling factor is 1.0, always.
+    The result is stored as a string in `self.poscar`, to write it in
+    a file use `write()`.
     """
-
-    # We will start with getting the positions
-    if direct == True:
-      pos = self.dpos
-    else:
-      pos = self.cpos
-      
-    # creating a list of text lines with positions
-    pos = [' '.join([str(coord) for coord in line]) for line in pos]
-
-    # Now we will look whether selective dynamics are used
-    if self.selective == True:
-      # a list of text lines with flags
-      flags = [' '.join([flag for flag in line]) for line in pos]
-      pos = [pos + ' ' + flag for (pos, flag) in zip(pos,flags)]
-
-    pos = '\n'.join(pos)
-
-    # Creating the POSCAR text string
-    self.poscar = "poscar.py\n"
-    self.poscar += "1.0\n"
-    self.poscar += '\n'.join([' '.join([str(y) for y in x]) for x in self.lat]) + '\n'
-    self.poscar += ' '.join(self.typeSp) + '\n'
-    self.poscar += ' '.join([str(x) for x in self.numberSp]) + '\n'
-    if self.selective:
-      self.poscar += 'Selective Dynamics\n'
-    if direct == False:
-      self.poscar += 'Cartesian\n'
-    else:
-      self.poscar += 'Direct\n'
-    self.poscar += pos # already set with the the T, F -if needed
-    self.poscar += '\n'
+    buffer = io.StringIO()
+    self._write_poscar(buffer, direct=direct, precision=precision)
+    self.poscar = buffer.getvalue()
     
     if self.verbose:
       print("\n\n unparsed POSCAR\n\n")
       print('unparse, self.poscar\n', self.poscar)
 
+  def _write_poscar(self, f, direct=True, precision=10):
+    """writes the POSCAR to the file-like object `f`. The positions are
+    formatted by chunks of lines, with `precision` decimals. (internal)
+    """
+    number = ' %' + str(precision + 6) + '.' + str(precision) + 'f'
+    f.write("poscar.py\n")
+    f.write("1.0\n")
+    _write_rows(f, np.asarray(self.lat), number*3 + '\n')
+    f.write(' '.join(self.typeSp) + '\n')
+    f.write(' '.join([str(x) for x in self.numberSp]) + '\n')
+    if self.selective:
+      f.write('Selective Dynamics\n')
+    if direct == False:
+      f.write('Cartesian\n')
+      pos = self.cpos
+    else:
+      f.write('Direct\n')
+      pos = self.dpos
+    if self.selective == True:
+      # the flags go after the positions, as T or F
+      rows = np.empty((len(pos), 6), dtype=object)
+      rows[:, :3] = pos
+      rows[:, 3:] = np.where(self.selectFlags, 'T', 'F')
+      _write_rows(f, rows, number*3 + ' %s %s %s\n')
+    else:
+      _write_rows(f, np.asarray(pos), number*3 + '\n')
 
-  def write(self, filename='POSCAR.out', direct=True):
-    self._unparse(direct=direct)
-    fout = open(filename, 'w')
-    fout.write(self.poscar)
+  def write(self, filename='POSCAR.out', direct=True, precision=10):
+    """Writes the POSCAR file `filename`, in `direct` or Cartesian
+    coordinates with `precision` decimals. The file is written
+    directly, `self.poscar` is not set (see `_unparse`)"""
+    with open(filename, 'w') as fout:
+      self._write_poscar(fout, direct=direct, precision=precision)
     if self.verbose:
       print('File '  + filename + ' written.')
     return
       
-  def xyz(self, filename):
-    xyzf = open(filename, 'w')
-    xyzf.write(str(self.Ntotal) + '\n')
-
-    # The comment line has the lettice
-    latStr = np.array(self.lat, dtype=str).flatten()
-    latStr = ' '.join(latStr)
-    xyzf.write('Lattice="'  + latStr + '"\n')
-    
-    # continuing with the positions
-    pos = self.cpos
-    pos = np.array(pos, dtype=str)
-    pos = [' '.join(x) for x in pos]
-    elm = list(self.elm)
-    xyzstr = '\n'.join( [ x + ' ' + y for x,y in zip(elm, pos) ] )
-    xyzf.write(xyzstr)
-    xyzf.write('\n')
-    xyzf.close()
+  def xyz(self, filename, precision=10):
+    number = ' %' + str(precision + 6) + '.' + str(precision) + 'f'
+    with open(filename, 'w') as xyzf:
+      xyzf.write(str(self.Ntotal) + '\n')
+      # The comment line has the lettice
+      latStr = ((number*9) % tuple(np.ravel(self.lat))).split()
+      xyzf.write('Lattice="'  + ' '.join(latStr) + '"\n')
+      # continuing with the positions
+      rows = np.empty((len(self.cpos), 4), dtype=object)
+      rows[:, 0] = self.elm
+      rows[:, 1:] = self.cpos
+      _write_rows(xyzf, rows, '%s' + number*3 + '\n')
     if self.verbose:
       print(filename + ' written as xyz')
       
   def sort(self):
-    #
-    # self.typeSp, self.elem, self.dpos
-    # must be present and updated (they can be disordered)
-    #
+    """Sorts the atoms, grouping them by element (in the order of
+    `self.typeSp`). The order of the atoms of the same element is
+    kept (a stable sort). Repeated elements in `typeSp` are merged.
+
+    self.typeSp, self.indexSp, self.dpos must be present and updated
+    (they can be disordered)
+
+    """
     from collections import OrderedDict
     # getting the different element's names, without repetitions
-    self.typeSp = list(OrderedDict.fromkeys(self.typeSp))
-    if self.verbose:
-      print('The list of elements is ', self.typeSp)
-    # lists of ordered atoms
-    atoms = []
-    elements = []
+    typeSp = list(OrderedDict.fromkeys(self.typeSp))
     if self.verbose:
+      print('The list of elements is ', typeSp)
       print('to sort: ', self.elm, '\n', self.dpos)
+    newIndex = np.array([typeSp.index(x) for x in self.typeSp], dtype=int)
+    indexSp = newIndex[self.indexSp]
+    self.typeSp = typeSp
     
     # ordering the positions accordiong to its element.
-    for thiselem in self.typeSp:
-      # Joining each element with its position
-      for elem, pos in zip(self.elm, self.dpos):
-        if thiselem == elem:
-          atoms.append(pos)
-          elements.append(elem)
+    order = np.argsort(indexSp, kind='stable')
+    self.indexSp = indexSp[order]
+    # reordering the positions (only the coordinates up to date)
+    self._take(order)
+    if self.selective:
+      self.selectFlags = self.selectFlags[order]
     if self.verbose:
-      print('sorted: ', elements, '\n', np.array(atoms))
-
-    self.elm = elements
-    # setting the position's list in direct coords.
-    self.dpos = np.array(atoms)
-    # and in cartesian coords as well
-    self._set_cartesian()
+      print('sorted: ', self.elm, '\n', self.dpos)
 
     # How many atoms by element?
-    from collections import Counter
-    # a dict of elements and its repetitions
-    counter = Counter(elements)
-    self.numberSp = [counter[x] for x in self.typeSp]
-    
+    self.numberSp = np.bincount(self.indexSp, minlength=len(self.typeSp)).tolist()
     self.Ntotal = sum(self.numberSp)
     if self.verbose:
       print ("N atoms per specie, ", self.numberSp, '. Total: ', self.Ntotal)
 
   def remove(self, atoms):
-    # atoms maybe (or not) just one atom (an int, not a one-sized list)
+    """Removes one or more `atoms` (0-based indexes, an int or any
+    array-like) at once. The order of the remaining atoms is kept."""
     if self.verbose:
       print('going to delete the following atom(s):', atoms)
-    try:
-      iterator = iter(atoms)
-    except TypeError:
-      atoms = [atoms]
+    atoms = np.array(atoms, dtype=int).ravel()
+    if np.any(atoms >= self.Ntotal):
+      raise RuntimeError('Error: atom index is larger than the atom number')
       
-    # we will populate a list with the atoms to keep
-    keep = [True]*self.Ntotal
-    for atom in atoms:
-      if atom >= self.Ntotal:
-        raise RuntimeError('Error: atom index is larger than the atom number')
-      keep[atom] = False
+    # a mask with the atoms to keep
+    keep = np.ones(self.Ntotal, dtype=bool)
+    keep[atoms] = False
     # creating new arrays without the removed elements
-    self.cpos = self.cpos[keep]
-    self.dpos = self.dpos[keep]
-    self.Ntotal = len(self.cpos)
-    
-    # self.elm is a list, I am not sure why, but I will cast it back to list
-    self.elm = np.array(self.elm)
-    self.elm = self.elm[keep]
-    self.elm = list(self.elm)
-    
+    self._take(keep)
+    self.Ntotal = int(np.sum(keep))
+    indexSp = self.indexSp[keep]
     if self.selective:
       self.selectFlags = self.selectFlags[keep]
-    # the atoms types and their number can be modified, we need to
-    # count them from self.elm
-    # Also I want to keep the order of elements
-    from collections import OrderedDict
-    self.typeSp = list(OrderedDict.fromkeys(self.elm).keys())
-    self.numberSp = [self.elm.count(x) for x in self.typeSp]
+      
+    # the atoms types and their number can be modified. I want to keep
+    # the order of elements (as they appear)
+    species, first = np.unique(indexSp, return_index=True)
+    species = species[np.argsort(first)]
+    newIndex = np.zeros(len(self.typeSp), dtype=int)
+    newIndex[species] = np.arange(len(species))
+    self.typeSp = [self.typeSp[x] for x in species]
+    self.indexSp = newIndex[indexSp]
+    self.numberSp = np.bincount(self.indexSp, minlength=len(self.typeSp)).tolist()
     if self.verbose:
       print('Elements', self.elm)
       print(self.typeSp, self.numberSp)
@@ -296,43 +432,72 @@ class Poscar:
     return
 
   def add(self, position, element, direct=True, selectiveFlags=None):
-    """ Atoms must be added one at the time """
-    position = np.array(position, dtype=float)
-    position.shape = (1,3)
+    """Adds a single atom, see `add_many`"""
     if self.verbose:
       print('going to add an ' +element+  ' atom at', position, end=',')
       if direct:
         print('in direct coordinates')
       else:
         print('in Cartesian coordiantes')
-    # setting the data
+    if selectiveFlags is not None:
+      selectiveFlags = [selectiveFlags]
+    self.add_many([position], [element], direct=direct, selectiveFlags=selectiveFlags)
+    return
+
+  def add_many(self, positions, elements, direct=True, selectiveFlags=None):
+    """Adds several atoms at once, and sorts the atoms (only once) by
+    element.
+
+    `positions`: Mx3 array-like
+    `elements`: a list of M elements, or a single element for all the atoms
+    `direct`: are the positions in direct or Cartesian coordinates?
+    `selectiveFlags`: Mx3 array-like with the selective dynamics flags
+    (bool or 'T','F'). Only used if self.selective, by default the new
+    atoms are free to move.
+
+    """
+    positions = np.array(positions, dtype=float).reshape(-1, 3)
+    M = len(positions)
+    if isinstance(elements, str):
+      elements = [elements]*M
+    elements = list(elements)
+    if len(elements) != M:
+      raise RuntimeError('add_many: ' + str(M) + ' positions, but ' +
+                         str(len(elements)) + ' elements')
+    if self.verbose:
+      print('going to add', M, 'atoms:', elements)
+    # setting the data, only in the coordinates given (the other ones
+    # are computed when needed)
     if direct:
-      self.dpos = np.concatenate((self.dpos, position))
+      self.dpos = np.concatenate((self.dpos, positions))
     else:
-      self.cpos = np.concatenate((self.cpos, position))
-    self.Ntotal = self.Ntotal + 1
-    self.elm.append(element)
-    if self.selective and selectiveFlags:
-      if self.verbose:
+      self.cpos = np.concatenate((self.cpos, positions))
+    self.Ntotal = self.Ntotal + M
+    # the new elements (if any) go at the end of the species table
+    typeSp = list(self.typeSp)
+    for element in elements:
+      if element not in typeSp:
+        typeSp.append(element)
+    index = dict(zip(typeSp, range(len(typeSp))))
+    indexSp = np.array([index[x] for x in elements], dtype=int)
+    self.indexSp = np.concatenate((self.indexSp, indexSp))
+    self.typeSp = typeSp
+    if self.selective:
+      # without flags, the new atoms are free to move
+      if selectiveFlags is None:
+        selectiveFlags = np.ones((M, 3), dtype=bool)
+      elif self.verbose:
         print('selective flag found.')
-      selectiveFlags = np.array(selectiveFlags, dtype=str)
-      self.selectFlags = np.concatenate(self.selectFlags, selectiveFlags)
-    # setting the other data
-    if direct:
-      self._set_cartesian()
-    else:
-      self._set_direct()
-    # the atoms types and their number can be modified, we need to
-    # count them from self.elm
-    # Also I want to keep the order of elements
-    from collections import OrderedDict
-    self.typeSp = list(OrderedDict.fromkeys(self.elm).keys())
-    self.numberSp = [self.elm.count(x) for x in self.typeSp]
+      selectiveFlags = np.array(selectiveFlags)
+      if selectiveFlags.dtype.kind in 'US':
+        selectiveFlags = selectiveFlags == 'T'
+      selectiveFlags = np.array(selectiveFlags, dtype=bool).reshape(M, 3)
+      self.selectFlags = np.concatenate((self.selectFlags, selectiveFlags))
+    # sorting the data
+    self.sort()
     if self.verbose:
       print('Elements', self.elm)
       print(self.typeSp, self.numberSp)
-    # sorting the data
-    self.sort()
     return
 
     
@@ -343,10 +508,12 @@ if __name__ == '__main__':
   parser.add_argument("inputfile", type=str, help="input file")
   parser.add_argument('-v', '--verbose', action='store_true')
   parser.add_argument('--xyz', action='store_true')
+  parser.add_argument('--cache', action='store_true', help='use a binary cache'
+                      ' of the parsed file')
   
   args = parser.parse_args()
 
-  p = Poscar(args.inputfile, verbose=args.verbose)
+  p = Poscar(args.inputfile, verbose=args.verbose, cache=args.cache)
   p.parse()
 
   if args.xyz:
@@ -1,12 +1,164 @@
 #!/usr/bin/env python
 
 import argparse
+import itertools
 import numpy as np
 from poscar import Poscar
 import latticeUtils
 
 
-def poscarDiff(poscar1, poscar2, tolerance=0.01):
+def _wrapped_displacements(dpos1, dpos2, lattice):
+  """Cartesian vectors from `dpos1` to `dpos2` (direct coords, same
+  shape), taking the nearest periodic image of each fractional
+  difference (i.e. within [-0.5,0.5)). Enough for small
+  displacements."""
+  delta = np.asarray(dpos2) - np.asarray(dpos1)
+  delta = delta - np.round(delta)
+  return np.dot(delta, lattice)
+
+def _assign(dpos1, dpos2, lattice, k=16, dense=1000):
+  """Minimum cost assignment of the atoms `dpos1` to the atoms `dpos2`
+  (same number of them, direct coords in [0,1)), the cost is the
+  displacement. For more than `dense` atoms only the `k` nearest
+  candidates of each atom are considered (a sparse bipartite graph),
+  if they aren't enough the full problem is solved. Returns the index
+  in `dpos2` of each atom. (internal)"""
+  from scipy.spatial import cKDTree
+  from scipy.sparse import csr_matrix
+  from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+  from scipy.optimize import linear_sum_assignment
+  N = len(dpos1)
+  k = min(k, N)
+  if N > dense and k < N:
+    tree = cKDTree(dpos2, boxsize=1.0)
+    candidates = tree.query(dpos1, k=k)[1]
+    cost = np.linalg.norm(_wrapped_displacements(dpos1[:,None,:], dpos2[candidates],
+                                                 lattice), axis=-1)
+    # zero weights would be missing edges
+    graph = csr_matrix((cost.ravel() + 1e-9, candidates.ravel(),
+                        np.arange(0, N*k+1, k)), shape=(N, N))
+    try:
+      return min_weight_full_bipartite_matching(graph)[1]
+    except ValueError:
+      pass
+  cost = np.linalg.norm(_wrapped_displacements(dpos1[:,None,:], dpos2[None,:,:],
+                                               lattice), axis=-1)
+  return linear_sum_assignment(cost)[1]
+
+def _wrapped(dpos):
+  """direct coords wrapped to [0,1), as needed by the boxsize of
+  cKDTree (internal)"""
+  dpos = np.mod(dpos, 1.0)
+  dpos[dpos >= 1.0] = 0.0
+  return dpos
+
+def best_translation(poscar1, poscar2, tolerance=0.0, subset=32, anchors=8):
+  """The rigid translation (in direct coords) to add to `poscar2` to
+  make it closest to `poscar1`. The candidates put an atom of the
+  least abundant element of `poscar2` on top of one (fixed) atom of
+  `poscar1`; the one with the smallest largest displacement between
+  nearest atoms is chosen.
+
+  All the candidates are first checked with a random `subset` of the
+  atoms (at once), its largest displacement is a lower bound of the
+  one with all the atoms. Then the candidates are checked with all
+  the atoms in the order of their bound, until the bound is larger
+  than the best displacement found, a displacement is below
+  `tolerance` or `anchors` candidates were checked. Hence, the result
+  is only approximate for structures far from equal.
+
+  Return: an array with 3 direct coordinates, None if the elements
+  are different.
+
+  """
+  from scipy.spatial import cKDTree
+  elm1 = np.array(poscar1.elm)
+  elm2 = np.array(poscar2.elm)
+  if sorted(elm1.tolist()) != sorted(elm2.tolist()):
+    return None
+  elements, counts = np.unique(elm2, return_counts=True)
+  rare = elements[np.argmin(counts)]
+  anchor = poscar1.dpos[np.nonzero(elm1 == rare)[0][0]]
+  shifts = anchor - poscar2.dpos[elm2 == rare]
+  trees = {}
+  for element in elements:
+    trees[element] = cKDTree(_wrapped(poscar2.dpos[elm2 == element]), boxsize=1.0)
+
+  def largest(atoms, shifts):
+    """the largest displacement of the `atoms` of poscar1 for each shift"""
+    worst = np.zeros(len(shifts))
+    for element in elements:
+      dpos1 = poscar1.dpos[atoms[elm1[atoms] == element]]
+      if len(dpos1) == 0:
+        continue
+      moved = dpos1[None,:,:] - shifts[:,None,:]
+      nearest = trees[element].query(_wrapped(moved.reshape(-1, 3)), k=1)[1]
+      dpos2 = poscar2.dpos[elm2 == element][nearest].reshape(moved.shape)
+      displacement = _wrapped_displacements(moved, dpos2, poscar1.lat)
+      worst = np.maximum(worst, np.linalg.norm(displacement, axis=-1).max(axis=1))
+    return worst
+
+  rng = np.random.default_rng(0)
+  N = len(elm1)
+  sample = rng.choice(N, size=min(subset, N), replace=False)
+  bound = largest(sample, shifts)
+  best, translation = np.inf, np.zeros(3)
+  everything = np.arange(N)
+  for candidate in np.argsort(bound, kind='stable')[:anchors]:
+    if bound[candidate] >= best:
+      break
+    worst = largest(everything, shifts[candidate:candidate+1])[0]
+    if worst < best:
+      best, translation = worst, shifts[candidate]
+    if best <= tolerance:
+      break
+  return translation
+
+def match_atoms(poscar1, poscar2, shift=None):
+  """Finds, for each atom of `poscar1`, the atom of the same element
+  in `poscar2` closest to it. The order of the atoms (and of the
+  elements) can be different.
+
+  For each element a periodic KD-tree of the fractional coordinates
+  of `poscar2` is queried with the atoms of `poscar1`. The atoms
+  claiming the same partner (if any) are assigned by a minimum cost
+  matching (Hungarian-like), using only the atoms in conflict.
+
+  `shift`: if given, a translation (direct coords) added to `poscar2`
+
+  Return: `permutation`, the atom `i` of poscar1 is the atom
+  `permutation[i]` of poscar2. None if the elements are different.
+
+  """
+  from scipy.spatial import cKDTree
+  elm1 = np.array(poscar1.elm)
+  elm2 = np.array(poscar2.elm)
+  if sorted(elm1.tolist()) != sorted(elm2.tolist()):
+    return None
+  if shift is None:
+    shift = np.zeros(3)
+  permutation = np.zeros(len(elm1), dtype=int)
+  for element in set(elm1.tolist()):
+    atoms1 = np.nonzero(elm1 == element)[0]
+    atoms2 = np.nonzero(elm2 == element)[0]
+    dpos1 = _wrapped(poscar1.dpos[atoms1])
+    dpos2 = _wrapped(poscar2.dpos[atoms2] + shift)
+    tree = cKDTree(dpos2, boxsize=1.0)
+    nearest = tree.query(dpos1, k=1)[1]
+    # the atoms of poscar2 claimed more than once are reassigned
+    claims = np.bincount(nearest, minlength=len(atoms2))
+    conflict = claims[nearest] > 1
+    if np.any(conflict):
+      free = np.ones(len(atoms2), dtype=bool)
+      free[nearest[~conflict]] = False
+      rows = np.nonzero(conflict)[0]
+      cols = np.nonzero(free)[0]
+      nearest[rows] = cols[_assign(dpos1[rows], dpos2[cols], poscar1.lat)]
+    permutation[atoms1] = atoms2[nearest]
+  return permutation
+
+def poscarDiff(poscar1, poscar2, tolerance=0.01, cell_list=False, cutoff=5.0,
+               max_bytes=None, match=False, translate=False):
   """It compares two different Poscar objects. Small numerical errors
   up to `tolerance` are ignored.
 
@@ -18,10 +170,37 @@ def poscarDiff(poscar1, poscar2, tolerance=0.01):
   -comparison between lattices (distances and angles)
   -comparison of the relative distances between atoms
 
+  `cell_list`: if True, only the distances between atoms closer than
+  `cutoff` (in any of the poscars) are compared. The distance matrices
+  are not calculated, recommended for large cells.
+
+  `max_bytes`: if given (and not `cell_list`), the distance matrices
+  are compared by blocks of rows, using roughly `max_bytes` of memory
+  for each block. All the distances are compared.
+
+  `match`: if True, the atoms are matched (see `match_atoms`) instead
+  of comparing distance matrices, the order of the atoms doesn't
+  matter. If the largest displacement between matched atoms is larger
+  than `tolerance`, its statistics are reported as
+  differences['displacements'] (a dict with 'max', 'mean', 'rms' and
+  the atom of poscar1 with the max. displacement, 'atom'). It scales
+  as N log(N), recommended for large cells.
+
+  `translate`: only with `match`. If True, the structures are first
+  aligned by a rigid translation (see `best_translation`)
+
   """
   differences = {}
+  if match:
+    shift = np.zeros(3)
+    if translate:
+      shift = best_translation(poscar1, poscar2, tolerance=tolerance)
+    permutation = match_atoms(poscar1, poscar2, shift=shift)
+    if permutation is None:
+      differences['Elements'] = (list(poscar1.elm),list(poscar2.elm))
+      return differences
   #Checking for type of elements
-  if(list(poscar1.elm) != list(poscar2.elm)):
+  elif(list(poscar1.elm) != list(poscar2.elm)):
     differences['Elements'] = (list(poscar1.elm),list(poscar2.elm))
     return differences
   #The rest only makes sense to check if elements are the same
@@ -37,18 +216,193 @@ def poscarDiff(poscar1, poscar2, tolerance=0.01):
     if(any([x > tolerance for x in delta])):
       differences['lattices'] = lat_delta
   #Checking distances
-  #We get the distance matrix, wich includes distances between atoms for all atoms 
-  d1 = latticeUtils.distances(poscar1.cpos, lattice=poscar1.lat)
-  d2 = latticeUtils.distances(poscar2.cpos, lattice=poscar2.lat)
-  delta = d1 - d2
-  #We take the norm of the difference between the distances
-  delta = np.linalg.norm(delta)
+  if match:
+    #The displacements between matched atoms
+    displacement = _wrapped_displacements(poscar1.dpos, poscar2.dpos[permutation] + shift,
+                                          poscar1.lat)
+    displacement = np.linalg.norm(displacement, axis=1)
+    if len(displacement) > 0 and displacement.max() > tolerance:
+      differences['displacements'] = {'max' : displacement.max(),
+                                      'mean' : displacement.mean(),
+                                      'rms' : np.sqrt(np.mean(displacement**2)),
+                                      'atom' : int(np.argmax(displacement))}
+    return differences
+  elif cell_list:
+    #Only the pairs found (in any poscar) by a cell list search are compared
+    N = poscar1.Ntotal
+    i1, j1, dist, shift = latticeUtils.neighbor_pairs(poscar1.cpos, lattice=poscar1.lat, cutoff=cutoff)
+    i2, j2, dist, shift = latticeUtils.neighbor_pairs(poscar2.cpos, lattice=poscar2.lat, cutoff=cutoff)
+    pairs = np.unique(np.concatenate((i1*N + j1, i2*N + j2)))
+    i, j = pairs//N, pairs%N
+    d1, shift = latticeUtils.pair_distances(poscar1.cpos, poscar1.lat, i, j)
+    d2, shift = latticeUtils.pair_distances(poscar2.cpos, poscar2.lat, i, j)
+    delta = np.linalg.norm(d1 - d2)
+  elif max_bytes is not None:
+    #The distance matrices are compared block by block, never stored
+    blocks1 = latticeUtils.distance_blocks(poscar1.cpos, lattice=poscar1.lat, max_bytes=max_bytes)
+    blocks2 = latticeUtils.distance_blocks(poscar2.cpos, lattice=poscar2.lat, max_bytes=max_bytes)
+    delta = 0.0
+    for (start, end, d1), (start, end, d2) in zip(blocks1, blocks2):
+      delta += np.sum((d1 - d2)**2)
+    delta = np.sqrt(delta)
+  else:
+    #We get the distance matrix, wich includes distances between atoms for all atoms 
+    d1 = latticeUtils.distances(poscar1.cpos, lattice=poscar1.lat)
+    d2 = latticeUtils.distances(poscar2.cpos, lattice=poscar2.lat)
+    #We take the norm of the difference between the distances
+    delta = np.linalg.norm(d1 - d2)
   if(delta > tolerance):
     differences['distances'] = delta
   return differences
   
   
 
+def fingerprint(poscar, cutoff=5.0):
+  """A descriptor of the structure invariant under rotations,
+  translations and permutations of the atoms. It is made of the
+  composition and a small vector of numbers: the cubic root of the
+  volume and, for each pair of elements, the mean and the rms of the
+  distances between atoms up to `cutoff` (from a cell list search).
+  The distances are weighted by a function going smoothly to zero at
+  `cutoff`, hence the vector changes continuously with the positions.
+
+  Small displacements of the atoms give small changes of the vector
+  (of the same order, all its entries are lengths). Different
+  compositions or vectors far apart mean different structures. The
+  opposite is not guaranteed, use `poscarDiff` to check.
+
+  return: (composition, vector). `composition` is a tuple of
+  (element, number of atoms), sorted by element
+
+  """
+  elements = sorted(set(poscar.typeSp))
+  # the index of each element, in alphabetical order
+  order = np.array([elements.index(x) for x in poscar.typeSp], dtype=int)
+  species = order[np.asarray(poscar.indexSp)]
+  K = len(elements)
+  composition = tuple((x, int(np.sum(species == n))) for n, x in enumerate(elements))
+  i, j, d, shift = latticeUtils.neighbor_pairs(poscar.cpos, lattice=poscar.lat, cutoff=cutoff)
+  weight = 0.5*(1 + np.cos(np.pi*np.minimum(d, cutoff)/cutoff))
+  a, b = np.minimum(species[i], species[j]), np.maximum(species[i], species[j])
+  pair = a*K + b
+  total = np.bincount(pair, weights=weight, minlength=K*K)
+  moment1 = np.bincount(pair, weights=weight*d, minlength=K*K)
+  moment2 = np.bincount(pair, weights=weight*d*d, minlength=K*K)
+  # only a <= b are meaningful
+  a, b = np.triu_indices(K)
+  pair = a*K + b
+  total = np.where(total[pair] > 0, total[pair], 1.0)
+  mean = moment1[pair]/total
+  rms = np.sqrt(moment2[pair]/total)
+  volume = abs(float(np.linalg.det(poscar.lat)))**(1/3)
+  return composition, np.concatenate(([volume], mean, rms))
+
+class _NearVectors:
+  """The fingerprint vectors of the unique structures of a composition
+  (in a preallocated array, grown when full), to find the ones close
+  to a new vector. The first vectors are indexed by a cKDTree, rebuilt
+  when the vectors added later are as many; the later ones are
+  compared at once (internal)
+
+  """
+  def __init__(self, size):
+    self.vectors = np.empty((16, size))
+    self.labels = np.empty(16, dtype=int)
+    self.n = 0
+    self.tree = None
+    self.indexed = 0
+
+  def add(self, vector, label):
+    from scipy.spatial import cKDTree
+    if self.n == len(self.vectors):
+      self.vectors = np.concatenate((self.vectors, np.empty_like(self.vectors)))
+      self.labels = np.concatenate((self.labels, np.empty_like(self.labels)))
+    self.vectors[self.n] = vector
+    self.labels[self.n] = label
+    self.n += 1
+    if self.n - self.indexed > max(self.indexed, 32):
+      self.tree = cKDTree(self.vectors[:self.n])
+      self.indexed = self.n
+
+  def near(self, vector, tolerance):
+    """the labels of the vectors closer than `tolerance` (in every
+    entry) to `vector`, the closest first"""
+    found = []
+    if self.tree is not None:
+      found = self.tree.query_ball_point(vector, tolerance, p=np.inf)
+    delta = np.abs(self.vectors[self.indexed:self.n] - vector).max(axis=1)
+    found = np.concatenate((np.array(found, dtype=int),
+                            self.indexed + np.nonzero(delta <= tolerance)[0]))
+    delta = np.abs(self.vectors[found] - vector).max(axis=1)
+    return self.labels[found[np.argsort(delta, kind='stable')]]
+
+
+def unique_structures(poscars, tolerance=0.01, cutoff=5.0):
+  """Removes the duplicates of a list of Poscar objects. The structures
+  are grouped by the composition of their `fingerprint`, and a
+  structure is only compared (`poscarDiff(match=True,
+  translate=True)`) with the unique structures of its group whose
+  fingerprint vectors differ less than `tolerance` (in every entry).
+  The close vectors are found with a KD-tree, the cost is roughly
+  N log(N) plus the few comparisons by `poscarDiff`.
+
+  return: (unique, labels). `unique` are the indexes of the different
+  structures (the first occurrence of each), `labels[i]` is the index
+  of the structure equal to `poscars[i]` in `unique`
+
+  """
+  # composition -> the vectors of its unique structures
+  groups = {}
+  unique = []
+  labels = np.zeros(len(poscars), dtype=int)
+  for index, p in enumerate(poscars):
+    composition, vector = fingerprint(p, cutoff=cutoff)
+    if composition not in groups:
+      groups[composition] = _NearVectors(len(vector))
+    group = groups[composition]
+    for label in group.near(vector, tolerance):
+      if not poscarDiff(poscars[unique[label]], p, tolerance=tolerance, match=True,
+                        translate=True):
+        labels[index] = label
+        break
+    else:
+      group.add(vector, len(unique))
+      labels[index] = len(unique)
+      unique.append(index)
+  return unique, labels
+
+
+def _repeated_positions(dpos, tol):
+  """Which of the direct positions `dpos` are closer than `tol` (with
+  PBC, in direct coordinates) to a previous one. The positions are
+  hashed to a grid of spacing `tol`, only the pairs in neighboring
+  grid points are compared (internal)
+
+  """
+  N = len(dpos)
+  ngrid = int(np.floor(1/tol))
+  dpos = np.mod(dpos, 1)
+  cells = np.floor(dpos*ngrid).astype(np.int64) % ngrid
+  keys = (cells[:,0]*ngrid + cells[:,1])*ngrid + cells[:,2]
+  order = np.argsort(keys, kind='stable')
+  sorted_keys = keys[order]
+  repeated = np.zeros(N, dtype=bool)
+  for offset in itertools.product((-1, 0, 1), repeat=3):
+    neighbor = (cells + offset) % ngrid
+    neighbor = (neighbor[:,0]*ngrid + neighbor[:,1])*ngrid + neighbor[:,2]
+    start = np.searchsorted(sorted_keys, neighbor, side='left')
+    counts = np.searchsorted(sorted_keys, neighbor, side='right') - start
+    # the pairs (i, j), j running over the atoms of the grid point
+    i = np.repeat(np.arange(N), counts)
+    j = np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+    j = order[j + np.repeat(start, counts)]
+    i, j = i[j < i], j[j < i]
+    d = dpos[i] - dpos[j]
+    d = d - np.rint(d)
+    repeated[i[np.linalg.norm(d, axis=1) < tol]] = True
+  return repeated
+
+
 class poscar_modify:
   """ class to change properties of a Poscar-object.
       It requires a poscar-object, not a filename.
@@ -60,6 +414,7 @@ class poscar_modify:
   pos_sum(factor, cartesian)        # sums `factor` to each position
   remove(self, atoms, human)        # removes a list of `atoms`
   add(element, position, cartesian) # add a single atom with  `element` at `position`
+  add_many(elements, positions, cartesian) # add several atoms at once
   shift(amount, cartesian)          # shift all the positions by `amount`
   scale_lattice(factor, cartesian)  # scale the lattice by `factor`. are `cartesian` fixed?
 
@@ -86,6 +441,7 @@ class poscar_modify:
 
     if self.verbose:
       print("new POSCAR:")
+      self.p._unparse(direct=direct)
       print(self.p.poscar)
       if xyz:
         print('XYZ file written')
@@ -99,7 +455,7 @@ class poscar_modify:
     
     """
     factor = np.array(factor, dtype=float)
-    if verbose:
+    if self.verbose:
       print("Multiply positions, factor = ", factor)
       print("old positions:")
       if cartesian:
@@ -109,12 +465,10 @@ class poscar_modify:
         
     if cartesian is True:
       self.p.cpos = self.p.cpos*factor
-      self.p._set_direct()
     else:
       self.p.dpos = self.p.dpos*factor
-      self.p._set_cartesian()
 
-    if verbose:
+    if self.verbose:
       print("\nnew positions:")
       if cartesian:
         print(self.p.cpos)
@@ -132,7 +486,7 @@ class poscar_modify:
     """
     factor = np.array(factor, dtype=float)
     
-    if verbose:
+    if self.verbose:
       print("summing to positions, factor = ", factor)
       print("old positions:")
       if cartesian:
@@ -142,12 +496,10 @@ class poscar_modify:
 
     if cartesian is True:
       self.p.cpos = self.p.cpos + factor
-      self.p._set_direct()
     else:
       self.p.dpos = self.p.dpos + factor
-      self.p._set_cartesian()
 
-    if verbose:
+    if self.verbose:
       print("\nnew positions:")
       if cartesian:
         print(self.p.cpos)
@@ -183,12 +535,11 @@ class poscar_modify:
     
     # then removing
     self.remove(indexes, human=False)
-    # and finally adding a new atoms, one at a time
-    for pos,elem in zip(dpos,newElements):
-      self.add(elem, pos, cartesian=False)
+    # and finally adding the new atoms, all at once
+    self.add_many(newElements, dpos, cartesian=False)
                
     if self.verbose:
-      print('Added element ', newElement, 'at direct coord:', dpos)
+      print('Added elements ', newElements, 'at direct coord:', dpos)
       
   def remove(self, atoms, human=False):
     """Removes a list of atoms from the Poscar object. The order of
@@ -226,6 +577,20 @@ class poscar_modify:
       direct = False
     self.p.add(position=position, element=element, direct=direct)
 
+  def add_many(self, elements, positions, cartesian=True):
+    """Adds several atoms to the Poscar object, sorting them only once.
+    
+    args:
+    
+    elements: a list of atomic species (or a single one for all the atoms)
+    positions: [[X, Y, Z], ...]
+    cartesian: Cartesian (True) or direct coordiantes (False)?
+    """
+    positions = np.array(positions, dtype=float)
+    if self.verbose:
+      print('New atoms:', elements, positions)
+    self.p.add_many(positions=positions, elements=elements, direct=not cartesian)
+
   def shift(self, amount, cartesian):
     """Shift all the positions by `amount`, given in cartesian or direct
     coordinates. The PBCs are always enforced (i.e. [0,1] in direct
@@ -240,25 +605,23 @@ class poscar_modify:
     if cartesian:
       if self.verbose:
         print('\nOriginal Cartesian coords:')
-        print(p.cpos)
+        print(self.p.cpos)
       self.p.cpos = self.p.cpos + amount
-      self.p._set_direct()
       if self.verbose:
         print('\nShifted Cartesian coords:')
-        print(p.cpos)        
+        print(self.p.cpos)        
     else:
       if self.verbose:
         print('\nOriginal Direct coords:')
-        print(p.dpos)      
+        print(self.p.dpos)      
       self.p.dpos = self.p.dpos + amount
-      self.p._set_cartesian()
       if self.verbose:
         print('\nShifted Cartesian coords:')
-        print(p.cpos)        
+        print(self.p.cpos)        
 
-    # enforcing the PBCs
+    # enforcing the PBCs. Setting the positions (in any coordinates)
+    # updates the other ones only when they are used
     self.p.dpos = np.mod(self.p.dpos, 1.0)
-    self.p._set_cartesian()
     return
 
   def scale_lattice(self, factor, cartesian):
@@ -306,7 +669,7 @@ class poscar_supercell:
     """
     lat = self.poscar.lat
     pos = self.poscar.dpos
-    elem = self.poscar.elm
+    indexSp = self.poscar.indexSp
     scell = np.array(size, dtype=int)
   
     if self.verbose:
@@ -327,67 +690,54 @@ class poscar_supercell:
 
     # I need to find the values of n_i, a_i *inside* the supercell.
     # n_i*a_i = n_i*ocell_ij*b_j
-    # then, the condition is : 0 < n_i*ocell_ij < 1
-    b = np.ones(3)
-    n = np.einsum('j,ji', b, scell )
-    n = int(np.max(np.abs(n)))
-    if self.verbose:
-      print( "maximum value of n to search for repetitions : ", n)
-
-    n = np.arange(-n,n)
-
-    n = np.array([(x,y,z) for z in n for y in n for x in n])
-    nuseful = []
-    #checking which of the previous repetitions works
-    for trial in n:
-      value = np.einsum('i,ij', trial, ocell)
-      if value.min() >= 0 and value.max() < 1:
-        nuseful.append(trial)
-      
+    # then, the condition is : 0 <= n_i*ocell_ij < 1
+    # The candidates are in the bounding box of the corners of the
+    # supercell (the sums of the rows of `scell`), all of them are
+    # checked at once
+    corners = np.array([(x,y,z) for z in (0,1) for y in (0,1) for x in (0,1)])
+    corners = np.dot(corners, scell)
+    ranges = [np.arange(corners[:,i].min(), corners[:,i].max()+1) for i in range(3)]
+    # (x,y,z), with x running fastest
+    n = np.stack(np.meshgrid(*ranges[::-1], indexing='ij'), axis=-1).reshape(-1, 3)[:,::-1]
+    value = np.dot(n, ocell)
+    eps = 1e-8
+    inside = np.all((value > -eps) & (value < 1 - eps), axis=1)
+    nuseful = n[inside]
+    shifts = value[inside]
+    volume = int(round(abs(np.linalg.det(scell))))
+    if len(nuseful) != volume:
+      raise RuntimeError('supercell: ' + str(len(nuseful)) + ' lattice points found, '
+                         + str(volume) + ' expected')
     if self.verbose:
       print( "set of new coords\n", nuseful)
-    npos = []
-    for nn in nuseful:
-      npos.append(spos + np.einsum('i,ij', nn, ocell))
-    
-    if self.verbose:
-      print( "positions:")
-    npos = np.concatenate(npos)
+
+    # all the positions, a copy of the cell for each lattice point
+    npos = (spos[None,:,:] + shifts[:,None,:]).reshape(-1, 3)
     npos = np.mod(npos, 1)
+    indexSp = np.tile(indexSp, len(nuseful))
     if self.verbose:
+      print( "positions:")
       print( npos, npos.shape)
 
-    # I can have repeated elements, such as '0 0 1', and '0 0 0'
-    # (the 1 can be 0.9999999 and fail the previous filter)
+    # I can have repeated elements, such as '0 0 1', and '0 0 0' (the
+    # 1 can be 0.9999999). An atom closer than `tol` (with PBC) to a
+    # previous one is removed. The positions are hashed to a grid of
+    # spacing `tol`, only the atoms in the same or the neighboring grid
+    # points are compared
     tol = 0.001
-    temp = []
-    for i in range(len(npos)):
-      repeated = False
-      for j in range(i):
-        d = np.abs(npos[i] - npos[j])
-        for k in range(len(d)):
-          if abs(d[k]-1) < d[k]:
-            d[k]=d[k]-1
-        #print d
-        if np.linalg.norm(d) < tol and i != j:
-          repeated = True
-          if self.verbose:
-            print( i, j, npos[i], npos[j])
-      if not repeated:
-        temp.append(npos[i])
-      
-    temp = np.concatenate(temp)
-    temp.shape = (-1,3)
+    unique = np.nonzero(~_repeated_positions(npos, tol))[0]
+    if self.verbose:
+      print( 'repeated atoms removed:', len(npos) - len(unique))
+    npos = npos[unique]
+    indexSp = indexSp[unique]
     if self.verbose:
-      print( temp.shape)
-    npos = temp[:]
+      print( npos.shape)
     
-    elem = elem*len(nuseful)
-    #print elem
-    self.poscar.elm = elem
+    self.poscar.indexSp = indexSp
     self.poscar.lat = np.dot(scell, lat)
     self.poscar.dpos = npos
-    self.poscar._set_cartesian()
+    if self.poscar.selective:
+      self.poscar.selectFlags = np.tile(self.poscar.selectFlags, (len(nuseful), 1))[unique]
   
     self.poscar.sort()
 
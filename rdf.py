@@ -2,50 +2,189 @@ from code import interact
 import numpy as np
 from poscar import Poscar
 import latticeUtils
-try:
-  from sklearn.neighbors.kde import KernelDensity
-except:
-  from sklearn.neighbors import KernelDensity
 import scipy
 import scipy.signal
 import matplotlib.pyplot as plt
 import generalUtils
 import db
 
+# x-axis space for KDE calculations
+KDE_SPACE = np.arange(0,6, 0.05)
+# pairs further than this don't change the KDE curves within KDE_SPACE
+PAIRS_CUTOFF = KDE_SPACE.max() + 1.0
+
+
+def kde_binned(samples, bandwidth, grid, oversampling=32, max_size=2**22):
+    """Logarithm of the gaussian kernel density of `samples` (1D) at the
+    points of `grid`, the same as sklearn's KernelDensity.score_samples.
+
+    The samples are linearly binned into a fine grid with spacing
+    `bandwidth/oversampling`, and the kernel is summed over the
+    (non-empty) bins instead of the samples. The sum is done in
+    logarithmic scale (log-sum-exp), the tails of the density are
+    meaningful (and so its minima) even far from the samples. The grid
+    points are done by chunks, of about `max_size` kernel evaluations.
+
+    """
+    samples = np.asarray(samples, dtype=float).ravel()
+    delta = bandwidth/oversampling
+    start = samples.min()
+    counts = linear_binning(samples - start, delta)
+    return kde_from_bins(start + np.arange(len(counts))*delta, counts, bandwidth, grid,
+                         max_size=max_size)
+
+def linear_binning(samples, delta, nbins=None):
+    """Histogram of `samples` (all >= 0) with bins at 0, delta, 2*delta,
+    ... Each sample is split between its two closest bins (linear
+    binning), its weights are proportional to its closeness.
+
+    `nbins`: size of the histogram, the samples beyond it are ignored. By
+    default it is large enough for all the samples.
+
+    """
+    x = np.asarray(samples, dtype=float)/delta
+    index = np.floor(x).astype(int)
+    weight = x - index
+    if nbins is None:
+        nbins = index.max() + 2 if len(index) > 0 else 0
+    inside = index + 1 < nbins
+    index, weight = index[inside], weight[inside]
+    counts = np.bincount(index, weights=1 - weight, minlength=nbins)
+    counts += np.bincount(index + 1, weights=weight, minlength=nbins)
+    return counts
+
+def kde_from_bins(centers, counts, bandwidth, grid, max_size=2**22):
+    """The log of the gaussian kernel density of a histogram (the number
+    of samples `counts` at each of the `centers`), at the points of
+    `grid`. See `kde_binned`."""
+    grid = np.asarray(grid, dtype=float).ravel()
+    bins = np.nonzero(counts > 0)[0]
+    centers = np.asarray(centers)[bins]
+    log_counts = np.log(counts[bins])
+
+    log_norm = np.log(np.sum(counts[bins])*bandwidth*np.sqrt(2*np.pi))
+    density = np.empty(len(grid))
+    chunk = max(1, max_size//len(bins))
+    for i in range(0, len(grid), chunk):
+        exponent = log_counts[None, :] - 0.5*((grid[i:i+chunk, None] - centers[None, :])/bandwidth)**2
+        largest = exponent.max(axis=1)
+        density[i:i+chunk] = largest + np.log(np.sum(np.exp(exponent - largest[:, None]), axis=1))
+    return density - log_norm
+
+def first_minimum(space, kde):
+    """The first local minimum of the curve `kde` over `space`. Raises an
+    IndexError if there is no minimum"""
+    #Here we make sure that there isn't any flat points that could
+    #hide local minimums
+    space, kde = generalUtils.remove_flat_points(space, kde)
+    min_index = scipy.signal.argrelextrema(kde,np.less)[0]
+    return space[min_index][0]
+
+def kde_sklearn(samples, bandwidth, grid):
+    """The same as `kde_binned`, but with sklearn's KernelDensity (exact,
+    but its cost is samples x grid). Useful for validation"""
+    try:
+        from sklearn.neighbors.kde import KernelDensity
+    except:
+        from sklearn.neighbors import KernelDensity
+    samples = np.asarray(samples, dtype=float).reshape(-1, 1)
+    kde_curve_fit = KernelDensity(kernel = 'gaussian', bandwidth=bandwidth).fit(samples)
+    return kde_curve_fit.score_samples(np.asarray(grid, dtype=float).reshape(-1, 1))
+
 
 class RDF:
-    #Add distances as optional argument
-    def __init__(self, poscar = None):
+    def __init__(self, poscar = None, cell_list = False, workers = None, backend = 'binned',
+                 distances = None, pairs = None):
         """ This Class mainly obtains cutoff values for first neighbor criteria by utilizing KernelDensity
         It can obtain a single cutoff value for the whole distance matrix 
         Or a cutoff value for each type of interaction (Ex = C-H) 
 
+        `cell_list`: if True, the distance matrix is not calculated. Only the pairs
+        within the range of `KDE_space` are found by a cell list (see
+        latticeUtils.neighbor_pairs). Recommended for large cells
+
+        `workers`: number of threads used to find the distances
+
+        `backend`: how the kernel densities are calculated, 'binned' (see
+        `kde_binned`) or 'sklearn' (KernelDensity, slow but exact)
+
+        `distances`: the NxN distance matrix, if already known (without
+        self-distances, see latticeUtils.distances)
+
+        `pairs`: a list of pairs (i, j, distance), three arrays, from a cutoff
+        based search (i.e. latticeUtils.neighbor_pairs without self
+        images). It must include all the pairs up to `self.pairs_cutoff`,
+        both (i,j) and (j,i). It implies `cell_list`, its cost is linear
+        with the number of pairs
+
         """
-        self.distances = latticeUtils.distances(poscar.cpos, lattice=poscar.lat, allow_self=False)
+        if backend not in ['binned', 'sklearn']:
+            raise RuntimeError('Unknown KDE backend: ' + str(backend))
+        self.poscar = poscar
+        self.cell_list = cell_list
+        self.workers = workers
+        self.backend = backend
         self.species = poscar.numberSp
         self.species_name = poscar.typeSp
         self.spDict = dict(zip(self.species_name,self.species))
         # x-axis space for KDE calculations
-        self.KDE_space = np.arange(0,6, 0.05)
+        self.KDE_space = KDE_SPACE.copy()
+        #Pairs further than this don't change the KDE curves within KDE_space
+        self.pairs_cutoff = PAIRS_CUTOFF
+
+        #Distances matrix, or list of pairs (i, j, distance) if cell_list
+        self.distances = distances
+        self.pairs = None
+        if pairs is not None:
+            self.cell_list = True
+            i, j, d = pairs
+            self.pairs = (np.asarray(i), np.asarray(j), np.asarray(d))
+        elif self.cell_list:
+            i, j, d, shift = latticeUtils.neighbor_pairs(poscar.cpos, lattice=poscar.lat,
+                                                         cutoff=self.pairs_cutoff, allow_self=False,
+                                                         workers=self.workers)
+            self.pairs = (i, j, d)
+        elif self.distances is None:
+            self.distances = latticeUtils.distances(poscar.cpos, lattice=poscar.lat, allow_self=False,
+                                                    workers=self.workers)
 
         #Container for a single minimum value for all distances
         self.neighbor_threshold = None
         #Array of first minimums for each Interaction
         self.neighbor_thresholdSp = None
-        #Matrix of first minimums formated to work with latticeUtils
-        self.CutoffMatrix = None
+        #Matrix of first minimums by Species (len(species) x len(species)),
+        #the NxN matrix by atoms is `CutoffMatrix`
+        self.CutoffSp = None
         #All Species Interactions (C-H = H-C)
         self.interactions = None
+        #KDE curves of each interaction (in the order of `interactions`) and
+        #of all the distances. They are calculated once, when needed
+        self.kde_curveSp = None
+        self.kde_curve = None
+        #Number of distances used for each curve of `kde_curveSp`
+        self.samplesSp = None
+        #Pair correlation function g(r) of each interaction, see `gr_Sp`
+        self.grSp = None
         self.KDE_CurveSp()
         self.FindNeighborsSp()
 
 
+    @property
+    def CutoffMatrix(self):
+        """Matrix of first minimums formated to work with latticeUtils (NxN,
+        by atoms). It is built from `CutoffSp` each time, use `CutoffSp`
+        if possible"""
+        if self.CutoffSp is None:
+            return None
+        species = self.poscar.indexSp
+        return self.CutoffSp[species[:, None], species[None, :]]
+
     def _addUp(self,Species):
         """" Used to make some calculations easier
         returns the sum of all atom Species up until the species especified"""
 
         index = self.species_name.index(Species)
-        add_up = np.sum(self.species[0:index])
+        add_up = int(np.sum(self.species[0:index]))
 
         return add_up
             
@@ -55,17 +194,53 @@ class RDF:
         Starting_index_X = self._addUp(Species = Interaction_X)
         Starting_index_Y = self._addUp(Species = Interaction_Y)
 
+        if self.distances is None:
+            #Without distance matrix, the block is calculated on its own
+            #It is only meant for small blocks
+            X = self.poscar.cpos[Starting_index_X : Starting_index_X + self.spDict[Interaction_X]]
+            Y = self.poscar.cpos[Starting_index_Y : Starting_index_Y + self.spDict[Interaction_Y]]
+            Block = latticeUtils.distances(np.concatenate((X, Y)), lattice=self.poscar.lat, allow_self=False)
+            return Block[:len(X), len(X):]
+
         Block = self.distances[Starting_index_X : Starting_index_X + self.spDict[Interaction_X], Starting_index_Y:Starting_index_Y + self.spDict[Interaction_Y] ]
 
         return Block
 
+    def _findSamples(self, Interaction_X, Interaction_Y):
+        """Returns all the distances of the interaction X-Y as a flat array
+        Only the pairs within `pairs_cutoff` are returned if cell_list"""
+
+        if self.pairs is None:
+            aux_block = self._findBlock(Interaction_X = Interaction_X,Interaction_Y = Interaction_Y)
+            #We need to extract the zeros from the diagonals of the same Species interactions
+            if(Interaction_X == Interaction_Y):
+                return np.extract(1-np.eye(len(aux_block)), aux_block)
+            return aux_block.flatten()
+
+        i, j, d = self.pairs
+        species = self.poscar.indexSp
+        X = list(self.species_name).index(Interaction_X)
+        Y = list(self.species_name).index(Interaction_Y)
+        return d[(species[i] == X) & (species[j] == Y)]
+
 
     
         
+    def _kde(self, samples, bandwidth):
+        """log of the kernel density of `samples` over `self.KDE_space`,
+        with the chosen backend"""
+        if self.backend == 'sklearn':
+            return kde_sklearn(samples, bandwidth, self.KDE_space)
+        return kde_binned(samples, bandwidth, self.KDE_space)
+
     def KDE_CurveSp(self):
-        """ Finding the kde curves for each interaction posible """
+        """ Finding the kde curves for each interaction posible
+        They are calculated only the first time, see `self.kde_curveSp`"""
+        if self.kde_curveSp is not None:
+            return self.kde_curveSp
         kde_curveSp = []
         interactions = []
+        samplesSp = []
         for I in self.spDict.keys():
             for J in self.spDict.keys():
                 
@@ -73,45 +248,75 @@ class RDF:
                 if(list(self.spDict.keys()).index(I) > list(self.spDict.keys()).index(J)):
                     continue
 
-                aux_block = self._findBlock(Interaction_X = I,Interaction_Y = J)
-                
-                #We need to extract the zeros from the diagonals of the same Species interactions
-                if(I == J):
-                    aux_block = np.extract(1-np.eye(len(aux_block)), aux_block)
-                else:
-                    aux_block = aux_block.flatten()
+                aux_block = self._findSamples(Interaction_X = I,Interaction_Y = J)
                 #Here we make sure that the sub_matrix taken contains physical distances
                 #For example interactions C-C when there is only one C atom
-                if (all(x == 0 for x in aux_block)):
+                if not np.any(aux_block):
                     continue
-                aux_block = aux_block.reshape(-1,1)
                 
-                bandwidth = db.DB()
                 #Here we get an adaptable Bandwidth that checks if there is H present
                 #If there is bandwidth is 0.05, if there isn't, bandwidth is 0.1
                 #This could be expanded into a whole database for each atom interaction or individualy
-                bandwidth = bandwidth.get_bandwidth(I,J)
-                kde_curve_fit = KernelDensity(kernel = 'gaussian', bandwidth=bandwidth).fit(aux_block)
-                kde_curveSp.append(kde_curve_fit.score_samples(self.KDE_space.reshape(-1,1)))
+                bandwidth = db.atomicDB.get_bandwidth(I,J)
+                kde_curveSp.append(self._kde(aux_block, bandwidth))
                 interactions.append([I,J])
+                samplesSp.append(len(aux_block))
 
         kde_curveSp = np.array(kde_curveSp)
         interactions = np.array(interactions)
 
         self.interactions = interactions
+        self.kde_curveSp = kde_curveSp
+        self.samplesSp = np.array(samplesSp)
 
         return kde_curveSp
 
+    def gr_Sp(self):
+        """The pair correlation function g(r) of each interaction (in the
+        order of `self.interactions`), over `self.KDE_space`. The kernel
+        density of the distances is scaled to the number of pairs and
+        divided by the volume of each spherical shell and by the density
+        of pairs:
+
+        g_XY(r) = n_XY * exp(kde_XY(r)) / (4 pi r^2 * N_X * N_Y / V)
+
+        with N_X*(N_X-1) instead of N_X*N_Y for X == Y. It is only meaningful
+        up to `self.pairs_cutoff` (with `pairs`, or a cell list) or half the
+        smallest height of the cell (with the distance matrix).
+
+        It is calculated only the first time, see `self.grSp`
+        """
+        if self.grSp is not None:
+            return self.grSp
+        kde = self.KDE_CurveSp()
+        volume = abs(np.linalg.det(self.poscar.lat))
+        r = self.KDE_space
+        shell = 4*np.pi*r**2
+        grSp = np.zeros((len(self.interactions), len(r)))
+        for n, (X, Y) in enumerate(self.interactions):
+            if X == Y:
+                norm = self.spDict[X]*(self.spDict[X] - 1)/volume
+            else:
+                norm = self.spDict[X]*self.spDict[Y]/volume
+            density = self.samplesSp[n]*np.exp(kde[n])
+            grSp[n, r > 0] = density[r > 0]/(shell[r > 0]*norm)
+        self.grSp = grSp
+        return grSp
+
     def KDE_Curve(self):
 
-        """This calculates a single kde curve for the whole distance matrix"""
+        """This calculates a single kde curve for the whole distance matrix
+        It is calculated only the first time, see `self.kde_curve`"""
+        if self.kde_curve is not None:
+            return self.kde_curve
         
-        non_zero_distances = np.extract(1-np.eye(len(self.distances)), self.distances)
-        non_zero_distances = non_zero_distances.reshape(-1,1)
-
-        kde_curve_fit = KernelDensity(kernel = 'gaussian', bandwidth=0.25).fit(non_zero_distances)
+        if self.pairs is None:
+            non_zero_distances = np.extract(1-np.eye(len(self.distances)), self.distances)
+        else:
+            non_zero_distances = self.pairs[2]
 
-        kde_curve = kde_curve_fit.score_samples(self.KDE_space.reshape(-1,1))
+        kde_curve = self._kde(non_zero_distances, 0.25)
+        self.kde_curve = kde_curve
 
         return kde_curve
 
@@ -144,33 +349,30 @@ class RDF:
         mins = []
         KDE = self.KDE_CurveSp()
         neighborsSp = []
-        temp_min_interaction = np.zeros(self.distances.shape)
+        temp_min_species = np.zeros((len(self.species_name), len(self.species_name)))
         for kde, interaction in zip(KDE,self.interactions):
             
             #Here we check that the amount of data from the interactions is enough to use Kernel Density
             #If not, we use the only distances available from the interaction
-            data = self._findBlock(Interaction_X = interaction[0],Interaction_Y= interaction[1])
-            if ((data.shape == (2,2))):
+            shape = (self.spDict[interaction[0]], self.spDict[interaction[1]])
+            if ((shape == (2,2))):
+                data = self._findBlock(Interaction_X = interaction[0],Interaction_Y= interaction[1])
                 min = data[0][1]*1.01
-            elif((data.shape == (1,1))):
+            elif((shape == (1,1))):
+                data = self._findBlock(Interaction_X = interaction[0],Interaction_Y= interaction[1])
                 min = data[0][0]*1.01
             else:
-                #Here we make sure that there isn't any flat points that could
-                #hide local minimums
-                KDE_space, kde_aux = generalUtils.remove_flat_points(self.KDE_space , kde)
-                min_index = scipy.signal.argrelextrema(kde_aux,np.less)[0]
-                
-                min = KDE_space[min_index][0]
+                min = first_minimum(self.KDE_space, kde)
             
             mins.append(min)
 
             #Here we make the cutoff value matrix 
-            x_start = self._addUp(Species=interaction[0])
-            y_start = self._addUp(Species=interaction[1])
-            temp_min_interaction[x_start : x_start + self.spDict[interaction[0]], y_start : y_start + self.spDict[interaction[1]] ] = min
-            temp_min_interaction[y_start : y_start + self.spDict[interaction[1]], x_start : x_start + self.spDict[interaction[0]] ] = min
+            X = list(self.species_name).index(interaction[0])
+            Y = list(self.species_name).index(interaction[1])
+            temp_min_species[X, Y] = min
+            temp_min_species[Y, X] = min
 
-        self.CutoffMatrix = temp_min_interaction
+        self.CutoffSp = temp_min_species
         mins = np.array(mins)
         self.neighbor_thresholdSp = mins
          
@@ -189,3 +391,126 @@ class RDF:
 
 
 
+
+
+class TrajectoryRDF:
+    def __init__(self, cutoff = PAIRS_CUTOFF, delta = 0.001, workers = None):
+        """Partial RDFs averaged over many frames (i.e. a MD trajectory).
+        The frames are added one at a time, only a histogram of the
+        distances of each pair of species is kept (its memory doesn't
+        depend on the number of frames).
+
+        Usage:
+        acc = TrajectoryRDF()
+        acc.add_frames(trajectory.Trajectory('XDATCAR'))  # or a list of Poscar
+        r, interactions, g = acc.gr()
+        elements, cutoffs = acc.cutoffs()
+
+        `cutoff`: largest distance of the histograms
+        `delta`: width of the bins of the histograms (linear binning)
+        `workers`: number of threads of the neighbor search
+
+        """
+        self.cutoff = cutoff
+        self.delta = delta
+        self.workers = workers
+        self.nbins = int(np.ceil(cutoff/delta)) + 1
+        self.r = np.arange(self.nbins)*delta
+        #Elements found so far, their index is the one used by the histograms
+        self.elements = []
+        #Histograms of distances, one per (X, Y) pair of elements (X <= Y), each
+        #frame is weighted by V/(N_X*N_Y) (see RDF.gr_Sp)
+        self.histograms = {}
+        self.frames = 0
+
+    def add(self, poscar):
+        """Adds the distances of a frame (a Poscar object)"""
+        # the species of the frame, as indexes of self.elements
+        for element in poscar.typeSp:
+            if element not in self.elements:
+                self.elements.append(element)
+        index = np.array([self.elements.index(x) for x in poscar.typeSp], dtype=int)
+        species = index[np.asarray(poscar.indexSp)]
+        counts = np.bincount(species, minlength=len(self.elements))
+        volume = abs(np.linalg.det(poscar.lat))
+
+        i, j, d, shift = latticeUtils.neighbor_pairs(poscar.cpos, lattice=poscar.lat,
+                                                     cutoff=self.cutoff, allow_self=False,
+                                                     workers=self.workers)
+        # each pair X-Y is counted once (X < Y), and twice for X == Y, as in
+        # RDF._findSamples
+        keep = species[i] <= species[j]
+        X, Y, d = species[i][keep], species[j][keep], d[keep]
+        for x, y in set(zip(X.tolist(), Y.tolist())):
+            if x == y:
+                norm = counts[x]*(counts[x] - 1)/volume
+            else:
+                norm = counts[x]*counts[y]/volume
+            key = (self.elements[x], self.elements[y])
+            histogram = linear_binning(d[(X == x) & (Y == y)], self.delta, self.nbins)/norm
+            if key in self.histograms:
+                self.histograms[key] += histogram
+            else:
+                self.histograms[key] = histogram
+        self.frames += 1
+
+    def add_frames(self, frames):
+        """Adds all the `frames` (any iterable of Poscar objects, i.e. a
+        trajectory.Trajectory)"""
+        for poscar in frames:
+            self.add(poscar)
+
+    def _interactions(self):
+        """the pairs of elements with distances, in order (internal)"""
+        return sorted(self.histograms.keys(), key=lambda x: (self.elements.index(x[0]),
+                                                             self.elements.index(x[1])))
+
+    def gr(self):
+        """The averaged pair correlation functions g(r), normalized by the
+        volume of each spherical shell (of width `delta`)
+
+        return: (r, interactions, g), `g[n]` is the g(r) of the pair of
+        elements `interactions[n]`. All of them are empty if no frame
+        was added
+
+        """
+        if self.frames == 0:
+            return np.array([]), [], np.zeros((0, 0))
+        interactions = self._interactions()
+        shell = 4/3*np.pi*((self.r + self.delta/2)**3 - np.maximum(self.r - self.delta/2, 0)**3)
+        g = np.array([self.histograms[x]/(self.frames*shell) for x in interactions])
+        # the last bin is incomplete
+        g[:, -1] = 0
+        return self.r, interactions, g
+
+    def KDE_CurveSp(self, space = KDE_SPACE):
+        """log of the kernel density of the distances of each interaction
+        (the same bandwidths than RDF), over `space`
+
+        return: (interactions, kde)
+
+        """
+        interactions = self._interactions()
+        kde = [kde_from_bins(self.r, self.histograms[x], db.atomicDB.get_bandwidth(*x), space)
+               for x in interactions]
+        return interactions, np.array(kde)
+
+    def cutoffs(self, space = KDE_SPACE):
+        """The first minimum of the kde curve of each pair of elements (0 if
+        there is no minimum)
+
+        return: (elements, CutoffSp), CutoffSp is a matrix with the order of
+        `elements`, as RDF.CutoffSp
+
+        """
+        interactions, kde = self.KDE_CurveSp(space)
+        CutoffSp = np.zeros((len(self.elements), len(self.elements)))
+        for (x, y), curve in zip(interactions, kde):
+            try:
+                min = first_minimum(space, curve)
+            except IndexError:
+                min = 0
+            X, Y = self.elements.index(x), self.elements.index(y)
+            CutoffSp[X, Y] = min
+            CutoffSp[Y, X] = min
+        return list(self.elements), CutoffSp
@@ -1,12 +1,100 @@
 #!/usr/bin/env python3
 import poscarUtils
 import poscar
+import trajectory
+import cacheUtils
+import chg_raw
+import latticeUtils
+import rdf
+import contextlib
+import copy
+import io
 import os
+import numpy as np
+from scipy.interpolate import griddata
+import matplotlib.pyplot as plt
 
 
 executable = '../analize.py'
 auxdir = 'aux/'
 resultsdir = 'results/'
+chgdir = 'chg/'
+xdatcardir = 'xdatcar/'
+
+
+def read_grids(filename):
+  """All the data blocks of a CHG-like file (of every frame, in order),
+  read at once. The reference for the readers of chg_raw"""
+  lines = open(filename).read().split('\n')
+  # the grid line is the first one after the blank line of the header
+  ngf = lines[lines.index('') + 1].split()
+  NGF = [int(x) for x in ngf]
+  Ndata = NGF[0]*NGF[1]*NGF[2]
+  blocks = []
+  for i, line in enumerate(lines):
+    if line.split() == ngf:
+      values = ' '.join(lines[i+1:i+1+Ndata]).split()[:Ndata]
+      blocks.append(np.array(values, dtype=float).reshape(NGF[2], NGF[1], NGF[0]))
+  return Ndata, blocks
+
+def read_xdatcar(filename):
+  """All the frames of a XDATCAR, as Poscar objects, read at once. The
+  reference for trajectory.Trajectory"""
+  lines = open(filename).read().split('\n')
+  frames = []
+  i = 0
+  while i < len(lines):
+    if lines[i].startswith('Direct configuration'):
+      N = sum([int(x) for x in header[6].split()])
+      p = poscar.Poscar(None)
+      p.parse(fromString=header + ['Direct'] + lines[i+1:i+1+N])
+      frames.append(p)
+      i += N + 1
+    elif len(lines[i].strip()) > 0:
+      header = lines[i:i+7]
+      i += 7
+    else:
+      i += 1
+  return frames
+
+def read_poscars(filename):
+  """All the frames of concatenated POSCAR files, as Poscar objects,
+  read at once. The reference for trajectory.Trajectory"""
+  lines = open(filename).read().split('\n')
+  frames = []
+  i = 0
+  while i < len(lines):
+    if len(lines[i].strip()) == 0:
+      i += 1
+      continue
+    N = sum([int(x) for x in lines[i+6].split()])
+    end = i + 8
+    if lines[i+7].strip()[0] in 'sS':
+      end += 1
+    p = poscar.Poscar(None)
+    p.parse(fromString=lines[i:end+N])
+    frames.append(p)
+    i = end + N
+  return frames
+
+def same_frame(p, q):
+  """Do the Poscar objects `p` and `q` have the same lattice, species,
+  positions and selective dynamics?"""
+  same = (np.allclose(p.lat, q.lat) and np.allclose(p.dpos, q.dpos) and
+          np.allclose(p.cpos, q.cpos) and list(p.elm) == list(q.elm))
+  if same and q.selective:
+    same = bool(p.selective) and np.array_equal(p.selectFlags, q.selectFlags)
+  return same and bool(p.selective) == bool(q.selective)
+
+def load_chg(filename, chunk=None, **kwargs):
+  """A chg_raw.Chg_base with `filename` loaded, without its messages.
+  `chunk`: the number of lines parsed at once"""
+  chg = chg_raw.Chg_base()
+  if chunk is not None:
+    chg.chunk = chunk
+  with contextlib.redirect_stdout(io.StringIO()):
+    chg.Load(filename, **kwargs)
+  return chg
 
 POSCAR = ["POSCAR-7-9-B.vasp",
           "POSCAR-7-9.vasp" ,
@@ -55,6 +143,27 @@ h_cluster_nn2 = {'options': ' -n 2 -s -y ',
                  'outfile' : '_cluster.vasp',
                  'print' : '\nTesting hydrogenated clusters (2 nearest neighbors)'}
 
+# the same, but the neighbors are found with a cell list
+cl_identification = {'options': ' --cell_list ',
+                     'suffix' : '_defect.vasp',
+                     'outfile' : '_defect.vasp',
+                     'print': '\nTesting the identification of defects (cell list)',
+                     'match' : True}
+cl_h_cluster_nn2 = {'options': ' -n 2 -s -y --cell_list ',
+                    'suffix' : '_cluster-h2.vasp',
+                    'outfile' : '_cluster.vasp',
+                    'print' : '\nTesting hydrogenated clusters (2 nearest neighbors, cell list)',
+                    'match' : True}
+# the same, with several threads
+j_identification = {'options': ' -j 2 ',
+                    'suffix' : '_defect.vasp',
+                    'outfile' : '_defect.vasp',
+                    'print': '\nTesting the identification of defects (2 threads)'}
+j_cl_identification = {'options': ' --cell_list -j 2 ',
+                       'suffix' : '_defect.vasp',
+                       'outfile' : '_defect.vasp',
+                       'print': '\nTesting the identification of defects (cell list, 2 threads)'}
+
 tasks = [identification,
          cluster_nn0,
          cluster_nn1,
@@ -62,7 +171,11 @@ tasks = [identification,
          s_cluster_nn1,
          s_cluster_nn2,
          h_cluster_nn1,
-         h_cluster_nn2]
+         h_cluster_nn2,
+         cl_identification,
+         cl_h_cluster_nn2,
+         j_identification,
+         j_cl_identification]
 
 
 
@@ -98,6 +211,9 @@ for task in tasks:
     p2 = poscar.Poscar(path_p2)
     p2.parse()
     comparison = poscarUtils.poscarDiff(p1, p2)
+    # the tasks meant for large cells are also compared matching the atoms
+    if not comparison and task.get('match'):
+      comparison = poscarUtils.poscarDiff(p1, p2, match=True)
 
     if not comparison:
       print('ok')
@@ -107,6 +223,350 @@ for task in tasks:
       print(path_p2)
       print(comparison)
       
+
+
+# the binary cache: a Poscar loaded from the cache keeps its data when
+# the file is modified and the cache written again
+print('\nTesting the binary cache of POSCAR files')
+filename = 'POSCAR-C4.vasp'
+print(filename + ' ... ', end='')
+path = auxdir + filename + '_cache.vasp'
+lines = open(filename).read().split('\n')
+open(path, 'w').write('\n'.join(lines))
+p1 = poscar.Poscar(path, cache=True)
+p1.parse()
+p1 = poscar.Poscar(path, cache=True)
+p1.parse()
+old_cpos = np.array(p1.cpos)
+# moving the second atom
+i = lines.index('C') + 2
+lines[i] = ' '.join(['%.6f' % (float(x) + 0.4) for x in lines[i].split()[:1]] +
+                    lines[i].split()[1:])
+open(path, 'w').write('\n'.join(lines))
+p2 = poscar.Poscar(path, cache=True)
+p2.parse()
+# clearing the cache of a file keeps the ones of files with longer names
+other = path + '.old'
+open(other, 'w').write('\n'.join(lines))
+poscar.Poscar(other, cache=True).parse()
+cacheUtils.clear(path)
+cleared = not cacheUtils.is_valid(path, 'poscar') and cacheUtils.is_valid(other, 'poscar')
+if np.array_equal(p1.cpos, old_cpos) and not np.array_equal(p2.cpos, old_cpos) and cleared:
+  print('ok')
+elif not cleared:
+  print('The wrong caches were cleared.')
+else:
+  print('The cached data changed.')
+cacheUtils.clear(other)
+os.remove(path)
+os.remove(other)
+
+# removing duplicates: copies of a structure with small random
+# displacements (and a translation) are the same structure
+print('\nTesting the removal of duplicated structures')
+rng = np.random.default_rng(0)
+for filename in ['POSCAR-C4.vasp', 'POSCAR-SiV.vasp']:
+  print(filename + ' ... ', end='')
+  p1 = poscar.Poscar(filename)
+  p1.parse()
+  p2 = poscar.Poscar('POSCAR-nv.vasp')
+  p2.parse()
+  poscars = [p1, p2]
+  for i in range(10):
+    p = copy.deepcopy(p1)
+    p.cpos = p1.cpos + rng.uniform(-1e-3, 1e-3, p1.cpos.shape) + p1.lat[0]*i/10
+    poscars.append(p)
+  unique, labels = poscarUtils.unique_structures(poscars)
+  if list(unique) == [0, 1] and list(labels) == [0, 1] + [0]*10:
+    print('ok')
+  else:
+    print('The duplicates were not removed.')
+    print(unique, labels)
+
+# reading CHG-like files, the grids are compared with the ones read at
+# once. A small chunk of lines forces several chunks by block
+print('\nTesting the reader of CHG-like files')
+for filename, is_chg, Ispin in [('CHGCAR-hex', True, 1),
+                                ('CHGCAR-spin', True, 2),
+                                ('CHG-ncl', True, 4),
+                                ('LOCPOT-hex', False, 1)]:
+  print(filename + ' ... ', end='')
+  Ndata, blocks = read_grids(chgdir + filename)
+  scale = Ndata if is_chg else 1
+  differences = []
+  for chunk in [2, 1 << 16]:
+    chg = load_chg(chgdir + filename, is_chg=is_chg, chunk=chunk)
+    if chg.Ispin != Ispin:
+      differences.append(('Ispin', chg.Ispin))
+    for i in range(Ispin):
+      if not np.allclose(getattr(chg, 'Data' + str(i)), blocks[i]/scale, rtol=1e-12, atol=0):
+        differences.append(('Data' + str(i), chunk))
+  if filename.startswith('LOCPOT') and not chg.is_locpot:
+    differences.append(('is_locpot', chg.is_locpot))
+  if not differences:
+    print('ok')
+  else:
+    print('Results differs.')
+    print(differences)
+
+# the data blocks are parsed only when used
+print('\nTesting the lazy parsing of the data blocks')
+filename = 'CHG-ncl'
+print(filename + ' ... ', end='')
+Ndata, blocks = read_grids(chgdir + filename)
+chg = load_chg(chgdir + filename)
+parsed = [x is not None for x in chg._data]
+data2 = chg.Data2
+parsed_after = [x is not None for x in chg._data]
+if (parsed == [False]*4 and parsed_after == [False, False, True, False] and
+    np.allclose(data2, blocks[2]/Ndata, rtol=1e-12, atol=0) and
+    chg.Data2 is data2 and np.allclose(chg.Data3, blocks[3]/Ndata, rtol=1e-12, atol=0)):
+  print('ok')
+else:
+  print('Results differs.')
+  print(parsed, parsed_after)
+
+# the frames of a CHG file, read through the index of frames
+print('\nTesting the frames of CHG files')
+filename = 'CHG-3frames'
+print(filename + ' ... ', end='')
+Ndata, blocks = read_grids(chgdir + filename)
+text = open(chgdir + filename).read()
+comment = text.split('\n')[0]
+headers = [comment + x.split('\n\n')[0] for x in text.split(comment)[1:]]
+differences = []
+for frame in [0, 1, 2, -1]:
+  chg = load_chg(chgdir + filename, frame=frame)
+  p = poscar.Poscar(None)
+  p.parse(fromString=headers[frame])
+  if not np.allclose(chg.Data0, blocks[frame]/Ndata, rtol=1e-12, atol=0):
+    differences.append(('Data0', frame))
+  if not np.allclose(chg.poscar.dpos, p.dpos):
+    differences.append(('positions', frame))
+chg = chg_raw.Chg_base()
+with contextlib.redirect_stdout(io.StringIO()):
+  if len(chg.index(chgdir + filename)) != 3:
+    differences.append(('Nframes', chg.Nframes))
+  read = 0
+  for frame, c in enumerate(chg.frames(chgdir + filename, start=1)):
+    read += 1
+    if not np.allclose(c.Data0, blocks[frame + 1]/Ndata, rtol=1e-12, atol=0):
+      differences.append(('frames()', frame + 1))
+  if read != 2:
+    differences.append(('frames()', read))
+  try:
+    chg.Load(chgdir + filename, frame=3)
+    differences.append(('frame 3', 'found'))
+  except RuntimeError:
+    pass
+if not differences:
+  print('ok')
+else:
+  print('Results differs.')
+  print(differences)
+
+# the binary cache of CHG-like files, with and without scaling. The
+# grids already loaded from the cache don't change
+print('\nTesting the binary cache of CHG-like files')
+filename = 'CHGCAR-spin'
+print(filename + ' ... ', end='')
+Ndata, blocks = read_grids(chgdir + filename)
+path = auxdir + filename + '_cache'
+open(path, 'w').write(open(chgdir + filename).read())
+differences = []
+load_chg(path, cache=True)
+first = load_chg(path, cache=True)
+for is_chg, scale in [(False, 1), (True, Ndata)]:
+  load_chg(path, is_chg=is_chg, cache=True)
+  chg = load_chg(path, is_chg=is_chg, cache=True)
+  if not isinstance(chg.Data0, np.memmap):
+    differences.append(('not cached', is_chg))
+  for i in range(2):
+    if not np.allclose(getattr(chg, 'Data' + str(i)), blocks[i]/scale, rtol=1e-12, atol=0):
+      differences.append(('Data' + str(i), is_chg))
+if not np.allclose(first.Data0, blocks[0]/Ndata, rtol=1e-12, atol=0):
+  differences.append(('the cached data changed', None))
+if not (cacheUtils.is_valid(path, 'chg0_1') and cacheUtils.is_valid(path, 'chg0_0')):
+  differences.append(('cache names', None))
+if not differences:
+  print('ok')
+else:
+  print('Results differs.')
+  print(differences)
+del chg, first
+cacheUtils.clear(path)
+os.remove(path)
+
+# cuts of a CHG-like file. The grid of the fixture is linear in the
+# indexes, then the periodic interpolation agrees with a triangulation
+# of the points of the plane (the previous method) within their hull
+print('\nTesting the cuts of CHG-like files')
+filename = 'CHGCAR-hex'
+print(filename + ' ... ', end='')
+with contextlib.redirect_stdout(io.StringIO()):
+  chg = chg_raw.Chg(chgdir + filename)
+lat = chg.chg.poscar.lat
+NGF = chg.chg.NGF
+data = chg.chg.Data0
+differences = []
+for ax3 in [0, 1, 2]:
+  ax1, ax2 = (ax3 + 1)%3, (ax3 + 2)%3
+  level = 2
+  xi, yi, zi = chg._cut(data, ax3, level/NGF[ax3])
+  # the points of the plane, in the 2D coordinates of the cut
+  e1 = lat[ax1]/np.linalg.norm(lat[ax1])
+  b1 = np.array([np.linalg.norm(lat[ax1]), 0])
+  b2 = np.array([np.dot(lat[ax2], e1), np.linalg.norm(lat[ax2] - np.dot(lat[ax2], e1)*e1)])
+  points, values = [], []
+  for i in range(NGF[ax1]):
+    for j in range(NGF[ax2]):
+      index = [0, 0, 0]
+      index[ax1], index[ax2], index[ax3] = i, j, level
+      points.append(i/NGF[ax1]*b1 + j/NGF[ax2]*b2)
+      values.append(data[index[2], index[1], index[0]])
+  reference = griddata(np.array(points), np.array(values), (xi, yi), method='linear')
+  inside = ~np.isnan(reference)
+  if np.sum(inside) < 0.3*reference.size or np.any(np.isnan(zi[inside])):
+    differences.append(('points', ax3))
+  elif not np.allclose(zi[inside], reference[inside], rtol=1e-8, atol=0):
+    differences.append(('values', ax3))
+fig = chg.CutPlot(axis='a', cart_level=1.0)
+plt.close(fig)
+if not differences:
+  print('ok')
+else:
+  print('Results differs.')
+  print(differences)
+
+# reading trajectories, the frames are compared with the ones read at
+# once
+print('\nTesting the reader of trajectories')
+for filename in ['XDATCAR-Si', 'XDATCAR-Si-cell', 'POSCAR-frames']:
+  print(filename + ' ... ', end='')
+  if filename.startswith('XDATCAR'):
+    reference = read_xdatcar(xdatcardir + filename)
+  else:
+    reference = read_poscars(xdatcardir + filename)
+  traj = trajectory.Trajectory(xdatcardir + filename)
+  differences = []
+  if len(traj) != len(reference):
+    differences.append(('Nframes', len(traj)))
+  for frame, p in enumerate(traj.frames(copy=True)):
+    if not same_frame(p, reference[frame]):
+      differences.append(('frames()', frame))
+  # random access, the same Poscar object is reused by every frame
+  for frame in [2, 0, -1]:
+    if not same_frame(traj[frame], reference[frame]):
+      differences.append(('read()', frame))
+  if not differences:
+    print('ok')
+  else:
+    print('Results differs.')
+    print(differences)
+
+# the RDF averaged over a trajectory, its histograms are compared with
+# the ones of all the distances (from the distance matrices) of the
+# frames. The cutoff is below half the cell, the matrices are enough
+print('\nTesting the RDF of trajectories')
+filename = 'XDATCAR-Si'
+print(filename + ' ... ', end='')
+cutoff, delta = 2.6, 0.001
+acc = rdf.TrajectoryRDF(cutoff=cutoff, delta=delta)
+# without frames the g(r) is empty
+r, interactions, g = acc.gr()
+empty = len(r) == 0 and interactions == [] and g.size == 0
+acc.add_frames(trajectory.Trajectory(xdatcardir + filename))
+histogram = np.zeros(acc.nbins)
+reference = read_xdatcar(xdatcardir + filename)
+for p in reference:
+  N = p.Ntotal
+  d = latticeUtils.distances(p.cpos, lattice=p.lat, allow_self=False)
+  d = d[~np.eye(N, dtype=bool)]
+  d = d[d < cutoff]
+  histogram += rdf.linear_binning(d, delta, acc.nbins)*abs(np.linalg.det(p.lat))/(N*(N - 1))
+r, interactions, g = acc.gr()
+if (empty and acc.frames == len(reference) and interactions == [('Si', 'Si')] and
+    np.allclose(acc.histograms[('Si', 'Si')], histogram) and np.sum(histogram) > 0):
+  print('ok')
+else:
+  print('Results differs.')
+  print(empty, acc.frames, interactions)
+
+# supercells: the number of atoms (and of each species) scales with
+# the volume, and no atom is repeated
+print('\nTesting the building of supercells')
+filename = 'POSCAR-C4.vasp'
+for size in [[[2, 0, 0], [0, 2, 0], [0, 0, 1]],
+             [[1, 1, 0], [-1, 1, 0], [0, 0, 1]]]:
+  print(filename + ' ' + str(size) + ' ... ', end='')
+  p = poscar.Poscar(filename)
+  p.parse()
+  N, numberSp, typeSp = p.Ntotal, np.array(p.numberSp), list(p.typeSp)
+  volume = int(round(abs(np.linalg.det(size))))
+  s = poscarUtils.poscar_supercell(p).supercell(size)
+  d = latticeUtils.distances(s.cpos, lattice=s.lat)
+  d = d[~np.eye(len(d), dtype=bool)]
+  differences = []
+  if s.Ntotal != volume*N or len(s.cpos) != volume*N:
+    differences.append(('Ntotal', s.Ntotal))
+  if list(s.typeSp) != typeSp or not np.array_equal(s.numberSp, volume*numberSp):
+    differences.append(('species', list(s.typeSp), list(s.numberSp)))
+  if d.min() < 0.1:
+    differences.append(('repeated atoms', d.min()))
+  if not differences:
+    print('ok')
+  else:
+    print('Results differs.')
+    print(differences)
+
+# minimum image distances on a strongly sheared lattice, compared with
+# a brute force search over many images
+print('\nTesting the distances on a sheared lattice')
+print('random positions ... ', end='')
+rng = np.random.default_rng(1)
+lat = np.array([[1.0, 0, 0], [5, 1, 0], [3, 2, 1]])*3
+cpos = np.dot(rng.random((20, 3)), lat)
+R = np.arange(-8, 9)
+images = np.dot(np.stack(np.meshgrid(R, R, R), axis=-1).reshape(-1, 3), lat)
+d = cpos[None,:,None,:] - cpos[:,None,None,:] + images[None,None,:,:]
+d = np.linalg.norm(d, axis=-1)
+# an atom is its own neighbor in another cell
+d[np.arange(20), np.arange(20), np.nonzero(np.all(images == 0, axis=1))[0][0]] = np.inf
+reference = d.min(axis=-1)
+computed = latticeUtils.distances(cpos, lattice=lat)
+if np.allclose(computed, reference):
+  print('ok')
+else:
+  print('Results differs.')
+  print(np.abs(computed - reference).max())
+
+# the distance matrix by blocks of rows, in a float32 array and with
+# several threads, compared with the matrix as a single block
+print('\nTesting the distance matrix by blocks')
+filename = 'POSCAR-SiV.vasp'
+print(filename + ' ... ', end='')
+p = poscar.Poscar(filename)
+p.parse()
+N = p.Ntotal
+reference = latticeUtils.distances(p.cpos, lattice=p.lat)
+max_bytes = 8*12*N*10
+blocks = list(latticeUtils.distance_blocks(p.cpos, lattice=p.lat, max_bytes=max_bytes))
+differences = []
+if len(blocks) < 2 or not np.array_equal(np.concatenate([x[2] for x in blocks]), reference):
+  differences.append(('blocks', len(blocks)))
+for kwargs in [{'max_bytes' : max_bytes}, {'workers' : 2},
+               {'max_bytes' : max_bytes, 'workers' : 3}]:
+  if not np.array_equal(latticeUtils.distances(p.cpos, lattice=p.lat, **kwargs), reference):
+    differences.append(kwargs)
+out = np.zeros((N, N), dtype=np.float32)
+computed = latticeUtils.distances(p.cpos, lattice=p.lat, max_bytes=max_bytes, out=out, workers=2)
+if computed is not out or not np.allclose(out, reference, rtol=1e-6, atol=0):
+  differences.append('float32')
+if not differences:
+  print('ok')
+else:
+  print('Results differs.')
+  print(differences)
     
 #     print(poscarUtils.poscarDiff(poscar_defect_1,poscar_defect_2))
 #   else:
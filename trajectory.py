@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Reader of multi-frame files: XDATCAR (fixed or variable cell) and
+concatenated POSCAR files.
+
+The file is scanned once to build an index with the byte offset of
+each frame, then any frame can be read without loading the rest of
+the file. Each frame is returned as a `poscar.Poscar` object.
+
+Usage:
+
+traj = Trajectory('XDATCAR')
+for p in traj:          # or traj.frames(start, stop, step)
+  d = defects.FindDefect(p)
+
+p = traj[-1]            # random access
+
+To avoid allocating memory at every step, the same Poscar object (and
+the same array of positions, as read) is reused for all the frames. Use
+`traj.read(frame, copy=True)` or deepcopy() to keep a frame.
+
+"""
+
+import argparse
+import os
+from copy import deepcopy
+import numpy as np
+import poscar
+
+
+def _is_configuration(line):
+  """Is `line` the first line of a XDATCAR frame, i.e. 'Direct
+  configuration=    1'?"""
+  line = line.lower().split()
+  return len(line) > 0 and line[0].startswith((b'direct', b'cartesian')) and \
+    b'configuration' in line[0] + b''.join(line[1:2])
+
+
+class Trajectory:
+  """Frames of a XDATCAR or concatenated POSCAR files
+
+  Methods:
+  scan(self)                          # builds the index of frames (called once, on demand)
+  read(self, frame, copy)             # a frame as a Poscar object
+  frames(self, start, stop, step)     # generator of frames
+  """
+  def __init__(self, filename, verbose=False):
+    self.filename = filename
+    self.verbose = verbose
+    if not os.path.isfile(filename):
+      raise RuntimeError('File does not exist: ' + str(filename))
+    self.offsets = None # byte offset where each frame starts. np.array(int)
+    self.frame_header = None # index of the header (in self.headers) of each frame
+    self.headers = [] # lattice, species and number of atoms of each different header
+    self.Nframes = None
+    self.poscar = None # the Poscar object reused by all the frames
+    self._header = None # the header currently loaded in self.poscar
+    self._buffer = None # the positions of the frame, as read. Nx3
+    return
+
+  def __len__(self):
+    if self.offsets is None:
+      self.scan()
+    return self.Nframes
+
+  def __iter__(self):
+    return self.frames()
+
+  def __getitem__(self, frame):
+    return self.read(frame)
+
+  def _parse_header(self, lines):
+    """The first 7 lines of a POSCAR (comment, scale, lattice, species
+    and number of atoms) decoded to a dict. (internal)"""
+    lines = [x.decode() for x in lines]
+    scale = float(lines[1].split()[0])
+    lat = np.array([x.split()[:3] for x in lines[2:5]], dtype=float)*scale
+    typeSp = lines[5].split()
+    try:
+      numberSp = np.array(lines[6].split(), dtype=int)
+    except ValueError:
+      raise RuntimeError('No data about the atomic species found, at frame ' +
+                         str(len(self.offsets)))
+    header = {'comment' : lines[0].rstrip('\n'),
+              'scale' : scale,
+              'lat' : lat,
+              'typeSp' : typeSp,
+              'numberSp' : numberSp,
+              'Ntotal' : int(np.sum(numberSp))}
+    return header
+
+  def _add_header(self, header):
+    """The index of `header` in `self.headers`, it is appended if it is
+    new. (internal)"""
+    if len(self.headers) > 0:
+      last = self.headers[-1]
+      if (last['typeSp'] == header['typeSp'] and
+          np.array_equal(last['numberSp'], header['numberSp']) and
+          np.array_equal(last['lat'], header['lat'])):
+        return len(self.headers) - 1
+    self.headers.append(header)
+    return len(self.headers) - 1
+
+  def scan(self):
+    """Reads the whole file once, storing the byte offset of each
+    frame. Only the headers are parsed, the positions are skipped.
+
+    A frame of a XDATCAR starts at its 'Direct configuration=' line
+    (the header can be repeated for a variable cell). A POSCAR frame
+    starts at its comment line.
+
+    """
+    offsets = []
+    frame_header = []
+    self.offsets = offsets
+    self.headers = []
+    current = None
+    with open(self.filename, 'rb') as f:
+      while True:
+        start = f.tell()
+        line = f.readline()
+        if not line:
+          break
+        if len(line.strip()) == 0:
+          continue
+        if current is not None and _is_configuration(line):
+          # a XDATCAR frame, with the last header
+          offsets.append(start)
+          frame_header.append(current)
+        else:
+          # a new header
+          lines = [line] + [f.readline() for i in range(6)]
+          header = self._parse_header(lines)
+          current = self._add_header(header)
+          start_mode = f.tell()
+          mode = f.readline()
+          if mode.lstrip()[:1] in [b's', b'S']:
+            mode = f.readline()
+          if _is_configuration(mode):
+            # the header of a XDATCAR, the frame is this line
+            offsets.append(start_mode)
+            frame_header.append(current)
+          else:
+            # a POSCAR, the frame includes the header
+            offsets.append(start)
+            frame_header.append(current)
+        # skipping the positions
+        for i in range(self.headers[current]['Ntotal']):
+          f.readline()
+    self.offsets = np.array(offsets, dtype=np.int64)
+    self.frame_header = np.array(frame_header, dtype=int)
+    self.Nframes = len(self.offsets)
+    if self.verbose:
+      print('Trajectory.scan(): file', self.filename)
+      print('frames found:', self.Nframes, ', different headers:', len(self.headers))
+    return self.offsets
+
+  def _set_header(self, index):
+    """Loads the header `index` into self.poscar, the buffers of
+    positions are allocated only if the number of atoms
+    changes. (internal)"""
+    if self._header == index:
+      return
+    header = self.headers[index]
+    p = self.poscar
+    if p is None or p.Ntotal != header['Ntotal']:
+      p = poscar.Poscar(self.filename, verbose=False)
+      self._buffer = np.zeros((header['Ntotal'], 3))
+      self.poscar = p
+    # the positions are replaced by the next frame, there is nothing
+    # to convert with the old lattice (as the `lat` setter would do)
+    p._set_positions(None, None)
+    p._lat = header['lat'].copy()
+    p._inv_lat = None
+    p.typeSp = list(header['typeSp'])
+    p.numberSp = header['numberSp'].copy()
+    p.Ntotal = header['Ntotal']
+    p.indexSp = np.repeat(np.arange(len(p.typeSp)), p.numberSp)
+    p.volume = np.linalg.det(p.lat)
+    p.selective = False
+    p.selectFlags = None
+    self._header = index
+
+  def read(self, frame, copy=False):
+    """Returns the `frame` (0-based, negative values count from the end)
+    as a Poscar object.
+
+    `copy`: if False, the Poscar object (and its arrays) is reused by
+    the next frame read.
+
+    """
+    if self.offsets is None:
+      self.scan()
+    if frame < 0:
+      frame = frame + self.Nframes
+    if frame < 0 or frame >= self.Nframes:
+      raise RuntimeError('Frame ' + str(frame) + ' out of range, there are ' +
+                         str(self.Nframes) + ' frames')
+    with open(self.filename, 'rb') as f:
+      p = self._read(f, frame)
+    if copy:
+      return deepcopy(p)
+    return p
+
+  def _read(self, f, frame):
+    """reads `frame` from the open file `f` into self.poscar (internal)"""
+    self._set_header(self.frame_header[frame])
+    p = self.poscar
+    header = self.headers[self.frame_header[frame]]
+    f.seek(self.offsets[frame])
+    line = f.readline()
+    if not _is_configuration(line):
+      # a POSCAR, skipping the header
+      for i in range(6):
+        line = f.readline()
+      line = f.readline()
+      p.selective = line.lstrip()[:1] in [b's', b'S']
+      if p.selective:
+        line = f.readline()
+    direct = line.lstrip()[:1] in [b'd', b'D']
+
+    # the positions (and flags) are tokenized at once, see
+    # Poscar.parse()
+    lines = [f.readline() for i in range(p.Ntotal)]
+    ncols = 6 if p.selective else 3
+    tokens = b' '.join(lines).split()
+    if len(tokens) != p.Ntotal*ncols:
+      tokens = [x for line in lines for x in line.split()[:ncols]]
+    if len(tokens) != p.Ntotal*ncols:
+      raise RuntimeError('Frame ' + str(frame) + ' is incomplete')
+    # the other coordinates are computed only if they are used
+    self._buffer[:] = np.array([tokens[i::ncols] for i in range(3)], dtype=float).T
+    if direct:
+      p.dpos = self._buffer
+    else:
+      self._buffer *= header['scale']
+      p.cpos = self._buffer
+    if p.selective:
+      p.selectFlags = np.array([tokens[i::ncols] for i in range(3, 6)]).T == b'T'
+    return p
+
+  def frames(self, start=0, stop=None, step=1, copy=False):
+    """Generator with the frames from `start` to `stop` (not included)
+    each `step`, as Poscar objects. The file is kept open.
+
+    `copy`: if False, the same Poscar object is yielded every time,
+    updated with the new positions.
+
+    """
+    if self.offsets is None:
+      self.scan()
+    with open(self.filename, 'rb') as f:
+      for frame in range(*slice(start, stop, step).indices(self.Nframes)):
+        p = self._read(f, frame)
+        if copy:
+          p = deepcopy(p)
+        yield p
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("inputfile", type=str, help="XDATCAR or concatenated POSCARs")
+  parser.add_argument('--frame', '-f', type=int, default=None,
+                      help='frame to write as POSCAR (0-based, -1 is the last one)')
+  parser.add_argument('--output', '-o', type=str, default='POSCAR.out',
+                      help='name of the POSCAR file written')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  args = parser.parse_args()
+
+  traj = Trajectory(args.inputfile, verbose=args.verbose)
+  print('Number of frames:', len(traj))
+  if args.frame is not None:
+    p = traj.read(args.frame)
+    p.write(args.output)
+    print('frame', args.frame, 'written to', args.output)